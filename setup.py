@@ -44,6 +44,7 @@ setup(
         "sounddevice==0.4.6",  # Required for tts and stt
         "pyttsx3==2.90",  # Required for tts
         "peft==0.12.0",
+        "msgpack==1.0.8",  # Binary request encoding, JSON is used without it
 
         # Pyinstaller Dependencies
         "ninja==1.11.1.1",
@@ -0,0 +1,248 @@
+"""
+Offline batch inference.
+
+Reads one request per line from a JSONL file or stdin, in the same format as
+requests sent to the server (prompt, instructions or conversation, and
+generation settings), plus an optional "id". Writes one result per line:
+
+    {"index": 0, "id": ..., "response": "...", "tokens": 12}
+
+Requests are read a window at a time and sorted by length, so every batch
+holds prompts of similar length and little padding. The output file is the
+checkpoint: results are flushed after every batch, and a rerun with the same
+input and output skips requests which already have a result.
+
+    python -m airunner_nexus.batch prompts.jsonl --output results.jsonl --ordered
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Iterable, Iterator, List, Optional, Set, TextIO, Tuple
+
+from airunner_nexus import settings
+from airunner_nexus.logger import logger
+
+# Request keys which do not change how a prompt is generated
+PROMPT_KEYS = ("id", "prompt", "instructions", "conversation", "history", "listener", "speaker")
+
+
+def settings_key(data: dict) -> str:
+    """Requests with the same key can share a batch."""
+    return json.dumps(
+        {key: value for key, value in data.items() if key not in PROMPT_KEYS},
+        sort_keys=True,
+        default=str
+    )
+
+
+def prompt_length(data: dict) -> int:
+    return len(json.dumps(data.get("conversation") or [data.get("instructions", ""), data.get("prompt", "")]))
+
+
+class BatchRunner:
+    def __init__(
+        self,
+        handler,
+        output_path: str,
+        batch_size: int = settings.BATCH_SIZE,
+        window: int = settings.BATCH_WINDOW,
+        ordered: bool = False
+    ):
+        """
+        :param handler: an LLMHandler, or anything with the same query_model and query_model_batch
+        :param window: requests read ahead and sorted by length before batching
+        :param ordered: write results in input order instead of as they complete
+        """
+        self.handler = handler
+        self.output_path = output_path
+        self.progress_path = output_path + ".progress.json"
+        self.batch_size = batch_size
+        self.window = max(window, batch_size)
+        self.ordered = ordered
+        self.completed = set()
+        self.pending = {}
+        self.next_index = 0
+        self.total_requests = 0
+        self.total_tokens = 0
+        self.total_seconds = 0.0
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.total_tokens / self.total_seconds if self.total_seconds else 0.0
+
+    def load_checkpoint(self) -> Set[int]:
+        """Find the requests which already have a result, dropping a half written last line."""
+        completed = set()
+        if os.path.exists(self.output_path):
+            valid_size = 0
+            with open(self.output_path, "rb") as output:
+                for line in output:
+                    try:
+                        completed.add(json.loads(line)["index"])
+                    except (ValueError, KeyError):
+                        break
+                    valid_size += len(line)
+            if valid_size < os.path.getsize(self.output_path):
+                with open(self.output_path, "r+b") as output:
+                    output.truncate(valid_size)
+        if os.path.exists(self.progress_path):
+            with open(self.progress_path) as progress:
+                progress = json.load(progress)
+            self.total_tokens = progress.get("tokens", 0)
+            self.total_seconds = progress.get("seconds", 0.0)
+        return completed
+
+    def save_progress(self):
+        path = self.progress_path + ".tmp"
+        with open(path, "w") as progress:
+            json.dump({
+                "completed": len(self.completed),
+                "tokens": self.total_tokens,
+                "seconds": self.total_seconds,
+            }, progress)
+        os.replace(path, self.progress_path)
+
+    def windows(self, lines: Iterable[str]) -> Iterator[List[Tuple[int, Optional[dict]]]]:
+        """Groups of (index, request) still to run; request is None for lines which are not valid JSON."""
+        window = []
+        for index, line in enumerate(lines):
+            if not line.strip():
+                self.completed.add(index)
+            if index in self.completed:
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                data = None
+            window.append((index, data))
+            if len(window) >= self.window:
+                yield window
+                window = []
+        if window:
+            yield window
+
+    def batches(self, window: List[Tuple[int, dict]]) -> Iterator[List[Tuple[int, dict]]]:
+        """Split a window into batches of requests with the same settings and similar lengths."""
+        window = sorted(window, key=lambda item: (settings_key(item[1]), prompt_length(item[1])))
+        batch = []
+        for item in window:
+            if batch and (len(batch) >= self.batch_size or settings_key(batch[0][1]) != settings_key(item[1])):
+                yield batch
+                batch = []
+            batch.append(item)
+        if batch:
+            yield batch
+
+    def run_batch(self, batch: List[Tuple[int, dict]]) -> List[dict]:
+        requests = [data for _index, data in batch]
+        if len(requests) == 1 or requests[0].get("json_schema") is not None:
+            # Grammar constrained requests keep their state per sequence
+            replies = []
+            for data in requests:
+                chunks = list(self.handler.query_model(data))
+                replies.append(("".join(chunks), self.count_tokens(chunks)))
+        else:
+            replies = self.handler.query_model_batch(requests)
+        return [
+            {"index": index, "id": data.get("id"), "response": text, "tokens": tokens}
+            for (index, data), (text, tokens) in zip(batch, replies)
+        ]
+
+    def count_tokens(self, chunks: List[str]) -> int:
+        """
+        Tokens in a streamed reply. Streamed chunks are decoded text, not
+        tokens, so the reply is retokenized; handlers without a tokenizer,
+        like the fake engine, stream one token per chunk.
+        """
+        tokenizer = getattr(self.handler, "tokenizer", None)
+        if tokenizer is None:
+            return len(chunks)
+        return len(tokenizer("".join(chunks), add_special_tokens=False)["input_ids"])
+
+    def write(self, output: TextIO, results: List[dict]):
+        for result in results:
+            self.completed.add(result["index"])
+            if not self.ordered:
+                output.write(json.dumps(result) + "\n")
+                continue
+            self.pending[result["index"]] = result
+        while self.ordered:
+            while self.next_index in self.completed and self.next_index not in self.pending:
+                # Written by an earlier run
+                self.next_index += 1
+            if self.next_index not in self.pending:
+                break
+            output.write(json.dumps(self.pending.pop(self.next_index)) + "\n")
+            self.next_index += 1
+        output.flush()
+        os.fsync(output.fileno())
+
+    def run(self, lines: Iterable[str]):
+        self.completed = self.load_checkpoint()
+        if self.completed:
+            logger.info(f"Resuming after {len(self.completed)} completed requests")
+        with open(self.output_path, "a", encoding="utf-8") as output:
+            for window in self.windows(lines):
+                invalid = [
+                    {"index": index, "id": None, "error": "request is not a JSON object"}
+                    for index, data in window if data is None
+                ]
+                if invalid:
+                    self.write(output, invalid)
+                for batch in self.batches([item for item in window if item[1] is not None]):
+                    start = time.perf_counter()
+                    try:
+                        results = self.run_batch(batch)
+                    except Exception as e:
+                        logger.error(f"Batch of {len(batch)} requests failed: {e}")
+                        results = [{"index": index, "id": data.get("id"), "error": str(e)} for index, data in batch]
+                    self.total_seconds += time.perf_counter() - start
+                    self.total_tokens += sum(result.get("tokens", 0) for result in results)
+                    self.total_requests += len(results)
+                    self.write(output, results)
+                    self.save_progress()
+                    logger.info(
+                        f"{len(self.completed)} requests done, "
+                        f"batch of {len(batch)}, {self.tokens_per_second:.1f} tokens/sec"
+                    )
+            self.write(output, [])
+        logger.info(
+            f"Finished {self.total_requests} requests, {self.total_tokens} tokens "
+            f"in {self.total_seconds:.1f}s: {self.tokens_per_second:.1f} tokens/sec"
+        )
+
+
+def load_handler(engine: str, model_name: str):
+    if engine == "fake":
+        from airunner_nexus.llm.fake_llm_handler import FakeLLMHandler
+        return FakeLLMHandler(model_name)
+    from airunner_nexus.llm.llm_handler import LLMHandler
+    return LLMHandler(model_name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a JSONL file of requests through the model.")
+    parser.add_argument("input", nargs="?", default="-", help="JSONL file of requests, or - for stdin")
+    parser.add_argument("--output", required=True, help="JSONL file of results, also used to resume")
+    parser.add_argument("--ordered", action="store_true", help="write results in input order")
+    parser.add_argument("--batch-size", type=int, default=settings.BATCH_SIZE)
+    parser.add_argument("--window", type=int, default=settings.BATCH_WINDOW)
+    parser.add_argument("--engine", default=settings.LLM_ENGINE, choices=["transformers", "fake"])
+    parser.add_argument("--model", default=settings.DEFAULT_MODEL_NAME)
+    args = parser.parse_args()
+    runner = BatchRunner(
+        load_handler(args.engine, args.model),
+        args.output,
+        batch_size=args.batch_size,
+        window=args.window,
+        ordered=args.ordered
+    )
+    if args.input == "-":
+        runner.run(sys.stdin)
+    else:
+        with open(args.input, encoding="utf-8") as input_file:
+            runner.run(input_file)
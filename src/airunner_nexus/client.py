@@ -1,11 +1,22 @@
+import base64
+import codecs
 import json
+import os
 import re
 import socket
+import threading
 import time
 from datetime import datetime
-from typing import Generator, Optional
+from typing import Callable, Generator, List, Optional, Tuple, Union
 
+import numpy as np
+
+from airunner_nexus.codec import ENCODING_JSON, ENCODING_MSGPACK, decode, encode
+from airunner_nexus.enums import FrameType
+from airunner_nexus.frames import AUDIO_DTYPE, AUDIO_HEADER, EMBEDDING_DTYPE, EMBEDDING_HEADER, FLAG_SHM, FRAME_HEADER, PROTOCOL_FRAMES, \
+    PROTOCOL_PACKETS, decode_header, encode_frame
 from airunner_nexus.llm.agent import Agent
+from airunner_nexus.shared_memory_ring import SharedMemoryRing
 from airunner_nexus.settings import DEFAULT_HOST, DEFAULT_PORT, PACKET_SIZE, USER_NAME, BOT_NAME, LLM_INSTRUCTIONS
 
 
@@ -17,16 +28,35 @@ class Client:
         packet_size: int = PACKET_SIZE,
         retry_delay: int = 2,
         user_name: str = USER_NAME,
-        bot_name: str = BOT_NAME
+        bot_name: str = BOT_NAME,
+        unix_socket_path: Optional[str] = None
     ):
+        """
+        :param unix_socket_path: connect to the server's Unix domain socket
+            instead of host and port when the server runs on this machine
+        """
         self.host = host
         self.port = port
         self.packet_size = packet_size
         self.retry_delay = retry_delay
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.unix_socket_path = unix_socket_path
+        if unix_socket_path:
+            self.client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.bot_agent = Agent(name=bot_name)
         self.user_agent = Agent(name=user_name)
         self.history = []
+        self.protocol = PROTOCOL_PACKETS
+        self.encoding = ENCODING_JSON
+        self.request_ring = None
+        self.response_ring = None
+        self.shm_threshold = None
+        # Timing of the last streamed response, see stream_query
+        self.last_stats = None
+        # Second connection for mood updates, see start_mood_update
+        self._mood_client = None
+        self._mood_thread = None
         self.connect()
 
     @property
@@ -71,33 +101,65 @@ class Client:
     def python_rules(self) -> str:
         return LLM_INSTRUCTIONS["python_rules"]
 
+    @property
+    def dialogue_stop(self) -> list:
+        """Stop once the model starts writing the next speaker's line."""
+        return [f"\n{self.user_agent.name}:", f"\n{self.bot_agent.name}:"]
+
     def do_greeting(self) -> Generator[str, None, None]:
         return self.do_query(
             LLM_INSTRUCTIONS["greeting_prompt"].format(speaker_name=self.bot_agent.name),
-            self.dialogue_instructions
+            self.dialogue_instructions,
+            stop=self.dialogue_stop
         )
 
     def do_response(self) -> Generator[str, None, None]:
         return self.do_query(
             LLM_INSTRUCTIONS["response_prompt"].format(speaker_name=self.bot_agent.name),
-            self.dialogue_instructions
+            self.dialogue_instructions,
+            stop=self.dialogue_stop
         )
 
-    def update_mood(self, agent: Agent) -> Agent:
-        stats = ", ".join([f'"{k}": {v}' for k, v in agent.mood_stats.items()])
-        res = self.do_query(
-            LLM_INSTRUCTIONS["update_mood_prompt"].format(
-                agent_name=agent.name,
-                stats=stats
-            ),
-            self.update_mood_instructions
-        )
-        python_code_match = self.find_python(res)
-        if python_code_match:
-            python_code = python_code_match.group(1)
-            exec(python_code, {}, {"agent": agent})
+    @property
+    def mood_client(self) -> "Client":
+        """A second connection, so mood updates don't wait behind the dialogue response."""
+        if self._mood_client is None:
+            self._mood_client = Client(
+                self.host,
+                self.port,
+                self.packet_size,
+                self.retry_delay,
+                unix_socket_path=self.unix_socket_path
+            )
+        return self._mood_client
+
+    def update_mood(self, agent: Agent, client: Optional["Client"] = None) -> Agent:
+        """Apply the mood deltas the server scores for the latest turns of the conversation."""
+        client = client or self
+        client.send_request({
+            "reqtype": "update_mood",
+            "agent": agent.name,
+            "stats": dict(agent.mood_stats),
+            "history": list(self.history),
+        })
+        try:
+            mood_deltas = client.receive_object().get("mood_deltas", {})
+        except ValueError:
+            return agent
+        for stat, amount in mood_deltas.items():
+            agent.update_mood_stat(stat, amount)
         return agent
 
+    def start_mood_update(self, agent: Agent):
+        """
+        Update the agent's mood on the mood connection while the response
+        streams. The deltas apply when they arrive, so they shape the next turn.
+        """
+        if self._mood_thread is not None:
+            self._mood_thread.join()
+        self._mood_thread = threading.Thread(target=self.update_mood, args=(agent, self.mood_client), daemon=True)
+        self._mood_thread.start()
+
     @staticmethod
     def find_python(res: str) -> Optional[re.Match]:
         return Client.find_code_block("python", res)
@@ -113,20 +175,20 @@ class Client:
     def do_prompt(self, user_prompt: str, update_speaker_mood: bool = False) -> Generator[str, None, None]:
         self.update_history(self.user_agent.name, user_prompt)
         if update_speaker_mood:
-            self.bot_agent = self.update_mood(self.bot_agent)
+            self.start_mood_update(self.bot_agent)
         for res in self.do_response():
             yield res
 
     def update_history(self, name: str, message: str):
         self.history.append({"name": name, "message": message})
 
-    def do_query(self, user_prompt: str, instructions: str) -> Generator[str, None, None]:
+    def build_request(self, user_prompt: str, instructions: str, **kwargs) -> dict:
         if self.history:
             instructions += "\nThe conversation so far:\n" + "\n".join(
                 f"{turn['name']}: {turn['message']}" for turn in self.history
             )
 
-        self.send_message(json.dumps({
+        request = {
             "history": self.history,
             "listener": self.user_agent.to_dict() if self.user_agent else None,
             "speaker": self.bot_agent.to_dict() if self.bot_agent else None,
@@ -148,43 +210,215 @@ class Client:
             "decoder_start_token_id": None,
             "use_cache": True,
             "length_penalty": 1.0
-        }))
+        }
+        request.update({key: value for key, value in kwargs.items() if value is not None})
+        return request
+
+    def do_query(
+        self,
+        user_prompt: str,
+        instructions: str,
+        json_schema: Optional[dict] = None,
+        stop: Optional[list] = None,
+        on_first_token: Optional[Callable[[float], None]] = None,
+        on_complete: Optional[Callable[[str, dict], None]] = None
+    ) -> Generator[str, None, None]:
+        """Yield the text of the response as it arrives, without the bot's name in front of it."""
+        prefix = f"{self.bot_agent.name}: "
+        pending = ""
+        for delta in self.stream_query(
+            self.build_request(user_prompt, instructions, json_schema=json_schema, stop=stop or None),
+            on_first_token=on_first_token,
+            on_complete=on_complete
+        ):
+            if prefix is not None:
+                # Hold the start back until it can't be the bot's name
+                pending += delta
+                if len(pending) < len(prefix) and prefix.startswith(pending):
+                    continue
+                delta = pending[len(prefix):] if pending.startswith(prefix) else pending
+                prefix = None
+            if delta:
+                yield delta
+        if prefix is not None and pending:
+            yield pending
+
+    def stream_query(
+        self,
+        request: dict,
+        on_first_token: Optional[Callable[[float], None]] = None,
+        on_complete: Optional[Callable[[str, dict], None]] = None
+    ) -> Generator[str, None, None]:
+        """
+        Send a request and yield each new piece of the response as it arrives.
+        :param on_first_token: called with the seconds until the first text arrived
+        :param on_complete: called with the whole response and its timing stats,
+            which are also kept in last_stats
+        """
+        started_at = time.perf_counter()
+        first_token_at = None
+        chunks = []
+        self.send_request(request)
+        for delta in self.receive_message():
+            delta = delta.replace('\x00', '')
+            if not delta:
+                continue
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+                if on_first_token is not None:
+                    on_first_token(first_token_at - started_at)
+            chunks.append(delta)
+            yield delta
+        total = time.perf_counter() - started_at
+        response = "".join(chunks)
+        self.last_stats = {
+            "time_to_first_token_ms": round((first_token_at - started_at) * 1000, 2) if first_token_at else None,
+            "total_ms": round(total * 1000, 2),
+            "chunks": len(chunks),
+            "characters": len(response),
+            "characters_per_second": round(len(response) / total, 2) if total else 0.0,
+        }
+        if on_complete is not None:
+            on_complete(response, self.last_stats)
+
+    def do_query_candidates(
+        self,
+        user_prompt: str,
+        instructions: str,
+        num_candidates: int
+    ) -> Generator[Tuple[int, str], None, None]:
+        """
+        Sample several candidate responses in one request.
 
-        server_response = ""
-        for res in self.receive_message():
-            res = res.replace(f"{self.bot_agent.name}: ", "").replace('\x00', '')
-            server_response += res
-            yield server_response
+        With the framed protocol every candidate is streamed as it is
+        generated; otherwise each candidate arrives complete at the end.
+        :return: (candidate index, text) tuples
+        """
+        self.send_request(self.build_request(
+            user_prompt,
+            instructions,
+            num_return_sequences=num_candidates
+        ))
+        if self.protocol == PROTOCOL_FRAMES:
+            for frame_type, stream_id, payload in self.receive_frames():
+                if frame_type is FrameType.TEXT:
+                    yield stream_id, payload.decode("utf-8")
+            return
+        for index, candidate in enumerate(self.receive_object().get("candidates", [])):
+            yield index, candidate
+
+    def do_query_speech(
+        self,
+        user_prompt: str,
+        instructions: str,
+        stop: Optional[list] = None
+    ) -> Generator[Tuple[Optional[str], Optional[Tuple[int, np.ndarray]]], None, None]:
+        """
+        Ask for a response which the server also speaks, a sentence at a
+        time while it is generated. Needs the framed protocol.
+        :return: (text, None) for each chunk of text and (None, (sample rate,
+            int16 samples)) for the audio of each sentence, as they arrive
+        """
+        self.send_request(self.build_request(user_prompt, instructions, stop=stop or None, tts=True))
+        for frame_type, _stream_id, payload in self.receive_frames():
+            if frame_type is FrameType.TEXT:
+                yield payload.decode("utf-8"), None
+            elif frame_type is FrameType.AUDIO:
+                _index, sample_rate = AUDIO_HEADER.unpack_from(payload)
+                yield None, (sample_rate, np.frombuffer(payload, dtype=AUDIO_DTYPE, offset=AUDIO_HEADER.size))
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """:return: float16 embeddings from the server, one row per text"""
+        self.send_request({"reqtype": "embed", "texts": texts})
+        if self.protocol == PROTOCOL_FRAMES:
+            embeddings = np.zeros((0, 0), dtype=EMBEDDING_DTYPE)
+            for frame_type, _stream_id, payload in self.receive_frames():
+                if frame_type is FrameType.EMBEDDING:
+                    rows, dimensions = EMBEDDING_HEADER.unpack_from(payload)
+                    embeddings = np.frombuffer(payload, dtype=EMBEDDING_DTYPE, offset=EMBEDDING_HEADER.size).reshape(
+                        rows, dimensions
+                    )
+            return embeddings
+        response = self.receive_object()
+        return np.frombuffer(base64.b64decode(response["embeddings"]), dtype=EMBEDDING_DTYPE).reshape(response["shape"])
 
     def _handle_prompt(self, prompt: str) -> Generator[str, None, None]:
-        response = ""
-        for txt in self.do_prompt(prompt):
-            response = str(txt)
-            yield response
-        self.update_history(self.bot_agent.name, response)
+        chunks = []
+        for delta in self.do_prompt(prompt):
+            chunks.append(delta)
+            yield delta
+        self.update_history(self.bot_agent.name, "".join(chunks))
 
     def run(self):
         while True:
             prompt = input("Enter a prompt: ")
             for res in self._handle_prompt(prompt):
                 self.handle_res(res)
+            print()
 
     def handle_res(self, res: str):
-        self.update_history(self.bot_agent.name, res)
-        print(res)
+        print(res, end="", flush=True)
 
     def connect(self):
         while True:
             try:
-                self.client_socket.connect((self.host, self.port))
+                if self.unix_socket_path:
+                    self.client_socket.connect(os.path.expanduser(self.unix_socket_path))
+                else:
+                    self.client_socket.connect((self.host, self.port))
                 print("Connected to server.")
                 return
-            except ConnectionRefusedError:
+            except (ConnectionRefusedError, FileNotFoundError):
                 print(f"Connection refused. Retrying in {self.retry_delay} seconds...")
                 time.sleep(self.retry_delay)
 
-    def send_message(self, message: str):
-        message = message.encode('utf-8')
+    def negotiate_protocol(
+        self,
+        protocol: str = PROTOCOL_FRAMES,
+        shm: bool = False,
+        encoding: Optional[str] = None
+    ) -> str:
+        """
+        Ask the server to switch this connection to another protocol.
+        :param shm: ask for shared memory rings for large payloads; only
+            granted for frames over a Unix domain socket
+        :param encoding: ask for "msgpack" requests and structured responses
+            instead of JSON; only granted for frames, if the server has msgpack
+        """
+        hello = {"reqtype": "hello", "protocol": protocol}
+        if shm:
+            hello["shm"] = True
+        if encoding:
+            hello["encoding"] = encoding
+        self.send_message(json.dumps(hello))
+        response = json.loads("".join(self.receive_message()).replace('\x00', ''))
+        self.protocol = response.get("protocol", PROTOCOL_PACKETS)
+        self.encoding = response.get("encoding", ENCODING_JSON)
+        rings = response.get("shm")
+        if rings:
+            self.request_ring = SharedMemoryRing(rings["requests"]["name"], rings["requests"]["size"])
+            self.response_ring = SharedMemoryRing(rings["responses"]["name"], rings["responses"]["size"])
+            self.shm_threshold = rings["threshold"]
+        return self.protocol
+
+    def send_request(self, request: dict):
+        """Send a request in the negotiated encoding."""
+        self.send_message(encode(request, self.encoding))
+
+    def send_message(self, message: Union[str, bytes]):
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        if self.protocol == PROTOCOL_FRAMES:
+            frame = None
+            if self.request_ring is not None and len(message) >= self.shm_threshold:
+                descriptor = self.request_ring.write(message)
+                if descriptor is not None:
+                    frame = encode_frame(FrameType.REQUEST, descriptor, flags=FLAG_SHM)
+            try:
+                self.client_socket.sendall(frame or encode_frame(FrameType.REQUEST, message))
+            except BrokenPipeError:
+                print("Connection lost. Make sure the server is running.")
+            return
         while message:
             packet = message[:self.packet_size]
             message = message[self.packet_size:]
@@ -197,24 +431,91 @@ class Client:
         self.send_end_message()
 
     def send_end_message(self):
+        if self.protocol == PROTOCOL_FRAMES:
+            return
         try:
             self.client_socket.sendall(b'\x00' * self.packet_size)
         except BrokenPipeError:
             print("Connection lost. Make sure the server is running.")
 
-    def receive_message(self) -> Generator[str, None, None]:
+    def read_exact(self, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = self.client_socket.recv(size - len(data))
+            if not chunk:
+                raise ConnectionResetError("connection closed by server")
+            data += chunk
+        return data
+
+    def receive_frames(self) -> Generator[Tuple[FrameType, int, bytes], None, None]:
+        """Yield (frame type, stream id, payload) until the server marks the response as done."""
         while True:
             try:
-                packet = self.client_socket.recv(self.packet_size)
+                frame_type, flags, stream_id, length = decode_header(self.read_exact(FRAME_HEADER.size))
+                payload = self.read_exact(length) if length else b''
             except OSError:
                 print("Connection lost. Make sure the server is running.")
                 break
-            if packet == b'\x00' * self.packet_size:
+            if flags & FLAG_SHM:
+                payload = self.response_ring.read(payload)
+            if frame_type is FrameType.DONE:
                 break
-            yield packet.decode('utf-8')
+            yield frame_type, stream_id, payload
+
+    def receive_message(self) -> Generator[str, None, None]:
+        """Yield the text of a response as it arrives, never splitting a character."""
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        if self.protocol == PROTOCOL_FRAMES:
+            for frame_type, _stream_id, payload in self.receive_frames():
+                if frame_type in (FrameType.TEXT, FrameType.JSON):
+                    text = decoder.decode(payload)
+                    if text:
+                        yield text
+                elif frame_type is FrameType.ERROR:
+                    print(f"Server error: {payload.decode('utf-8', errors='replace')}")
+        else:
+            while True:
+                try:
+                    packet = self.read_exact(self.packet_size)
+                except OSError:
+                    print("Connection lost. Make sure the server is running.")
+                    break
+                if packet == b'\x00' * self.packet_size:
+                    break
+                text = decoder.decode(packet.rstrip(b'\x00'))
+                if text:
+                    yield text
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+
+    def receive_object(self) -> dict:
+        """
+        Read a structured response, in whichever encoding it was sent.
+        Raises ValueError if it can't be decoded.
+        """
+        if self.protocol == PROTOCOL_FRAMES:
+            message = {}
+            for frame_type, _stream_id, payload in self.receive_frames():
+                if frame_type is FrameType.JSON:
+                    message = decode(payload, ENCODING_JSON)
+                elif frame_type is FrameType.MSGPACK:
+                    message = decode(payload, ENCODING_MSGPACK)
+            return message
+        return json.loads("".join(self.receive_message()).replace('\x00', ''))
 
     def close_connection(self):
+        if self._mood_thread is not None:
+            self._mood_thread.join()
+        if self._mood_client is not None:
+            self._mood_client.close_connection()
+            self._mood_client = None
         self.client_socket.close()
+        for ring in (self.request_ring, self.response_ring):
+            if ring is not None:
+                ring.close()
+        self.request_ring = None
+        self.response_ring = None
 
 
 if __name__ == "__main__":
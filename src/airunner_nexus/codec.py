@@ -0,0 +1,148 @@
+"""
+Encodings of requests and structured responses.
+
+JSON is always available. A client using the framed protocol may ask for
+MessagePack in its hello request; if the server has msgpack installed it
+agrees, and from then on requests and structured responses on that
+connection are MessagePack. Keys listed in FIELDS are sent as their index
+instead of their name, at any depth, so a long history costs a byte per key.
+
+Run this module to compare both encodings on a request with a long history:
+
+    python -m airunner_nexus.codec --turns 200
+"""
+import argparse
+import json
+import time
+from typing import Any, Callable
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ENCODING_JSON = "json"
+ENCODING_MSGPACK = "msgpack"
+
+# Field ids are the positions in this tuple. Both ends must agree on them:
+# only ever append new fields, never reorder or remove one.
+FIELDS = (
+    # requests
+    "reqtype", "prompt", "instructions", "conversation", "history", "listener", "speaker",
+    "use_usernames", "prompt_prefix", "max_new_tokens", "temperature", "top_k", "top_p",
+    "query_type", "min_length", "do_sample", "early_stopping", "num_beams", "repetition_penalty",
+    "num_return_sequences", "decoder_start_token_id", "use_cache", "length_penalty",
+    "json_schema", "stop", "stop_token_ids", "seed", "priority", "tenant", "session_id",
+    "trace", "profile", "tts", "text", "texts", "request_id", "agent", "stats",
+    # history, conversation and agents
+    "name", "message", "role", "content",
+    # responses
+    "status", "connections", "queued", "mood_deltas", "candidates", "shape", "dtype", "embeddings",
+)
+FIELD_IDS = {name: index for index, name in enumerate(FIELDS)}
+
+
+def available_encodings() -> list:
+    """Encodings this process can use, preferred first."""
+    return [ENCODING_MSGPACK, ENCODING_JSON] if msgpack is not None else [ENCODING_JSON]
+
+
+def compact(value: Any) -> Any:
+    """Replace known keys with their field ids."""
+    if isinstance(value, dict):
+        return {FIELD_IDS.get(key, key): compact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [compact(item) for item in value]
+    return value
+
+
+def expand_keys(pairs: list) -> dict:
+    """
+    Build a decoded map, replacing field ids with their keys. Requests come
+    from JSON, which only has string keys, so an integer key is always an id.
+    """
+    return {FIELDS[key] if type(key) is int and 0 <= key < len(FIELDS) else key: item for key, item in pairs}
+
+
+def encode(message: dict, encoding: str = ENCODING_JSON) -> bytes:
+    if encoding == ENCODING_MSGPACK:
+        return msgpack.packb(compact(message), use_bin_type=True)
+    return json.dumps(message, ensure_ascii=False).encode("utf-8")
+
+
+def decode(payload: bytes, encoding: str = ENCODING_JSON) -> Any:
+    """Raises ValueError if the payload is not a valid message in the encoding."""
+    if encoding == ENCODING_MSGPACK:
+        try:
+            return msgpack.unpackb(payload, raw=False, strict_map_key=False, object_pairs_hook=expand_keys)
+        except (msgpack.ExtraData, msgpack.FormatError, msgpack.StackError, ValueError, TypeError) as e:
+            raise ValueError(f"invalid MessagePack message: {e}")
+    return json.loads(payload.decode("utf-8"))
+
+
+def sample_request(turns: int) -> dict:
+    """A chat request like Client.build_request makes, with turns of history."""
+    history = [
+        {"name": "User" if index % 2 == 0 else "AI Bot", "message": f"Message number {index}, déjà vu? 🙂 " * 4}
+        for index in range(turns)
+    ]
+    return {
+        "history": history,
+        "listener": {"conversation": [], "name": "User"},
+        "speaker": {"conversation": [], "name": "AI Bot"},
+        "use_usernames": True,
+        "prompt_prefix": "",
+        "instructions": "You are a chatbot.\n" + "\n".join(f"{turn['name']}: {turn['message']}" for turn in history),
+        "prompt": "Generate a response for AI Bot",
+        "max_new_tokens": 1000,
+        "temperature": 0.9,
+        "top_k": 50,
+        "top_p": 0.9,
+        "query_type": "llm",
+        "min_length": 0,
+        "do_sample": True,
+        "early_stopping": True,
+        "num_beams": 1,
+        "repetition_penalty": 1.0,
+        "num_return_sequences": 1,
+        "decoder_start_token_id": None,
+        "use_cache": True,
+        "length_penalty": 1.0,
+    }
+
+
+def time_per_call(function: Callable[[], Any], repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def benchmark(turns: int, repeat: int) -> dict:
+    """:return: payload bytes and encode and decode microseconds of each available encoding"""
+    request = sample_request(turns)
+    results = {}
+    for encoding in available_encodings():
+        payload = encode(request, encoding)
+        assert decode(payload, encoding) == request
+        results[encoding] = {
+            "bytes": len(payload),
+            "encode_us": round(time_per_call(lambda: encode(request, encoding), repeat) * 1e6, 1),
+            "decode_us": round(time_per_call(lambda: decode(payload, encoding), repeat) * 1e6, 1),
+        }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare request encodings.")
+    parser.add_argument("--turns", type=int, nargs="+", default=[0, 20, 200, 2000], help="turns of history")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+    if msgpack is None:
+        print("msgpack is not installed, only JSON is available")
+    for turns in args.turns:
+        for encoding, result in benchmark(turns, args.repeat).items():
+            print(
+                f"{turns:>5} turns  {encoding:<8} {result['bytes']:>9} bytes  "
+                f"encode {result['encode_us']:>9.1f}us  decode {result['decode_us']:>9.1f}us"
+            )
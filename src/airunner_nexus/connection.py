@@ -0,0 +1,296 @@
+import itertools
+import re
+import socket
+import struct
+import threading
+import time
+from typing import List, Optional
+
+from airunner_nexus import settings
+from airunner_nexus.codec import ENCODING_JSON, ENCODING_MSGPACK, encode
+from airunner_nexus.enums import FrameType
+from airunner_nexus.exceptions import ProtocolError
+from airunner_nexus.frames import FLAG_SHM, FRAME_HEADER, PROTOCOL_FRAMES, PROTOCOL_PACKETS, decode_header
+from airunner_nexus.logger import logger
+from airunner_nexus.shared_memory_ring import SharedMemoryRing
+
+SENTENCE_END = re.compile(rb'[.!?\n]["\')\]]*\s*$')
+IOV_MAX = 1024
+
+
+class Connection:
+    """
+    A connected client socket.
+
+    Messages are sent as packets of packet_size bytes padded with null bytes
+    and terminated by a packet of null bytes, or as frames once the client has
+    negotiated the framed protocol. Sends are serialized with a lock so
+    several workers can answer the same client.
+
+    Outgoing messages are buffered and consecutive text for the same stream is
+    merged, so streamed tokens share packets. The buffer is written with one
+    vectored send once it holds flush_bytes, when text ends a sentence, at the
+    end of a response, or flush_delay_ms after the first buffered message.
+
+    Local clients on a Unix domain socket can attach shared memory rings, one
+    per direction. Frame payloads of at least shm_threshold bytes then go
+    through the rings and the socket only carries their descriptors.
+    """
+    _ids = itertools.count(1)
+
+    def __init__(
+        self,
+        soc: socket.socket,
+        address,
+        packet_size: int,
+        flush_bytes: int = settings.OUTPUT_FLUSH_BYTES,
+        flush_delay_ms: float = settings.OUTPUT_FLUSH_DELAY_MS,
+        flush_on_sentence: bool = settings.OUTPUT_FLUSH_ON_SENTENCE,
+        tcp_nodelay: bool = settings.TCP_NODELAY
+    ):
+        self.id = next(Connection._ids)
+        self.soc = soc
+        self.address = address
+        self.packet_size = packet_size
+        self.flush_bytes = flush_bytes
+        self.flush_delay = flush_delay_ms / 1000
+        self.flush_on_sentence = flush_on_sentence
+        self.is_open = True
+        self.protocol = PROTOCOL_PACKETS
+        # Encoding of requests and structured responses, negotiated with the protocol
+        self.encoding = ENCODING_JSON
+        self._send_lock = threading.RLock()
+        self._flush_condition = threading.Condition(self._send_lock)
+        self._pending = []
+        self._pending_bytes = 0
+        self._first_pending_at = None
+        self._padding = memoryview(bytes(packet_size))
+        self.input_ring = None
+        self.output_ring = None
+        self.shm_threshold = settings.SHM_THRESHOLD
+        # When the first bytes of the last message arrived, for tracing
+        self.receive_started_at = None
+        if tcp_nodelay and soc.family in (socket.AF_INET, socket.AF_INET6):
+            soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.flush_delay > 0:
+            threading.Thread(target=self._flush_loop, daemon=True, name=f"connection {self.id} flush").start()
+
+    @property
+    def uses_frames(self) -> bool:
+        return self.protocol == PROTOCOL_FRAMES
+
+    @property
+    def is_local(self) -> bool:
+        return self.soc.family == getattr(socket, "AF_UNIX", None)
+
+    def attach_rings(self, size: int, threshold: int) -> dict:
+        """
+        Create a ring for requests and one for responses.
+        :return: their names and sizes for the client
+        """
+        self.input_ring = SharedMemoryRing(size=size)
+        self.output_ring = SharedMemoryRing(size=size)
+        self.shm_threshold = threshold
+        return {
+            "requests": self.input_ring.describe(),
+            "responses": self.output_ring.describe(),
+            "threshold": threshold,
+        }
+
+    def do_send(self, msg: bytes) -> int:
+        """Send bytes to the client straight away, after anything already buffered."""
+        with self._send_lock:
+            self._pending.append((None, 0, msg))
+            return len(msg) if self.flush() else 0
+
+    def send_frame(self, frame_type: FrameType, payload: bytes = b"", stream_id: int = 0, flush: bool = True):
+        """Buffer a frame, or its packet equivalent for clients using packets."""
+        with self._send_lock:
+            last = self._pending[-1] if self._pending else None
+            if (
+                frame_type is FrameType.TEXT
+                and last is not None
+                and last[0] is FrameType.TEXT
+                and last[1] == stream_id
+            ):
+                last[2].extend(payload)
+            else:
+                self._pending.append((frame_type, stream_id, bytearray(payload)))
+            self._pending_bytes += len(payload)
+            if self._first_pending_at is None:
+                self._first_pending_at = time.monotonic()
+            if flush or self._pending_bytes >= self.flush_bytes:
+                self.flush()
+            else:
+                self._flush_condition.notify()
+
+    def send_message(self, message: bytes, stream_id: int = 0):
+        """Send a message to the client in byte packets, or as a text frame."""
+        self.send_frame(
+            FrameType.TEXT,
+            message,
+            stream_id,
+            flush=self.flush_on_sentence and SENTENCE_END.search(message) is not None
+        )
+
+    def send_end_message(self):
+        """Send a packet of null bytes, or a done frame, to indicate the end of a response."""
+        self.send_frame(FrameType.DONE)
+
+    def send_stream_end(self, stream_id: int):
+        """Mark the end of one stream of a response. Only meaningful for frames."""
+        if self.uses_frames:
+            self.send_frame(FrameType.END, stream_id=stream_id, flush=False)
+
+    def message_client(self, message: dict):
+        """Send a dict as a complete message in the connection's encoding."""
+        frame_type = FrameType.MSGPACK if self.encoding == ENCODING_MSGPACK else FrameType.JSON
+        with self._send_lock:
+            self.send_frame(frame_type, encode(message, self.encoding), flush=False)
+            self.send_end_message()
+
+    def _packetize(self, payload: bytearray) -> List[memoryview]:
+        """
+        Split a payload into packet sized views, each followed by a view of
+        the shared padding. Packets never end inside a UTF-8 character.
+        """
+        view = memoryview(payload)
+        size = len(payload)
+        buffers = []
+        start = 0
+        while start < size:
+            end = min(start + self.packet_size, size)
+            if end < size:
+                split = end
+                while split > start and payload[split] & 0xC0 == 0x80:
+                    split -= 1
+                end = split if split > start else end
+            buffers.append(view[start:end])
+            if end - start < self.packet_size:
+                buffers.append(self._padding[:self.packet_size - (end - start)])
+            start = end
+        return buffers
+
+    def _buffers(self) -> list:
+        buffers = []
+        for frame_type, stream_id, payload in self._pending:
+            if frame_type is None:
+                buffers.append(payload)
+            elif self.uses_frames:
+                descriptor = None
+                if self.output_ring is not None and len(payload) >= self.shm_threshold:
+                    descriptor = self.output_ring.write(payload)
+                if descriptor is not None:
+                    buffers.append(FRAME_HEADER.pack(frame_type.value, FLAG_SHM, stream_id, len(descriptor)))
+                    buffers.append(descriptor)
+                    continue
+                buffers.append(FRAME_HEADER.pack(frame_type.value, 0, stream_id, len(payload)))
+                if payload:
+                    buffers.append(memoryview(payload))
+            elif frame_type is FrameType.DONE:
+                buffers.append(self._padding)
+            elif frame_type in (FrameType.TEXT, FrameType.JSON):
+                buffers.extend(self._packetize(payload))
+        return buffers
+
+    def flush(self) -> bool:
+        """Write everything buffered. Returns False if the client is gone."""
+        with self._send_lock:
+            if not self._pending:
+                return self.is_open
+            buffers = self._buffers()
+            self._pending = []
+            self._pending_bytes = 0
+            self._first_pending_at = None
+            if not self.is_open:
+                logger.error("No connection to client")
+                return False
+            try:
+                self._send_buffers(buffers)
+            except OSError as e:
+                logger.error(f"Failed to send to client {self.address}: {e}")
+                self.close()
+                return False
+            return True
+
+    def _send_buffers(self, buffers: list):
+        """Vectored send which carries on after partial writes."""
+        while buffers:
+            batch = buffers[:IOV_MAX]
+            if hasattr(self.soc, "sendmsg"):
+                sent = self.soc.sendmsg(batch)
+            else:
+                sent = self.soc.send(b"".join(batch))
+            index = 0
+            while index < len(batch) and sent >= len(batch[index]):
+                sent -= len(batch[index])
+                index += 1
+            buffers = buffers[index:]
+            if sent:
+                buffers[0] = memoryview(buffers[0])[sent:]
+
+    def _flush_loop(self):
+        """Flush buffered messages once they have waited flush_delay."""
+        with self._flush_condition:
+            while self.is_open:
+                if self._first_pending_at is None:
+                    self._flush_condition.wait()
+                    continue
+                remaining = self._first_pending_at + self.flush_delay - time.monotonic()
+                if remaining > 0:
+                    self._flush_condition.wait(remaining)
+                    continue
+                self.flush()
+
+    def read_exact(self, size: int) -> bytes:
+        """Read exactly size bytes. Returns b'' once the client has disconnected."""
+        data = b''
+        while len(data) < size:
+            chunk = self.soc.recv(size - len(data))
+            if not chunk:
+                return b''
+            data += chunk
+        return data
+
+    def get_packet(self) -> bytes:
+        """Read a whole packet. Returns b'' once the client has disconnected."""
+        return self.read_exact(self.packet_size)
+
+    def receive_frame(self) -> Optional[tuple]:
+        """
+        :return: (frame type, flags, stream id, payload) or None once the client has disconnected.
+        Raises ProtocolError for a malformed frame.
+        """
+        header = self.read_exact(FRAME_HEADER.size)
+        if not header:
+            return None
+        self.receive_started_at = time.monotonic()
+        try:
+            frame_type, flags, stream_id, length = decode_header(header)
+        except ValueError as e:
+            raise ProtocolError(f"invalid frame header: {e}")
+        payload = self.read_exact(length) if length else b''
+        if length and not payload:
+            return None
+        if flags & FLAG_SHM:
+            if self.input_ring is None:
+                raise ProtocolError("shared memory frame on a connection without shared memory rings")
+            try:
+                payload = self.input_ring.read(payload)
+            except (ValueError, struct.error) as e:
+                raise ProtocolError(f"invalid shared memory descriptor: {e}")
+        return frame_type, flags, stream_id, payload
+
+    def close(self):
+        with self._flush_condition:
+            if not self.is_open:
+                return
+            self.is_open = False
+            self._flush_condition.notify_all()
+            for ring in (self.input_ring, self.output_ring):
+                if ring is not None:
+                    ring.close()
+        try:
+            self.soc.close()
+        except OSError:
+            pass
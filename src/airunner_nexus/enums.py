@@ -1,4 +1,4 @@
-from enum import Enum
+from enum import Enum, auto
 
 
 class HandlerType(Enum):
@@ -30,12 +30,28 @@ class TTSModel(Enum):
     ESPEAK = "espeak"
     SPEECHT5 = "speecht5"
     BARK = "bark"
+    FAKE = "fake"
 
 
 class FilterType(Enum):
     PIXEL_ART = "pixelart"
 
 
-class AgentState(enum.Enum):
-    SEARCH = enum.auto()
-    CHAT = enum.auto()
+class AgentState(Enum):
+    SEARCH = auto()
+    CHAT = auto()
+
+
+class FrameType(Enum):
+    """Frame types of the framed protocol negotiated with a hello request."""
+    REQUEST = 1
+    TEXT = 2
+    END = 3
+    DONE = 4
+    JSON = 5
+    ERROR = 6
+    CANCEL = 7
+    QUIT = 8
+    EMBEDDING = 9
+    AUDIO = 10
+    MSGPACK = 11
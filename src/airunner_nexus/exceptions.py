@@ -10,4 +10,19 @@ class FailedToSendError(Exception):
 
 class NoConnectionToClientError(Exception):
     """No connection to client"""
-    message = "No connection to client"
\ No newline at end of file
+    message = "No connection to client"
+
+
+class MemoryBudgetError(Exception):
+    """Request does not fit in the memory budget"""
+    message = "Request does not fit in the memory budget"
+
+
+class GenerationError(Exception):
+    """Generation failed after the request was accepted"""
+    message = "Generation failed"
+
+
+class ProtocolError(Exception):
+    """Client sent something the protocol does not allow"""
+    message = "Protocol error"
@@ -0,0 +1,41 @@
+"""
+Framed protocol.
+
+After a client sends a hello request asking for the "frames" protocol, both
+sides exchange length-prefixed frames instead of null padded packets. Frames
+are binary safe and carry a stream id so that several streams, for example
+one per sampled candidate, can share a connection.
+
+Clients connected over a Unix domain socket may also ask for shared memory
+rings in the hello request. Large payloads are then written to a ring and
+the frame only carries a descriptor.
+
+The hello request may also ask for MessagePack instead of JSON for requests
+and structured responses, see codec.py.
+"""
+import struct
+
+from airunner_nexus.enums import FrameType
+
+PROTOCOL_PACKETS = "packets"
+PROTOCOL_FRAMES = "frames"
+# frame type, flags, stream id, payload length
+FRAME_HEADER = struct.Struct("!BBHI")
+# the payload is a shared memory ring descriptor, see shared_memory_ring.py
+FLAG_SHM = 0x01
+# rows, dimensions; followed by rows * dimensions little endian float16 values
+EMBEDDING_HEADER = struct.Struct("!II")
+EMBEDDING_DTYPE = "<f2"
+# sentence index, sample rate; followed by mono 16 bit little endian PCM
+AUDIO_HEADER = struct.Struct("!II")
+AUDIO_DTYPE = "<i2"
+
+
+def encode_frame(frame_type: FrameType, payload: bytes = b"", stream_id: int = 0, flags: int = 0) -> bytes:
+    return FRAME_HEADER.pack(frame_type.value, flags, stream_id, len(payload)) + payload
+
+
+def decode_header(header: bytes) -> tuple:
+    """:return: (frame type, flags, stream id, payload length)"""
+    frame_type, flags, stream_id, length = FRAME_HEADER.unpack(header)
+    return FrameType(frame_type), flags, stream_id, length
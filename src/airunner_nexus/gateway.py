@@ -0,0 +1,346 @@
+import argparse
+import base64
+import json
+import socket
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from airunner_nexus import settings
+from airunner_nexus.codec import ENCODING_JSON, encode
+from airunner_nexus.connection import Connection
+from airunner_nexus.enums import FrameType
+from airunner_nexus.frames import EMBEDDING_HEADER, PROTOCOL_FRAMES
+from airunner_nexus.logger import logger
+from airunner_nexus.server import Server
+
+# Rough number of characters per token, used to estimate prompt sizes
+CHARS_PER_TOKEN = 4
+
+
+class BackendError(Exception):
+    """A backend failed before it produced any output"""
+
+
+class Backend:
+    """
+    A server behind the gateway, with a pool of idle framed connections to it.
+    Its health and counters are updated under stats_lock, which the gateway
+    shares with its routing decisions.
+    """
+    def __init__(self, address: str, packet_size: int, timeout: float, stats_lock: Optional[threading.Lock] = None):
+        host, _, port = address.rpartition(":")
+        self.host = host
+        self.port = int(port)
+        self.packet_size = packet_size
+        self.timeout = timeout
+        self.is_healthy = True
+        self.outstanding_tokens = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.streamed_chunks = 0
+        self.total_latency = 0.0
+        self.total_first_chunk_latency = 0.0
+        self.health_latency = None
+        self.last_status = {}
+        self.idle = []
+        self.stats_lock = stats_lock or threading.Lock()
+        self._lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    def open_connection(self, protocol: Optional[str] = PROTOCOL_FRAMES) -> Connection:
+        soc = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        soc.settimeout(None)
+        connection = Connection(soc, (self.host, self.port), self.packet_size, flush_delay_ms=0)
+        if protocol:
+            self.request(connection, {"reqtype": "hello", "protocol": protocol})
+            connection.protocol = protocol
+        return connection
+
+    def request(self, connection: Connection, message: dict) -> dict:
+        """Send a request with the packet protocol and read its JSON reply."""
+        connection.message_client(message)
+        packets = []
+        while True:
+            packet = connection.get_packet()
+            if packet == b'':
+                raise BackendError(f"{self.name} closed the connection")
+            if packet == b'\x00' * self.packet_size:
+                break
+            packets.append(packet.rstrip(b'\x00'))
+        return json.loads(b''.join(packets).decode("utf-8"))
+
+    def acquire(self) -> Connection:
+        with self._lock:
+            while self.idle:
+                connection = self.idle.pop()
+                if connection.is_open:
+                    return connection
+        return self.open_connection()
+
+    def release(self, connection: Connection):
+        with self._lock:
+            if connection.is_open and self.is_healthy:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def close_idle(self):
+        with self._lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+    def check_health(self) -> bool:
+        start = time.perf_counter()
+        try:
+            connection = self.open_connection(protocol=None)
+            try:
+                connection.soc.settimeout(self.timeout)
+                status = self.request(connection, {"reqtype": "health"})
+            finally:
+                connection.close()
+        except (OSError, ValueError, BackendError) as e:
+            with self.stats_lock:
+                was_healthy = self.is_healthy
+                self.is_healthy = False
+            if was_healthy:
+                logger.error(f"Backend {self.name} failed its health check: {e}")
+            self.close_idle()
+            return False
+        is_healthy = status.get("status") == "ok"
+        with self.stats_lock:
+            was_healthy = self.is_healthy
+            self.health_latency = time.perf_counter() - start
+            self.last_status = status
+            self.is_healthy = is_healthy
+        if is_healthy and not was_healthy:
+            logger.info(f"Backend {self.name} is healthy again")
+        elif was_healthy and not is_healthy:
+            logger.error(f"Backend {self.name} reports status {status.get('status')}")
+        return is_healthy
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            completed = self.requests - self.failures
+            return {
+                "backend": self.name,
+                "healthy": self.is_healthy,
+                "in_flight": self.in_flight,
+                "outstanding_tokens": self.outstanding_tokens,
+                "requests": self.requests,
+                "failures": self.failures,
+                "streamed_chunks": self.streamed_chunks,
+                "mean_latency_ms": self.total_latency / completed * 1000 if completed else 0.0,
+                "mean_first_chunk_ms": self.total_first_chunk_latency / completed * 1000 if completed else 0.0,
+                "health_latency_ms": self.health_latency * 1000 if self.health_latency is not None else None,
+                "queued": self.last_status.get("queued"),
+            }
+
+
+class Gateway(Server):
+    """
+    Speak the client protocol and spread requests over several servers.
+
+    Requests go to the backend with the fewest outstanding tokens, except that
+    every session sticks to the backend which served it last so its prefix
+    cache stays warm, as long as that backend is healthy and not more than
+    affinity_slack tokens busier than the least loaded one. A session is the
+    request's session_id, or the client connection otherwise.
+
+    Backends are health checked in the background. A request whose backend
+    fails before producing output is retried on another backend.
+    """
+    def __init__(self, *args, **kwargs):
+        self.routing_lock = threading.Lock()
+        self.backends = [
+            Backend(address, kwargs.get("packet_size", settings.PACKET_SIZE), kwargs.get(
+                "health_timeout", settings.GATEWAY_HEALTH_TIMEOUT
+            ), self.routing_lock)
+            for address in kwargs.get("backends", settings.GATEWAY_BACKENDS)
+        ]
+        self.health_interval = kwargs.get("health_interval", settings.GATEWAY_HEALTH_INTERVAL)
+        self.affinity_slack = kwargs.get("affinity_slack", settings.GATEWAY_AFFINITY_SLACK)
+        self.max_sessions = kwargs.get("max_sessions", settings.GATEWAY_MAX_SESSIONS)
+        self.sessions = OrderedDict()
+        kwargs.setdefault("worker_threads", settings.GATEWAY_WORKER_THREADS)
+        super().__init__(*args, **kwargs)
+        self.start_thread(target=self.watch_backends, name="watch backends")
+
+    def load_llm(self):
+        """The gateway has no model of its own."""
+
+    def watch_backends(self):
+        while not self.quit_event.is_set():
+            for backend in self.backends:
+                backend.check_health()
+            self.quit_event.wait(self.health_interval)
+        for backend in self.backends:
+            backend.close_idle()
+
+    @staticmethod
+    def estimate_tokens(data: dict) -> int:
+        """Tokens a request will occupy on a backend: its prompt and everything it may generate."""
+        prompt = data.get("conversation") or [data.get("instructions", ""), data.get("prompt", "")]
+        prompt_tokens = len(json.dumps(prompt)) // CHARS_PER_TOKEN
+        return prompt_tokens + data.get("max_new_tokens", 1000) * data.get("num_return_sequences", 1)
+
+    def choose_backend(self, session: str, exclude: List[Backend]) -> Optional[Backend]:
+        with self.routing_lock:
+            healthy = [backend for backend in self.backends if backend.is_healthy and backend not in exclude]
+            if not healthy:
+                return None
+            least_loaded = min(healthy, key=lambda backend: backend.outstanding_tokens)
+            backend = self.sessions.get(session)
+            if (
+                backend not in healthy
+                or backend.outstanding_tokens > least_loaded.outstanding_tokens + self.affinity_slack
+            ):
+                backend = least_loaded
+            self.sessions[session] = backend
+            self.sessions.move_to_end(session)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+            return backend
+
+    def handle_message(self, msg: bytes, connection: Optional[Connection] = None):
+        data = self.request_data(msg, connection)
+        if connection is not None and connection.encoding != ENCODING_JSON:
+            # Backends are spoken to in JSON
+            msg = encode(data)
+        if data.get("reqtype") == "gateway_stats":
+            self.message_client({"backends": [backend.stats() for backend in self.backends]}, connection)
+            return
+        if data.get("reqtype") == "health":
+            healthy = any(backend.is_healthy for backend in self.backends)
+            self.message_client({
+                "status": "ok" if healthy else "unavailable",
+                "connections": len(self.connections),
+                "queued": self.queue.qsize(),
+            }, connection)
+            return
+        session = str(data.get("session_id") or f"connection-{connection.id if connection else 0}")
+        tokens = self.estimate_tokens(data)
+        tried = []
+        while True:
+            backend = self.choose_backend(session, tried)
+            if backend is None:
+                logger.error("No healthy backend for request")
+                if connection is not None:
+                    self.relay_frame(connection, FrameType.ERROR, b"no healthy backend")
+                self.send_end_message(connection)
+                return
+            tried.append(backend)
+            try:
+                self.proxy(backend, msg, tokens, connection)
+                return
+            except BackendError as e:
+                logger.error(f"Failing over from {backend.name}: {e}")
+                with self.routing_lock:
+                    backend.is_healthy = False
+                backend.close_idle()
+
+    @staticmethod
+    def relay_frame(connection: Connection, frame_type: FrameType, payload: bytes, stream_id: int = 0):
+        """
+        Forward a backend frame to the client. Clients using packets get
+        embeddings and errors as the JSON objects Server sends them.
+        """
+        if connection.uses_frames or frame_type is FrameType.JSON:
+            connection.send_frame(frame_type, payload, stream_id, flush=False)
+        elif frame_type is FrameType.EMBEDDING:
+            rows, dimensions = EMBEDDING_HEADER.unpack_from(payload)
+            connection.send_frame(FrameType.JSON, encode({
+                "shape": [rows, dimensions],
+                "dtype": "float16",
+                "embeddings": base64.b64encode(payload[EMBEDDING_HEADER.size:]).decode("ascii"),
+            }), flush=False)
+        elif frame_type is FrameType.ERROR:
+            connection.send_frame(FrameType.JSON, encode({"error": bytes(payload).decode("utf-8", "replace")}), flush=False)
+
+    def proxy(self, backend: Backend, msg: bytes, tokens: int, connection: Optional[Connection]):
+        """
+        Relay one request to a backend and stream its response to the client.
+        Raises BackendError if the backend fails before sending anything.
+        """
+        with self.routing_lock:
+            backend.outstanding_tokens += tokens
+            backend.in_flight += 1
+            backend.requests += 1
+        remaining = tokens
+        chunks = 0
+        start = time.perf_counter()
+        backend_connection = None
+        try:
+            try:
+                backend_connection = backend.acquire()
+                backend_connection.send_frame(FrameType.REQUEST, msg)
+            except OSError as e:
+                raise BackendError(str(e))
+            if not backend_connection.is_open:
+                raise BackendError(f"{backend.name} closed the connection")
+            while True:
+                try:
+                    frame = backend_connection.receive_frame()
+                except OSError:
+                    frame = None
+                if frame is None:
+                    if chunks == 0:
+                        raise BackendError(f"{backend.name} closed the connection")
+                    logger.error(f"Backend {backend.name} failed mid response")
+                    with self.routing_lock:
+                        backend.failures += 1
+                    if connection is not None:
+                        self.relay_frame(connection, FrameType.ERROR, b"backend failed")
+                    self.send_end_message(connection)
+                    backend_connection.close()
+                    return
+                frame_type, _flags, stream_id, payload = frame
+                if frame_type is FrameType.DONE:
+                    break
+                if chunks == 0:
+                    with self.routing_lock:
+                        backend.total_first_chunk_latency += time.perf_counter() - start
+                chunks += 1
+                if frame_type is FrameType.TEXT:
+                    with self.routing_lock:
+                        # Every chunk is at least one generated token
+                        if remaining > 0:
+                            backend.outstanding_tokens -= 1
+                            remaining -= 1
+                        backend.streamed_chunks += 1
+                    if connection is not None:
+                        connection.send_message(payload, stream_id)
+                elif frame_type is FrameType.END:
+                    if connection is not None:
+                        connection.send_stream_end(stream_id)
+                elif connection is not None:
+                    self.relay_frame(connection, frame_type, payload, stream_id)
+            self.send_end_message(connection)
+            with self.routing_lock:
+                backend.total_latency += time.perf_counter() - start
+            backend.release(backend_connection)
+        except BackendError:
+            with self.routing_lock:
+                backend.failures += 1
+            if backend_connection is not None:
+                backend_connection.close()
+            raise
+        finally:
+            with self.routing_lock:
+                backend.outstanding_tokens -= remaining
+                backend.in_flight -= 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Spread airunner_nexus clients over several servers.")
+    parser.add_argument("--host", default=settings.DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=settings.DEFAULT_PORT)
+    parser.add_argument("--backends", nargs="+", default=settings.GATEWAY_BACKENDS, help="host:port of each server")
+    args = parser.parse_args()
+    gateway = Gateway(host=args.host, port=args.port, backends=args.backends)
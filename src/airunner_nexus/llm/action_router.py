@@ -0,0 +1,110 @@
+import threading
+import time
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from airunner_nexus import settings
+from airunner_nexus.enums import LLMActionType
+from airunner_nexus.logger import logger
+
+ACTION_EXAMPLES = {
+    LLMActionType.DO_NOT_RESPOND: ["stop talking", "be quiet", "ok", "never mind"],
+    LLMActionType.CHAT: ["how are you today?", "tell me about yourself", "what do you think about that?"],
+    LLMActionType.GENERATE_IMAGE: ["draw a castle at sunset", "make a picture of a cat", "generate an image of a forest"],
+    LLMActionType.ANALYZE_VISION_HISTORY: ["what did you see?", "describe what is on the screen", "what was in that image?"],
+    LLMActionType.APPLICATION_COMMAND: ["open the settings", "save the file", "undo that"],
+    LLMActionType.UPDATE_MOOD: ["you make me so happy", "that was really mean of you", "I'm disappointed in you"],
+    LLMActionType.QUIT_APPLICATION: ["quit", "close the application", "exit the program"],
+    LLMActionType.TOGGLE_FULLSCREEN: ["go full screen", "make the window fullscreen", "exit full screen"],
+    LLMActionType.TOGGLE_TTS: ["turn on text to speech", "stop reading out loud", "mute your voice"],
+    LLMActionType.PERFORM_RAG_SEARCH: ["search my documents for the budget", "find the notes about the meeting", "look up what the manual says"],
+}
+
+
+class ActionRouter:
+    """
+    Classify a request into an LLMActionType by comparing its embedding with
+    precomputed embeddings of each action's description and examples.
+
+    When the softmax confidence of the best action is below the threshold the
+    request is handed to the fallback (usually the LLM) instead.
+    """
+    def __init__(
+        self,
+        embed: Callable[[List[str]], np.ndarray],
+        fallback: Optional[Callable[[str], LLMActionType]] = None,
+        threshold: float = settings.ROUTER_CONFIDENCE_THRESHOLD,
+        temperature: float = settings.ROUTER_TEMPERATURE
+    ):
+        self.embed = embed
+        self.fallback = fallback
+        self.threshold = threshold
+        self.temperature = temperature
+        self.actions = list(LLMActionType)
+        self.label_actions = []
+        texts = []
+        for action_index, action in enumerate(self.actions):
+            description = action.value.split(":", 1)[-1].replace("{{ username }}", "The user").strip()
+            for text in [description] + ACTION_EXAMPLES.get(action, []):
+                texts.append(text)
+                self.label_actions.append(action_index)
+        self.label_actions = np.asarray(self.label_actions)
+        self.label_embeddings = np.asarray(self.embed(texts), dtype=np.float32)
+        self.total_routed = 0
+        self.total_fallbacks = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def fallback_rate(self) -> float:
+        return self.total_fallbacks / self.total_routed if self.total_routed else 0.0
+
+    @property
+    def mean_latency_ms(self) -> float:
+        return self.total_latency / self.total_routed * 1000 if self.total_routed else 0.0
+
+    def scores(self, text: str) -> np.ndarray:
+        """Softmax over the best matching label of each action."""
+        similarities = self.label_embeddings @ np.asarray(self.embed([text]), dtype=np.float32)[0]
+        best = np.full(len(self.actions), -np.inf, dtype=np.float32)
+        np.maximum.at(best, self.label_actions, similarities)
+        logits = (best - best.max()) / self.temperature
+        probabilities = np.exp(logits)
+        return probabilities / probabilities.sum()
+
+    def route(self, text: str) -> dict:
+        start = time.perf_counter()
+        probabilities = self.scores(text)
+        best = int(np.argmax(probabilities))
+        action = self.actions[best]
+        confidence = float(probabilities[best])
+        latency = time.perf_counter() - start
+        used_fallback = confidence < self.threshold and self.fallback is not None
+        if used_fallback:
+            action = self.fallback(text)
+
+        with self._lock:
+            self.total_routed += 1
+            self.total_fallbacks += int(used_fallback)
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+        logger.info(
+            f"Routed request to {action.name} in {latency * 1000:.1f}ms "
+            f"(confidence {confidence:.2f}, fallback rate {self.fallback_rate:.1%})"
+        )
+        return {
+            "action": action.name,
+            "confidence": confidence,
+            "latency_ms": latency * 1000,
+            "fallback": used_fallback,
+        }
+
+    def stats(self) -> dict:
+        return {
+            "routed": self.total_routed,
+            "fallback_rate": self.fallback_rate,
+            "mean_latency_ms": self.mean_latency_ms,
+            "max_latency_ms": self.max_latency * 1000,
+        }
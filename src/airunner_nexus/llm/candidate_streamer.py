@@ -0,0 +1,64 @@
+from queue import Queue
+from typing import Optional
+
+from transformers.generation.streamers import BaseStreamer
+
+
+class CandidateStreamer(BaseStreamer):
+    """
+    Stream every sequence of a batched generate call separately.
+
+    Iterating yields (index, text) tuples, and (index, None) once a sequence
+    has produced its EOS token. The prompt is never streamed.
+    """
+    def __init__(self, tokenizer, num_candidates: int, timeout: Optional[float] = None):
+        self.tokenizer = tokenizer
+        self.num_candidates = num_candidates
+        self.timeout = timeout
+        self.token_ids = [[] for _ in range(num_candidates)]
+        self.printed = [0] * num_candidates
+        self.finished = [False] * num_candidates
+        self.queue = Queue()
+        self.next_tokens_are_prompt = True
+
+    def put(self, value):
+        if self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+        for index, token_id in enumerate(value.reshape(-1).tolist()):
+            if self.finished[index]:
+                continue
+            if token_id == self.tokenizer.eos_token_id:
+                self._finish(index)
+                continue
+            self.token_ids[index].append(token_id)
+            text = self.tokenizer.decode(self.token_ids[index], skip_special_tokens=True)
+            # Wait for the rest of a multibyte character
+            if text.endswith("�"):
+                continue
+            if len(text) > self.printed[index]:
+                self.queue.put((index, text[self.printed[index]:]), timeout=self.timeout)
+                self.printed[index] = len(text)
+
+    def _finish(self, index: int):
+        text = self.tokenizer.decode(self.token_ids[index], skip_special_tokens=True)
+        if len(text) > self.printed[index]:
+            self.queue.put((index, text[self.printed[index]:]), timeout=self.timeout)
+            self.printed[index] = len(text)
+        self.finished[index] = True
+        self.queue.put((index, None), timeout=self.timeout)
+
+    def end(self):
+        for index in range(self.num_candidates):
+            if not self.finished[index]:
+                self._finish(index)
+        self.queue.put(None, timeout=self.timeout)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        value = self.queue.get(timeout=self.timeout)
+        if value is None:
+            raise StopIteration()
+        return value
@@ -0,0 +1,192 @@
+"""
+Compiled decode loop for the PyTorch engine.
+
+model.generate grows its KV cache every step, so each token pays Python and
+kernel launch overhead which is a large share of decode time at batch size
+1. CompiledDecoder instead preallocates a static KV cache of max_cache_len
+tokens and decodes with a forward pass compiled by torch.compile, whose
+input shapes never change and which can be captured as a CUDA graph. It is
+warmed up when the model loads.
+
+Only plain generations of one sequence which fit in the cache use it, one at
+a time; everything else, such as sampled candidates continuing from a
+shared prefill, beams, or a generation while another holds the cache, runs
+eagerly. Per token latency of both paths is kept for comparison.
+"""
+import threading
+import time
+from collections import deque
+
+import torch
+from transformers import LogitsProcessorList, StoppingCriteriaList
+from transformers.generation.logits_process import MinLengthLogitsProcessor, RepetitionPenaltyLogitsProcessor, \
+    TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+
+from airunner_nexus import settings
+from airunner_nexus.logger import logger
+from airunner_nexus.scheduler import percentile
+
+try:
+    from transformers import StaticCache
+except ImportError:
+    StaticCache = None
+
+
+class CompiledDecoder:
+    def __init__(
+        self,
+        model,
+        max_cache_len: int = settings.COMPILED_MAX_CACHE_LEN,
+        mode: str = settings.COMPILE_MODE,
+        warmup_steps: int = settings.COMPILE_WARMUP_STEPS
+    ):
+        self.model = model
+        self.max_cache_len = max_cache_len
+        self.latency = {
+            "eager": deque(maxlen=settings.SCHEDULER_LATENCY_WINDOW),
+            "compiled": deque(maxlen=settings.SCHEDULER_LATENCY_WINDOW),
+        }
+        self._lock = threading.Lock()
+        self.cache = None
+        self.step = None
+        self.enabled = StaticCache is not None and getattr(model, "_supports_static_cache", False)
+        if not self.enabled:
+            logger.info(f"{type(model).__name__} does not support a static KV cache, decoding eagerly")
+            return
+        self.cache = StaticCache(
+            config=model.config,
+            max_batch_size=1,
+            max_cache_len=max_cache_len,
+            device=model.device,
+            dtype=model.dtype
+        )
+        self.step = torch.compile(self.forward, mode=mode, fullgraph=True)
+        try:
+            self.warm_up(warmup_steps)
+        except Exception as e:
+            logger.error(f"Compiling the decode step failed, decoding eagerly: {e}")
+            self.enabled = False
+            self.cache = None
+
+    def forward(self, input_ids: torch.Tensor, cache_position: torch.Tensor) -> torch.Tensor:
+        """Logits of the last position, with keys and values written to the static cache."""
+        logits = self.model(
+            input_ids=input_ids,
+            position_ids=cache_position.unsqueeze(0),
+            cache_position=cache_position,
+            past_key_values=self.cache,
+            use_cache=True,
+            return_dict=False
+        )[0]
+        return logits[:, -1, :]
+
+    def warm_up(self, steps: int):
+        """Compile the one decode shape, capturing it as a CUDA graph where there is one, before requests arrive."""
+        start = time.perf_counter()
+        with torch.no_grad():
+            self.reset()
+            token = torch.zeros((1, 1), dtype=torch.long, device=self.model.device)
+            self.forward(token, torch.arange(1, device=self.model.device))
+            for position in range(1, steps + 1):
+                self.step(token, torch.tensor([position], device=self.model.device))
+        self.reset()
+        logger.info(f"Compiled the decode step in {time.perf_counter() - start:.1f}s")
+
+    def reset(self):
+        for layer in self.cache.key_cache + self.cache.value_cache:
+            layer.zero_()
+
+    def can_handle(self, data: dict) -> bool:
+        input_ids = data["input_ids"]
+        return (
+            self.enabled
+            and input_ids.shape[0] == 1
+            and data.get("num_beams", 1) == 1
+            and data.get("num_return_sequences", 1) == 1
+            and data.get("past_key_values") is None
+            and input_ids.shape[1] + data.get("max_new_tokens", 1000) <= self.max_cache_len
+        )
+
+    def generate(self, data: dict) -> bool:
+        """
+        Run a generation with the compiled decode step if it can be.
+        :param data: model.generate keyword arguments, as LLMHandler builds them
+        :return: False if the generation was not run, and has to run eagerly
+        """
+        if not self.can_handle(data) or not self._lock.acquire(blocking=False):
+            return False
+        try:
+            with torch.no_grad():
+                start = time.perf_counter()
+                tokens = self.decode(data)
+            if tokens:
+                self.latency["compiled"].append((time.perf_counter() - start) / tokens)
+        finally:
+            self._lock.release()
+        return True
+
+    def decode(self, data: dict) -> int:
+        """:return: the number of tokens generated"""
+        input_ids = data["input_ids"]
+        device = input_ids.device
+        streamer = data.get("streamer")
+        eos_token_id = self.model.generation_config.eos_token_id
+        eos_token_ids = set(eos_token_id if isinstance(eos_token_id, list) else [eos_token_id])
+        processors = LogitsProcessorList(data.get("logits_processor") or [])
+        # Like model.generate, leave out processors and warpers whose settings disable them
+        if data.get("repetition_penalty") not in (None, 1.0):
+            processors.append(RepetitionPenaltyLogitsProcessor(data["repetition_penalty"]))
+        if (data.get("min_length") or 0) > 0 and eos_token_id is not None:
+            processors.append(MinLengthLogitsProcessor(data["min_length"], eos_token_id))
+        do_sample = data.get("do_sample", True)
+        if do_sample:
+            if data.get("temperature") not in (None, 1.0):
+                processors.append(TemperatureLogitsWarper(data["temperature"]))
+            if data.get("top_k"):
+                processors.append(TopKLogitsWarper(data["top_k"]))
+            if data.get("top_p") is not None and data["top_p"] < 1.0:
+                processors.append(TopPLogitsWarper(data["top_p"]))
+        stopping_criteria = StoppingCriteriaList(data.get("stopping_criteria") or [])
+
+        self.reset()
+        if streamer is not None:
+            streamer.put(input_ids.cpu())
+        # The prompt is prefilled eagerly, since its length varies
+        logits = self.forward(input_ids, torch.arange(input_ids.shape[1], device=device))
+        tokens = 0
+        try:
+            for _ in range(data.get("max_new_tokens", 1000)):
+                scores = processors(input_ids, logits.float())
+                if do_sample:
+                    next_token = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1)
+                else:
+                    next_token = torch.argmax(scores, dim=-1, keepdim=True)
+                input_ids = torch.cat([input_ids, next_token], dim=-1)
+                tokens += 1
+                if streamer is not None:
+                    streamer.put(next_token[0].cpu())
+                if next_token.item() in eos_token_ids or bool(torch.as_tensor(stopping_criteria(input_ids, scores)).any()):
+                    break
+                position = torch.tensor([input_ids.shape[1] - 1], device=device)
+                # The compiled graph's output is overwritten by the next call, so keep a copy
+                logits = self.step(next_token, position).clone()
+        finally:
+            if streamer is not None:
+                streamer.end()
+        return tokens
+
+    def record_eager(self, seconds: float, tokens: int):
+        if tokens:
+            self.latency["eager"].append(seconds / tokens)
+
+    def stats(self) -> dict:
+        """Per token latency, prefill included, of recent generations on each path."""
+        report = {"compiled_enabled": self.enabled, "max_cache_len": self.max_cache_len}
+        for path, values in self.latency.items():
+            values = list(values)
+            report[path] = {
+                "generations": len(values),
+                "ms_per_token_p50": round(percentile(values, 0.5) * 1000, 3) if values else None,
+                "ms_per_token_p99": round(percentile(values, 0.99) * 1000, 3) if values else None,
+            }
+        return report
@@ -0,0 +1,16 @@
+from transformers import StoppingCriteria
+
+
+class DecodeTurnStoppingCriteria(StoppingCriteria):
+    """
+    Never stops a generation. Between decode steps it hands the model to the
+    decode scheduler and waits until this generation's turn comes back.
+    """
+    def __init__(self, decode_scheduler, ticket):
+        super().__init__()
+        self.decode_scheduler = decode_scheduler
+        self.ticket = ticket
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.decode_scheduler.step(self.ticket)
+        return False
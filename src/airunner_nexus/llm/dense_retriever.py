@@ -0,0 +1,43 @@
+from typing import Dict, List, Optional
+
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+from airunner_nexus.llm.vector_index import VectorIndex
+
+
+class DenseRetriever(BaseRetriever):
+    """Retrieve nodes from a VectorIndex using the query embedding."""
+    def __init__(
+        self,
+        vector_index: VectorIndex,
+        embed_model,
+        similarity_top_k: int = 5,
+        filters: Optional[Dict[str, object]] = None
+    ):
+        super().__init__()
+        self.vector_index = vector_index
+        self.embed_model = embed_model
+        self.similarity_top_k = similarity_top_k
+        self.filters = filters
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        query_embedding = query_bundle.embedding
+        if query_embedding is None:
+            query_embedding = self.embed_model.get_query_embedding(query_bundle.query_str)
+        results = self.vector_index.search(
+            query_embedding,
+            top_k=self.similarity_top_k,
+            filters=self.filters
+        )
+        return [
+            NodeWithScore(
+                node=TextNode(
+                    text=result["text"],
+                    id_=f"{result['doc_id']}:{result['row']}",
+                    metadata=result["metadata"],
+                ),
+                score=result["score"]
+            )
+            for result in results
+        ]
@@ -0,0 +1,98 @@
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Generator, List, Optional, Tuple
+
+from llama_index.core import SimpleDirectoryReader
+from llama_index.core.node_parser import SentenceSplitter
+
+from airunner_nexus.logger import logger
+
+FileChunks = Tuple[str, Optional[List[str]], List[Tuple[str, dict, str]]]
+
+
+def extractor_classes(file_extractor: Optional[dict]) -> Optional[Dict[str, type]]:
+    """
+    Reader class of each extension, which can be sent to worker processes
+    where reader instances may not pickle. Workers build the readers with
+    their default arguments.
+    """
+    if not file_extractor:
+        return None
+    return {extension: type(reader) for extension, reader in file_extractor.items()}
+
+
+def load_file_chunks(
+    file_path: str,
+    chunk_size: int,
+    chunk_overlap: int,
+    extractors: Optional[Dict[str, type]] = None
+) -> FileChunks:
+    """
+    Read, parse and chunk a single file.
+
+    Runs inside a worker process.
+    :return: (file_path, document ids, [(text, metadata, document id), ...]),
+        with None for the document ids if the file could not be read
+    """
+    try:
+        documents = SimpleDirectoryReader(
+            input_files=[file_path],
+            file_extractor={extension: reader() for extension, reader in extractors.items()} if extractors else None,
+            exclude_hidden=False,
+            filename_as_id=True
+        ).load_data()
+    except ValueError as e:
+        logger.error(f"Error loading {file_path}: {str(e)}")
+        return file_path, None, []
+    splitter = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    nodes = splitter.get_nodes_from_documents(documents)
+    return (
+        file_path,
+        [document.doc_id for document in documents],
+        [(node.get_content(), node.metadata, node.ref_doc_id) for node in nodes]
+    )
+
+
+def iter_file_chunks(
+    files: List[str],
+    workers: Optional[int] = None,
+    chunk_size: int = 256,
+    chunk_overlap: int = 20,
+    max_pending: Optional[int] = None,
+    extractors: Optional[Dict[str, type]] = None
+) -> Generator[FileChunks, None, None]:
+    """
+    Chunk files in a process pool and yield each file's chunks as soon as it
+    has been processed. A file which fails is yielded with None for its
+    document ids instead of stopping the others.
+
+    At most max_pending files are in flight at once so memory use does not
+    grow with the number of files.
+    """
+    if not files:
+        return
+    workers = workers or multiprocessing.cpu_count()
+    max_pending = max_pending or workers * 2
+    files = iter(files)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        pending = {}
+        for file_path in files:
+            pending[executor.submit(load_file_chunks, file_path, chunk_size, chunk_overlap, extractors)] = file_path
+            if len(pending) >= max_pending:
+                break
+        while pending:
+            done, _not_done = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                file_path = pending.pop(future)
+                next_file = next(files, None)
+                if next_file is not None:
+                    pending[executor.submit(load_file_chunks, next_file, chunk_size, chunk_overlap, extractors)] = next_file
+                try:
+                    file_chunks = future.result()
+                except Exception as e:
+                    logger.error(f"Error chunking {file_path}: {e}")
+                    file_chunks = file_path, None, []
+                yield file_chunks
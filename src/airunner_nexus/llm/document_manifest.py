@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Tuple
+
+from airunner_nexus.logger import logger
+
+
+class DocumentManifest:
+    """
+    Tracks the files which have been added to a persisted document index.
+
+    Each entry stores the size, mtime and sha256 hash of a file along with the
+    ids of the documents which were created from it so that changed or deleted
+    files can be removed from the index without rebuilding it.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, dict] = {}
+        self.load()
+
+    @staticmethod
+    def file_hash(path: str, block_size: int = 1 << 20) -> str:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            self.entries = {}
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f).get("files", {})
+        except (OSError, json.decoder.JSONDecodeError) as err:
+            logger.error(f"Unable to read document manifest {self.path}: {err}")
+            self.entries = {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"files": self.entries}, f)
+        os.replace(tmp_path, self.path)
+
+    def diff(self, files: List[str]) -> Tuple[List[str], List[str], List[str]]:
+        """
+        Compare the given files against the manifest.
+
+        Files whose size and mtime are unchanged are not hashed.
+        :return: (added, changed, deleted) file paths
+        """
+        added = []
+        changed = []
+        seen = set()
+        for path in files:
+            path = os.path.abspath(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            seen.add(path)
+            entry = self.entries.get(path)
+            if entry is None:
+                added.append(path)
+                continue
+            if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                continue
+            if self.file_hash(path) != entry["hash"]:
+                changed.append(path)
+            else:
+                entry["mtime"] = stat.st_mtime
+        deleted = [path for path in self.entries if path not in seen]
+        return added, changed, deleted
+
+    def doc_ids(self, path: str) -> List[str]:
+        entry = self.entries.get(os.path.abspath(path))
+        return entry["doc_ids"] if entry else []
+
+    def update(self, path: str, doc_ids: List[str]):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        self.entries[path] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "hash": self.file_hash(path),
+            "doc_ids": doc_ids,
+        }
+
+    def remove(self, path: str):
+        self.entries.pop(os.path.abspath(path), None)
@@ -0,0 +1,124 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List
+
+import numpy as np
+
+from airunner_nexus import settings
+
+
+class PendingEmbeddings:
+    """Texts waiting for the next batch, and their vectors once it has run."""
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.vectors = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class EmbeddingBatcher:
+    """
+    Embed texts for many concurrent requests with as few model calls as
+    possible.
+
+    Texts which are not cached are queued; a background thread waits up to
+    window_ms after the first one for more to arrive, then embeds every
+    distinct text of the batch in one call. Results are kept in an LRU cache
+    so repeated inputs skip the model.
+    """
+    def __init__(
+        self,
+        embed: Callable[[List[str]], np.ndarray],
+        window_ms: float = settings.EMBED_BATCH_WINDOW_MS,
+        max_batch: int = settings.EMBED_MAX_BATCH,
+        cache_size: int = settings.EMBED_CACHE_SIZE
+    ):
+        self.embed_texts = embed
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.pending = queue.SimpleQueue()
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+        self.batched_texts = 0
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True, name="embedding batcher").start()
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Return L2 normalized float32 embeddings, one row per text."""
+        vectors = [None] * len(texts)
+        missing = []
+        with self._lock:
+            for index, text in enumerate(texts):
+                vector = self.cache.get(text)
+                if vector is None:
+                    missing.append(index)
+                    continue
+                self.cache.move_to_end(text)
+                vectors[index] = vector
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            request = PendingEmbeddings([texts[index] for index in missing])
+            self.pending.put(request)
+            request.done.wait()
+            if request.error is not None:
+                raise request.error
+            for index, vector in zip(missing, request.vectors):
+                vectors[index] = vector
+        if not vectors:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack(vectors)
+
+    def _collect(self) -> List[PendingEmbeddings]:
+        requests = [self.pending.get()]
+        total = len(requests[0].texts)
+        deadline = time.monotonic() + self.window
+        while total < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self.pending.get(timeout=remaining)
+            except queue.Empty:
+                break
+            requests.append(request)
+            total += len(request.texts)
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._collect()
+            texts = list(dict.fromkeys(text for request in requests for text in request.texts))
+            try:
+                vectors = dict(zip(texts, np.asarray(self.embed_texts(texts), dtype=np.float32)))
+            except Exception as e:
+                for request in requests:
+                    request.error = e
+                    request.done.set()
+                continue
+            with self._lock:
+                self.batches += 1
+                self.batched_texts += len(texts)
+                for text, vector in vectors.items():
+                    self.cache[text] = vector
+                    self.cache.move_to_end(text)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            for request in requests:
+                request.vectors = [vectors[text] for text in request.texts]
+                request.done.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "batches": self.batches,
+                "mean_batch_size": self.batched_texts / self.batches if self.batches else 0.0,
+                "cached": len(self.cache),
+            }
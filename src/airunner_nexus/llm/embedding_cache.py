@@ -0,0 +1,132 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from airunner_nexus import settings
+from airunner_nexus.logger import logger
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of embeddings keyed by the hash of the model name and the
+    text which was embedded.
+    """
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB)")
+        self.db.commit()
+
+    @staticmethod
+    def key(model_name: str, text: str) -> bytes:
+        return hashlib.sha256(f"{model_name}\x00{text}".encode("utf-8")).digest()
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                for key, vector in self.db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ):
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+        return found
+
+    def put_many(self, items: Dict[bytes, np.ndarray]):
+        with self._lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items.items()]
+            )
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class EmbeddingStats:
+    def __init__(self):
+        self.requested = 0
+        self.cache_hits = 0
+        self.embedded = 0
+        self.embed_seconds = 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.cache_hits / self.requested if self.requested else 0.0
+
+    @property
+    def embeddings_per_second(self) -> float:
+        return self.embedded / self.embed_seconds if self.embed_seconds else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "requested": self.requested,
+            "cache_hits": self.cache_hits,
+            "embedded": self.embedded,
+            "hit_rate": self.hit_rate,
+            "embeddings_per_second": self.embeddings_per_second,
+        }
+
+
+class BatchEmbedder:
+    """
+    Embed texts in length-sorted batches, skipping texts which are already in
+    the embedding cache.
+    """
+    def __init__(
+        self,
+        embed_model,
+        model_name: str,
+        cache: EmbeddingCache = None,
+        batch_size: int = settings.RAG_EMBED_BATCH_SIZE
+    ):
+        self.embed_model = embed_model
+        self.model_name = model_name
+        self.cache = cache
+        self.batch_size = batch_size
+        self.stats = EmbeddingStats()
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Return one embedding row per text, in the order the texts were given."""
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        keys = [EmbeddingCache.key(self.model_name, text) for text in texts]
+        cached = self.cache.get_many(keys) if self.cache else {}
+        vectors = [cached.get(key) for key in keys]
+        misses = sorted(
+            (i for i, vector in enumerate(vectors) if vector is None),
+            key=lambda i: len(texts[i]),
+            reverse=True
+        )
+
+        embedded = {}
+        start_time = time.perf_counter()
+        for start in range(0, len(misses), self.batch_size):
+            batch = misses[start:start + self.batch_size]
+            results = self.embed_model.get_text_embedding_batch([texts[i] for i in batch])
+            for i, vector in zip(batch, results):
+                vectors[i] = np.asarray(vector, dtype=np.float32)
+                embedded[keys[i]] = vectors[i]
+        elapsed = time.perf_counter() - start_time
+        if self.cache and embedded:
+            self.cache.put_many(embedded)
+
+        self.stats.requested += len(texts)
+        self.stats.cache_hits += len(texts) - len(misses)
+        self.stats.embedded += len(misses)
+        self.stats.embed_seconds += elapsed
+        logger.info(
+            f"Embedded {len(misses)} of {len(texts)} chunks "
+            f"({len(misses) / elapsed if elapsed else 0.0:.1f} embeddings/sec, "
+            f"cache hit rate {self.stats.hit_rate:.1%})"
+        )
+        return np.stack(vectors)
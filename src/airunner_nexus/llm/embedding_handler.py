@@ -0,0 +1,28 @@
+import os
+from typing import List
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+from airunner_nexus import settings
+
+
+class EmbeddingHandler:
+    """Small sentence embedding model used for routing and scoring on the CPU."""
+    def __init__(self, model_path: str = settings.EMBEDDING_MODEL_PATH, device: str = settings.EMBEDDING_DEVICE):
+        self.model_path = os.path.expanduser(model_path)
+        self.device = device
+        self.model = self.load_model()
+
+    def load_model(self) -> SentenceTransformer:
+        return SentenceTransformer(self.model_path, device=self.device)
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Return L2 normalized float32 embeddings, one row per text."""
+        return self.model.encode(
+            texts,
+            batch_size=len(texts) or 1,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        ).astype(np.float32)
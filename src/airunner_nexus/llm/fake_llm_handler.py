@@ -0,0 +1,72 @@
+import time
+
+from airunner_nexus import settings
+from airunner_nexus.enums import LLMActionType
+from airunner_nexus.scheduler import request_priority
+from airunner_nexus.tracing import span
+
+
+class FakeLLMHandler:
+    """
+    Stand-in for LLMHandler which streams a canned reply without loading a
+    model, for testing servers, gateways and clients on machines without a GPU.
+
+    The reply echoes the prompt word by word with a fixed delay per token and
+    honours max_new_tokens and num_return_sequences.
+    """
+    def __init__(self, model_name: str = settings.DEFAULT_MODEL_NAME, token_delay: float = settings.FAKE_TOKEN_DELAY):
+        self.model_name = model_name
+        self.token_delay = token_delay
+        self._do_interrupt_process = False
+        self.decode_scheduler = None
+
+    def resume(self):
+        self._do_interrupt_process = False
+
+    def interrupt(self):
+        self._do_interrupt_process = True
+
+    def reply_tokens(self, data: dict) -> list:
+        words = f"You said: {data.get('prompt', '')}".split()
+        tokens = [word if index == 0 else f" {word}" for index, word in enumerate(words)]
+        return tokens[:data.get("max_new_tokens", 1000)]
+
+    def decode(self, data: dict):
+        """Yield the reply's tokens, taking turns with other generations like LLMHandler does."""
+        ticket = None
+        if self.decode_scheduler is not None:
+            ticket = self.decode_scheduler.ticket(request_priority(data))
+            self.decode_scheduler.start(ticket)
+        try:
+            for token in self.reply_tokens(data):
+                if self._do_interrupt_process:
+                    break
+                time.sleep(self.token_delay)
+                if ticket is not None:
+                    self.decode_scheduler.step(ticket)
+                yield token
+        finally:
+            if ticket is not None:
+                self.decode_scheduler.finish(ticket)
+
+    def query_model(self, data: dict):
+        self.resume()
+        with span("generate"):
+            yield from self.decode(data)
+
+    def query_model_candidates(self, data: dict):
+        self.resume()
+        num_candidates = data.get("num_return_sequences", 1)
+        for token in self.decode(data):
+            for index in range(num_candidates):
+                yield index, token
+        for index in range(num_candidates):
+            yield index, None
+
+    def query_model_batch(self, requests: list) -> list:
+        replies = [self.reply_tokens(data) for data in requests]
+        time.sleep(self.token_delay * max(len(tokens) for tokens in replies))
+        return [("".join(tokens), len(tokens)) for tokens in replies]
+
+    def classify_action(self, text: str) -> LLMActionType:
+        return LLMActionType.CHAT
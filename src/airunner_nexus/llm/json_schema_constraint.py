@@ -0,0 +1,482 @@
+"""
+Constrain generation to JSON which matches a schema.
+
+Supports the subset of JSON schema which is useful for generation: type
+(including lists of types), properties, required, additionalProperties,
+items, minItems, maxItems, enum, const and maxLength. Anything else is
+treated as an unconstrained JSON value.
+
+Run this module to check the acceptor against sample schemas:
+
+    python -m airunner_nexus.llm.json_schema_constraint
+
+Unlike JSON schema, an object with properties is closed unless its
+additionalProperties is true or a schema: a model left free to add keys
+tends to invent them, which is rarely what a caller listing properties
+wants.
+"""
+import json
+import re
+from typing import List, Optional
+
+import torch
+from transformers import LogitsProcessor, StoppingCriteria
+
+from airunner_nexus import settings
+
+WHITESPACE = " \t\n\r"
+NUMBER_CHARS = "-+.eE0123456789"
+NUMBER_PREFIX = re.compile(r"-?(0|[1-9]\d*)?$|-?(0|[1-9]\d*)\.\d*$|-?(0|[1-9]\d*)(\.\d+)?[eE][+-]?\d*$")
+INTEGER_PREFIX = re.compile(r"-?(0|[1-9]\d*)?$")
+NUMBER_COMPLETE = re.compile(r"-?(0|[1-9]\d*)(\.\d+)?([eE][+-]?\d+)?$")
+BYTE_TOKEN = re.compile(r"<0x([0-9A-Fa-f]{2})>$")
+ALL_TYPES = ("object", "array", "string", "number", "integer", "boolean", "null")
+MAX_WHITESPACE_RUN = 32
+MAX_NUMBER_LENGTH = 32
+
+
+def allowed_types(schema: dict) -> tuple:
+    if "const" in schema:
+        schema = dict(schema, enum=[schema["const"]])
+    if "enum" in schema:
+        types = set()
+        for value in schema["enum"]:
+            if isinstance(value, bool):
+                types.add("boolean")
+            elif value is None:
+                types.add("null")
+            elif isinstance(value, (int, float)):
+                types.add("number")
+            elif isinstance(value, str):
+                types.add("string")
+            elif isinstance(value, list):
+                types.add("array")
+            elif isinstance(value, dict):
+                types.add("object")
+        return tuple(types)
+    schema_type = schema.get("type")
+    if schema_type is None:
+        return ALL_TYPES
+    return (schema_type,) if isinstance(schema_type, str) else tuple(schema_type)
+
+
+def enum_values(schema: dict) -> Optional[list]:
+    if "const" in schema:
+        return [schema["const"]]
+    return schema.get("enum")
+
+
+class JsonSchemaAcceptor:
+    """
+    Character level pushdown acceptor for JSON matching a schema.
+
+    The state is a stack of small dicts holding only immutable values so a
+    clone is a shallow copy of each frame.
+    """
+    def __init__(self, schema: dict):
+        self.stack = [{"kind": "value", "schema": schema or {}}]
+        self.done = False
+        self.whitespace_run = 0
+
+    def clone(self) -> "JsonSchemaAcceptor":
+        acceptor = JsonSchemaAcceptor.__new__(JsonSchemaAcceptor)
+        acceptor.stack = [dict(frame) for frame in self.stack]
+        acceptor.done = self.done
+        acceptor.whitespace_run = self.whitespace_run
+        return acceptor
+
+    @property
+    def is_complete(self) -> bool:
+        """True once the root value has closed."""
+        return self.done
+
+    @property
+    def can_end(self) -> bool:
+        """
+        True if the output may end here: once the root value has closed, or
+        in a root number, which only whitespace or the end of the output ends.
+        """
+        if self.done:
+            return True
+        return (
+            len(self.stack) == 1
+            and self.stack[0]["kind"] == "number"
+            and NUMBER_COMPLETE.match(self.stack[0]["text"]) is not None
+        )
+
+    def feed_text(self, text: str) -> bool:
+        for char in text:
+            if not self.feed(char):
+                return False
+        return True
+
+    def accepts(self, text: str) -> bool:
+        """Return True if text could be appended without leaving the grammar."""
+        return self.clone().feed_text(text)
+
+    def feed(self, char: str) -> bool:
+        if self.done:
+            return False
+        frame = self.stack[-1]
+        if frame["kind"] in ("value", "object", "array") and char in WHITESPACE:
+            if not (frame["kind"] == "object" and frame["state"] == "key"):
+                self.whitespace_run += 1
+                return self.whitespace_run <= MAX_WHITESPACE_RUN
+        self.whitespace_run = 0
+        return getattr(self, "_feed_" + frame["kind"])(frame, char)
+
+    def _pop(self):
+        self.stack.pop()
+        if not self.stack:
+            self.done = True
+            return
+        parent = self.stack[-1]
+        parent["state"] = "comma_or_end"
+        if parent["kind"] == "array":
+            parent["count"] += 1
+
+    def _push_value(self, schema: dict):
+        self.stack.append({"kind": "value", "schema": schema})
+
+    def _feed_value(self, frame: dict, char: str) -> bool:
+        schema = frame["schema"]
+        types = allowed_types(schema)
+        enum = enum_values(schema)
+        if char == "{" and "object" in types:
+            properties = schema.get("properties")
+            # Closed by default when properties are listed, see the module docstring
+            closed = properties is not None and schema.get("additionalProperties", False) is False
+            self.stack[-1] = {
+                "kind": "object",
+                "schema": schema,
+                "state": "key_or_end",
+                "seen": (),
+                "key": "",
+                "closed": closed,
+                "escape": False,
+            }
+            return True
+        if char == "[" and "array" in types:
+            self.stack[-1] = {"kind": "array", "schema": schema, "state": "value_or_end", "count": 0}
+            return True
+        if char == '"' and "string" in types:
+            strings = None
+            if enum is not None:
+                strings = tuple(json.dumps(value)[1:-1] for value in enum if isinstance(value, str))
+            self.stack[-1] = {
+                "kind": "string",
+                "enum": strings,
+                "max_length": schema.get("maxLength"),
+                "text": "",
+                "length": 0,
+                "escape": False,
+                "unicode": 0,
+            }
+            return True
+        if char in "-0123456789" and ("number" in types or "integer" in types):
+            self.stack[-1] = {"kind": "number", "text": char, "integer": "number" not in types}
+            return True
+        if char in "tfn":
+            options = []
+            for literal, value, literal_type in (("true", True, "boolean"), ("false", False, "boolean"), ("null", None, "null")):
+                if literal[0] != char or literal_type not in types:
+                    continue
+                if enum is not None and not any(item is value for item in enum):
+                    continue
+                options.append(literal)
+            if options:
+                self.stack[-1] = {"kind": "literal", "options": tuple(options), "text": char}
+                return True
+        return False
+
+    @staticmethod
+    def _remaining_keys(frame: dict) -> list:
+        properties = frame["schema"].get("properties") or {}
+        return [key for key in properties if key not in frame["seen"]]
+
+    def _can_close_object(self, frame: dict) -> bool:
+        return all(key in frame["seen"] for key in frame["schema"].get("required", []))
+
+    def _feed_object(self, frame: dict, char: str) -> bool:
+        state = frame["state"]
+        if state in ("key_or_end", "key_start"):
+            if char == '"':
+                if frame["closed"] and not self._remaining_keys(frame):
+                    return False
+                frame["state"] = "key"
+                frame["key"] = ""
+                return True
+            if char == "}" and state == "key_or_end" and self._can_close_object(frame):
+                self._pop()
+                return True
+            return False
+        if state == "key":
+            return self._feed_key(frame, char)
+        if state == "colon":
+            if char != ":":
+                return False
+            schema = frame["schema"]
+            properties = schema.get("properties") or {}
+            key_schema = properties.get(frame["key"])
+            if key_schema is None:
+                additional = schema.get("additionalProperties", {})
+                key_schema = additional if isinstance(additional, dict) else {}
+            frame["state"] = "value"
+            self._push_value(key_schema)
+            return True
+        if state == "comma_or_end":
+            if char == ",":
+                if frame["closed"] and not self._remaining_keys(frame):
+                    return False
+                frame["state"] = "key_start"
+                return True
+            if char == "}" and self._can_close_object(frame):
+                self._pop()
+                return True
+        return False
+
+    def _feed_key(self, frame: dict, char: str) -> bool:
+        key = frame["key"]
+        if frame["escape"]:
+            frame["escape"] = False
+            frame["key"] = key + char
+            return True
+        if char == '"':
+            if key in frame["seen"]:
+                return False
+            if frame["closed"] and key not in self._remaining_keys(frame):
+                return False
+            frame["seen"] = frame["seen"] + (key,)
+            frame["state"] = "colon"
+            return True
+        if ord(char) < 0x20:
+            return False
+        if frame["closed"]:
+            key += char
+            if not any(remaining.startswith(key) for remaining in self._remaining_keys(frame)):
+                return False
+        elif char == "\\":
+            frame["escape"] = True
+            key += char
+        else:
+            key += char
+        frame["key"] = key
+        return True
+
+    def _feed_array(self, frame: dict, char: str) -> bool:
+        schema = frame["schema"]
+        state = frame["state"]
+        if state in ("value_or_end", "value_start"):
+            if char == "]" and state == "value_or_end" and frame["count"] >= schema.get("minItems", 0):
+                self._pop()
+                return True
+            if schema.get("maxItems") is not None and frame["count"] >= schema["maxItems"]:
+                return False
+            frame["state"] = "value"
+            items = schema.get("items")
+            self._push_value(items if isinstance(items, dict) else {})
+            return self.feed(char)
+        if state == "comma_or_end":
+            if char == "," and (schema.get("maxItems") is None or frame["count"] < schema["maxItems"]):
+                frame["state"] = "value_start"
+                return True
+            if char == "]" and frame["count"] >= schema.get("minItems", 0):
+                self._pop()
+                return True
+        return False
+
+    def _feed_string(self, frame: dict, char: str) -> bool:
+        text = frame["text"]
+        if frame["unicode"]:
+            if char not in "0123456789abcdefABCDEF":
+                return False
+            frame["unicode"] -= 1
+        elif frame["escape"]:
+            if char not in '"\\/bfnrtu':
+                return False
+            frame["escape"] = False
+            frame["unicode"] = 4 if char == "u" else 0
+        elif char == '"':
+            if frame["enum"] is not None and text not in frame["enum"]:
+                return False
+            self._pop()
+            return True
+        elif char == "\\":
+            frame["escape"] = True
+            frame["length"] += 1
+        elif ord(char) < 0x20:
+            return False
+        else:
+            frame["length"] += 1
+        if frame["max_length"] is not None and frame["length"] > frame["max_length"]:
+            return False
+        text += char
+        if frame["enum"] is not None and not any(value.startswith(text) for value in frame["enum"]):
+            return False
+        frame["text"] = text
+        return True
+
+    def _feed_number(self, frame: dict, char: str) -> bool:
+        text = frame["text"] + char
+        pattern = INTEGER_PREFIX if frame["integer"] else NUMBER_PREFIX
+        if char in NUMBER_CHARS and len(text) <= MAX_NUMBER_LENGTH and pattern.match(text):
+            frame["text"] = text
+            return True
+        if NUMBER_COMPLETE.match(frame["text"]) is None:
+            return False
+        if len(self.stack) == 1:
+            if char not in WHITESPACE:
+                return False
+            self._pop()
+            return True
+        self._pop()
+        return self.feed(char)
+
+    def _feed_literal(self, frame: dict, char: str) -> bool:
+        text = frame["text"] + char
+        if not any(option.startswith(text) for option in frame["options"]):
+            return False
+        frame["text"] = text
+        if text in frame["options"]:
+            self._pop()
+        return True
+
+
+def token_texts(tokenizer) -> List[Optional[str]]:
+    """
+    Text each vocabulary entry adds to a decoded sequence, or None for
+    special tokens and partial UTF-8 byte tokens which are never allowed.
+    """
+    special_ids = set(tokenizer.all_special_ids)
+    texts = []
+    for token_id, token in enumerate(tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))):
+        if token is None or token_id in special_ids:
+            texts.append(None)
+            continue
+        byte_token = BYTE_TOKEN.match(token)
+        if byte_token:
+            value = int(byte_token.group(1), 16)
+            texts.append(chr(value) if value < 0x80 else None)
+        elif "▁" in token:
+            texts.append(token.replace("▁", " "))
+        else:
+            texts.append(tokenizer.convert_tokens_to_string([token]))
+    return texts
+
+
+class JsonSchemaConstraint:
+    """Tracks one acceptor per sequence in the batch, fed with every generated token."""
+    def __init__(self, schema: dict, tokenizer, vocabulary: List[Optional[str]]):
+        self.schema = schema
+        self.eos_token_id = tokenizer.eos_token_id
+        self.vocabulary = vocabulary
+        self.prompt_length = None
+        self.acceptors = []
+        self.consumed = []
+
+    def sync(self, input_ids: torch.LongTensor):
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1]
+            self.acceptors = [JsonSchemaAcceptor(self.schema) for _ in range(input_ids.shape[0])]
+            self.consumed = [self.prompt_length] * input_ids.shape[0]
+        for row, acceptor in enumerate(self.acceptors):
+            for token_id in input_ids[row, self.consumed[row]:].tolist():
+                text = self.vocabulary[token_id] if token_id < len(self.vocabulary) else None
+                if text is not None:
+                    acceptor.feed_text(text)
+            self.consumed[row] = input_ids.shape[1]
+
+    @property
+    def is_complete(self) -> bool:
+        return bool(self.acceptors) and all(acceptor.is_complete for acceptor in self.acceptors)
+
+
+class JsonSchemaLogitsProcessor(LogitsProcessor):
+    """
+    Mask every token which would take the output outside of the schema.
+
+    Candidates are tested in order of their logits and only the first
+    keep_top_k valid tokens are left unmasked, so the cost per step depends on
+    how many high scoring tokens are invalid rather than on the vocabulary size.
+    """
+    def __init__(
+        self,
+        constraint: JsonSchemaConstraint,
+        keep_top_k: int = settings.JSON_CONSTRAINT_TOP_K,
+        max_candidates: int = settings.JSON_CONSTRAINT_MAX_CANDIDATES
+    ):
+        self.constraint = constraint
+        self.keep_top_k = keep_top_k
+        self.max_candidates = max_candidates
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        self.constraint.sync(input_ids)
+        mask = torch.full_like(scores, float("-inf"))
+        vocabulary = self.constraint.vocabulary
+        for row, acceptor in enumerate(self.constraint.acceptors):
+            if acceptor.is_complete:
+                mask[row, self.constraint.eos_token_id] = 0
+                continue
+            allowed = self._allowed_tokens(acceptor, torch.argsort(scores[row], descending=True)[:self.max_candidates].tolist())
+            if not allowed:
+                allowed = self._allowed_tokens(acceptor, range(len(vocabulary)))
+            if not allowed or acceptor.can_end:
+                allowed.append(self.constraint.eos_token_id)
+            mask[row, allowed] = 0
+        return scores + mask
+
+    def _allowed_tokens(self, acceptor: JsonSchemaAcceptor, candidates) -> list:
+        vocabulary = self.constraint.vocabulary
+        allowed = []
+        for token_id in candidates:
+            text = vocabulary[token_id] if token_id < len(vocabulary) else None
+            if text and acceptor.accepts(text):
+                allowed.append(token_id)
+                if len(allowed) >= self.keep_top_k:
+                    break
+        return allowed
+
+
+class JsonCompleteStoppingCriteria(StoppingCriteria):
+    """Stop as soon as every sequence holds a complete JSON value."""
+    def __init__(self, constraint: JsonSchemaConstraint):
+        super().__init__()
+        self.constraint = constraint
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.constraint.sync(input_ids)
+        return self.constraint.is_complete
+
+
+def self_check():
+    """Feed sample outputs through the acceptor, one character at a time and with lookahead."""
+    cases = [
+        ({"type": "object"}, '{"a": 1, "b": [true, null], "c": {"d": "e"}}'),
+        ({"type": "object", "properties": {"action": {"enum": ["CHAT", "SEARCH"]}}}, '{"action": "CHAT"}'),
+        (
+            {"type": "object", "properties": {"a": {"type": "integer"}, "b": {"type": "string"}}, "required": ["a"]},
+            '{"a": 12, "b": "x"}'
+        ),
+        ({"type": "array", "items": {"type": "integer"}, "maxItems": 2}, "[1, 2]"),
+        ({"type": "integer"}, "123 "),
+    ]
+    for schema, text in cases:
+        acceptor = JsonSchemaAcceptor(schema)
+        for index, char in enumerate(text):
+            for candidate in (",", "}", "]", ":", '"', " "):
+                acceptor.accepts(candidate)
+            assert acceptor.accepts(text[index:]), f"{text[index:]!r} rejected after {text[:index]!r}"
+            assert acceptor.feed(char), f"{char!r} rejected after {text[:index]!r}"
+        assert acceptor.is_complete, f"{text!r} is not complete"
+    rejected = [
+        ({"type": "object", "properties": {"action": {"enum": ["CHAT"]}}}, '{"action": "CHAT",'),
+        ({"type": "array", "maxItems": 2}, "[1, 2,"),
+        ({"type": "integer"}, "1.5"),
+    ]
+    for schema, text in rejected:
+        assert not JsonSchemaAcceptor(schema).feed_text(text), f"{text!r} accepted for {schema}"
+    print(f"{len(cases) + len(rejected)} schema checks passed")
+
+
+if __name__ == '__main__':
+    self_check()
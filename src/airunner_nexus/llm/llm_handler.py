@@ -1,22 +1,54 @@
+import contextvars
+import json
 import os
+import time
 import torch
 import threading
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, LogitsProcessorList
 from transformers.generation.streamers import TextIteratorStreamer
 from airunner_nexus import settings
+from airunner_nexus.enums import LLMActionType
+from airunner_nexus.exceptions import GenerationError
+from airunner_nexus.llm.candidate_streamer import CandidateStreamer
+from airunner_nexus.llm.compiled_decoder import CompiledDecoder
+from airunner_nexus.llm.decode_turn_stopping_criteria import DecodeTurnStoppingCriteria
 from airunner_nexus.llm.external_condition_stopping_criteria import ExternalConditionStoppingCriteria
+from airunner_nexus.llm.memory_budget import MemoryBudget
+from airunner_nexus.llm.json_schema_constraint import JsonCompleteStoppingCriteria, JsonSchemaConstraint, \
+    JsonSchemaLogitsProcessor, token_texts
+from airunner_nexus.llm.stop_sequences import StopSequenceMatcher, StopSequenceStoppingCriteria
+from airunner_nexus.scheduler import request_priority
+from airunner_nexus.logger import logger
 from airunner_nexus.settings import MODEL_BASE_PATH, MODELS
+from airunner_nexus.tracing import current_trace, span, torch_profile
 
 class LLMHandler:
-    def __init__(self, model_name: str = settings.DEFAULT_MODEL_NAME):
+    def __init__(self, model_name: str = settings.DEFAULT_MODEL_NAME, memory_share: float = 1.0):
+        """
+        :param memory_share: fraction of the device's free memory this handler
+            may budget, when processes share it
+        """
         self.model_name = model_name
         self.model_path = os.path.join(os.path.expanduser(MODEL_BASE_PATH), MODELS[self.model_name]["path"])
         self.model = self.load_model()
+        # Allocated before the budget is taken, so its static cache is not counted as free memory
+        self.compiled_decoder = CompiledDecoder(self.model) if settings.COMPILED_DECODE else None
+        self.memory_budget = MemoryBudget.for_model(self.model, self.device, memory_share)
         self.tokenizer = self.load_tokenizer()
         self.streamer = self.load_streamer()
         self.generate_thread = threading.Thread(target=self.generate)
         self.generate_data = None
         self._do_interrupt_process = False
+        self._vocabulary = None
+        # Set by the server to interleave concurrent generations step by step
+        self.decode_scheduler = None
+
+    @property
+    def vocabulary(self) -> list:
+        """Text of every token, used to check tokens against a grammar."""
+        if self._vocabulary is None:
+            self._vocabulary = token_texts(self.tokenizer)
+        return self._vocabulary
 
     @property
     def quantized_model_path(self) -> str:
@@ -68,46 +100,327 @@ class LLMHandler:
             {"role": "system", "content": data.get("instructions", "")},
             {"role": "user", "content": data.get("prompt", "")},
         ])
-        rendered_template = self.rendered_template(conversation)
-        model_inputs = self.tokenizer(rendered_template, return_tensors="pt").to(self.device)
-        stopping_criteria = ExternalConditionStoppingCriteria(self._do_interrupt_process)
-        self.generate_data = dict(
-            model_inputs,
-            max_new_tokens=data.get("max_new_tokens", 1000),
-            min_length=data.get("min_length", 0),
-            do_sample=data.get("do_sample", True),
-            early_stopping=data.get("early_stopping", True),
-            num_beams=data.get("num_beams", 1),
-            temperature=data.get("temperature", 0.9),
-            top_p=data.get("top_p", 0.9),
-            top_k=data.get("top_k", 50),
-            repetition_penalty=data.get("repetition_penalty", 1.0),
-            num_return_sequences=data.get("num_return_sequences", 1),
-            decoder_start_token_id=data.get("decoder_start_token_id", None),
-            use_cache=data.get("use_cache", True),
-            length_penalty=data.get("length_penalty", 1.0),
-            stopping_criteria=[stopping_criteria],
-            streamer=self.streamer
-        )
+        with span("rendered_template"):
+            rendered_template = self.rendered_template(conversation)
+        with span("tokenize"):
+            model_inputs = self.tokenizer(rendered_template, return_tensors="pt").to(self.device)
+        stopping_criteria, logits_processor, stop_strings, stop_token_ids = self.generation_controls(data)
+        # Every beam, or every returned sample, keeps its own KV cache
+        sequences = max(data.get("num_beams", 1), data.get("num_return_sequences", 1))
+        reservation = self.admit(data, model_inputs["input_ids"].shape[1], sequences)
+        # Until the generate thread owns the reservation, release it here if anything fails
+        try:
+            ticket = self.decode_ticket(data, stopping_criteria)
+            streamer = self.load_streamer()
+            self.streamer = streamer
+            self.generate_data = dict(
+                model_inputs,
+                max_new_tokens=reservation.max_new_tokens,
+                min_length=data.get("min_length", 0),
+                do_sample=data.get("do_sample", True),
+                early_stopping=data.get("early_stopping", True),
+                num_beams=data.get("num_beams", 1),
+                temperature=data.get("temperature", 0.9),
+                top_p=data.get("top_p", 0.9),
+                top_k=data.get("top_k", 50),
+                repetition_penalty=data.get("repetition_penalty", 1.0),
+                num_return_sequences=data.get("num_return_sequences", 1),
+                decoder_start_token_id=data.get("decoder_start_token_id", None),
+                use_cache=data.get("use_cache", True),
+                length_penalty=data.get("length_penalty", 1.0),
+                stopping_criteria=stopping_criteria,
+                logits_processor=logits_processor,
+                streamer=streamer
+            )
 
-        if self.generate_thread.is_alive():
-            self.generate_thread.join()
+            if ticket is None and self.generate_thread.is_alive():
+                self.generate_thread.join()
 
-        self.generate_thread = threading.Thread(target=self.generate, args=(self.generate_data,))
-        self.generate_thread.start()
+            # Run in a copy of this thread's context so the generate thread logs with the same request id
+            self.generate_thread = threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(self.generate, self.generate_data, ticket, reservation)
+            )
+            self.generate_thread.start()
+        except Exception:
+            reservation.release()
+            raise
+        generate_started_at = time.monotonic()
+        first_token_at = None
 
         rendered_template = self.update_rendered_template(rendered_template)
         streamed_template = ""
         replaced = False
+        # Hold back anything which may be the start of a stop string, including stop tokens' text
+        stop_matcher = StopSequenceMatcher(
+            stop_strings + [self.tokenizer.decode([token_id]) for token_id in stop_token_ids]
+        )
 
-        for new_text in self.streamer:
+        for new_text in streamer:
             if not replaced:
                 replaced, streamed_template = self.update_streamed_template(rendered_template, streamed_template, new_text)
+                if replaced:
+                    first_token_at = time.monotonic()
             if replaced:
-                yield self.strip_tags(new_text)
+                text, stopped = stop_matcher.push(self.strip_tags(new_text))
+                if text:
+                    yield text
+                if stopped:
+                    break
+        self.raise_generation_error(streamer)
+        text = stop_matcher.flush()
+        if text:
+            yield text
+        trace = current_trace.get()
+        if trace is not None and first_token_at is not None:
+            # Prefill lasts until the first generated token is streamed, decode until the last
+            trace.add("prefill", generate_started_at, first_token_at)
+            trace.add("decode", first_token_at, time.monotonic())
+
+    def generation_controls(self, data: dict) -> tuple:
+        """:return: (stopping criteria, logits processors, stop strings, stop token ids) for a request"""
+        stopping_criteria = [ExternalConditionStoppingCriteria(lambda: self._do_interrupt_process)]
+        stop_strings = data.get("stop") or []
+        if isinstance(stop_strings, str):
+            stop_strings = [stop_strings]
+        stop_token_ids = data.get("stop_token_ids") or []
+        if stop_strings or stop_token_ids:
+            stopping_criteria.append(StopSequenceStoppingCriteria(self.tokenizer, stop_strings, stop_token_ids))
+        logits_processor = LogitsProcessorList()
+        if data.get("json_schema") is not None:
+            constraint = JsonSchemaConstraint(data["json_schema"], self.tokenizer, self.vocabulary)
+            logits_processor.append(JsonSchemaLogitsProcessor(constraint))
+            stopping_criteria.append(JsonCompleteStoppingCriteria(constraint))
+        return stopping_criteria, logits_processor, stop_strings, stop_token_ids
+
+    def query_model_candidates(self, data: dict):
+        """
+        Sample num_return_sequences candidates for one prompt.
+
+        The prompt is prefilled once and its KV cache is copied to every
+        candidate, which are then decoded together as a batch.
+        Yields (candidate index, text), and (candidate index, None) when a
+        candidate is finished.
+        """
+        self.resume()
+        num_candidates = data.get("num_return_sequences", 1)
+        conversation = data.get("conversation", [
+            {"role": "system", "content": data.get("instructions", "")},
+            {"role": "user", "content": data.get("prompt", "")},
+        ])
+        model_inputs = self.tokenizer(self.rendered_template(conversation), return_tensors="pt").to(self.device)
+        input_ids = model_inputs["input_ids"]
+        stopping_criteria, logits_processor, stop_strings, stop_token_ids = self.generation_controls(data)
+        reservation = self.admit(data, input_ids.shape[1], num_candidates)
+        ticket = self.decode_ticket(data, stopping_criteria)
+        if ticket is not None:
+            self.decode_scheduler.start(ticket)
+        try:
+            with torch.no_grad():
+                prefill = self.model(input_ids=input_ids[:, :-1], use_cache=True)
+            streamer = CandidateStreamer(self.tokenizer, num_candidates)
+            generate_data = dict(
+                input_ids=input_ids.repeat(num_candidates, 1),
+                attention_mask=model_inputs["attention_mask"].repeat(num_candidates, 1),
+                past_key_values=self.fork_cache(prefill.past_key_values, num_candidates),
+                max_new_tokens=reservation.max_new_tokens,
+                min_length=data.get("min_length", 0),
+                do_sample=True,
+                temperature=data.get("temperature", 0.9),
+                top_p=data.get("top_p", 0.9),
+                top_k=data.get("top_k", 50),
+                repetition_penalty=data.get("repetition_penalty", 1.0),
+                use_cache=True,
+                stopping_criteria=stopping_criteria,
+                logits_processor=logits_processor,
+                streamer=streamer
+            )
+
+            if ticket is None and self.generate_thread.is_alive():
+                self.generate_thread.join()
+
+            self.generate_thread = threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(self.generate, generate_data, ticket, reservation)
+            )
+            self.generate_thread.start()
+        except Exception:
+            if ticket is not None:
+                self.decode_scheduler.finish(ticket)
+            reservation.release()
+            raise
+
+        stop_matchers = [
+            StopSequenceMatcher(stop_strings + [self.tokenizer.decode([token_id]) for token_id in stop_token_ids])
+            for _ in range(num_candidates)
+        ]
+        for index, new_text in streamer:
+            stop_matcher = stop_matchers[index]
+            if new_text is None:
+                text = stop_matcher.flush()
+                if text:
+                    yield index, text
+                yield index, None
+                continue
+            text, _stopped = stop_matcher.push(self.strip_tags(new_text))
+            if text:
+                yield index, text
+        self.raise_generation_error(streamer)
+
+    def query_model_batch(self, requests: list) -> list:
+        """
+        Generate replies to several prompts in one padded batch, without
+        streaming. Every request must use the same generation settings; those
+        of the first request are used.
+        :return: (text, number of generated tokens) for each request
+        """
+        self.resume()
+        data = requests[0]
+        rendered_templates = [
+            self.rendered_template(request.get("conversation", [
+                {"role": "system", "content": request.get("instructions", "")},
+                {"role": "user", "content": request.get("prompt", "")},
+            ]))
+            for request in requests
+        ]
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        # Pad on the left so every prompt ends where generation starts, leaving
+        # the tokenizer as other requests expect it afterwards
+        padding_side = self.tokenizer.padding_side
+        self.tokenizer.padding_side = "left"
+        try:
+            model_inputs = self.tokenizer(rendered_templates, return_tensors="pt", padding=True).to(self.device)
+        finally:
+            self.tokenizer.padding_side = padding_side
+        prompt_tokens = model_inputs["input_ids"].shape[1]
+        fits = self.memory_budget.max_batch_size(prompt_tokens + data.get("max_new_tokens", 1000))
+        if len(requests) > fits:
+            # Split batches which would not fit in memory at once
+            return self.query_model_batch(requests[:fits]) + self.query_model_batch(requests[fits:])
+        stopping_criteria, logits_processor, stop_strings, _stop_token_ids = self.generation_controls(data)
+        reservation = self.admit(data, prompt_tokens, len(requests))
+        try:
+            with torch.no_grad():
+                output = self.model.generate(
+                    **model_inputs,
+                    max_new_tokens=reservation.max_new_tokens,
+                    min_length=data.get("min_length", 0),
+                    do_sample=data.get("do_sample", True),
+                    temperature=data.get("temperature", 0.9),
+                    top_p=data.get("top_p", 0.9),
+                    top_k=data.get("top_k", 50),
+                    repetition_penalty=data.get("repetition_penalty", 1.0),
+                    use_cache=True,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    stopping_criteria=stopping_criteria,
+                    logits_processor=logits_processor
+                )
+        finally:
+            reservation.release()
+        generated = output[:, model_inputs["input_ids"].shape[1]:]
+        results = []
+        for row in generated:
+            special = (row == self.tokenizer.pad_token_id) | (row == self.tokenizer.eos_token_id)
+            text = self.strip_tags(self.tokenizer.decode(row, skip_special_tokens=True))
+            for stop in stop_strings:
+                if stop and stop in text:
+                    text = text[:text.index(stop)]
+            results.append((text, int((~special).sum())))
+        return results
+
+    @staticmethod
+    def fork_cache(past_key_values, num_copies: int) -> tuple:
+        """Copy a batch size 1 KV cache so each of num_copies sequences can continue from it."""
+        if hasattr(past_key_values, "to_legacy_cache"):
+            past_key_values = past_key_values.to_legacy_cache()
+        return tuple(
+            tuple(tensor.expand(num_copies, *tensor.shape[1:]).contiguous() for tensor in layer)
+            for layer in past_key_values
+        )
+
+    def decode_ticket(self, data: dict, stopping_criteria: list):
+        """
+        With a decode scheduler, get a ticket for the request's priority class
+        and wait for a turn between decode steps.
+        """
+        if self.decode_scheduler is None:
+            return None
+        ticket = self.decode_scheduler.ticket(request_priority(data))
+        stopping_criteria.insert(0, DecodeTurnStoppingCriteria(self.decode_scheduler, ticket))
+        return ticket
+
+    def admit(self, data: dict, prompt_tokens: int, sequences: int = 1):
+        """
+        Reserve memory for a generation, clamping its max_new_tokens if the
+        budget requires. Raises MemoryBudgetError if it can't be admitted.
+        """
+        return self.memory_budget.admit(prompt_tokens, data.get("max_new_tokens", 1000), sequences)
+
+    def decode(self, data: dict):
+        """Run model.generate, or the compiled decode loop when it can take the generation."""
+        if self.compiled_decoder is None:
+            self.model.generate(**data)
+            return
+        if self.compiled_decoder.generate(data):
+            return
+        start = time.perf_counter()
+        output = self.model.generate(**data)
+        self.compiled_decoder.record_eager(
+            time.perf_counter() - start,
+            output.shape[1] - data["input_ids"].shape[1]
+        )
+
+    def decode_stats(self) -> dict:
+        return self.compiled_decoder.stats() if self.compiled_decoder is not None else {"compiled_enabled": False}
+
+    def generate(self, data, ticket=None, reservation=None):
+        try:
+            with span("generate"), torch_profile("generate"):
+                if ticket is None:
+                    self.decode(data)
+                    return
+                self.decode_scheduler.start(ticket)
+                try:
+                    self.decode(data)
+                finally:
+                    self.decode_scheduler.finish(ticket)
+        except Exception as e:
+            logger.error(f"Generation failed: {e}")
+            streamer = data.get("streamer")
+            if streamer is not None:
+                # End the stream so the reader stops waiting, and let it raise the error
+                streamer.error = e
+                streamer.end()
+        finally:
+            if reservation is not None:
+                reservation.release()
+
+    @staticmethod
+    def raise_generation_error(streamer):
+        """Raise GenerationError if the generation feeding the streamer failed."""
+        error = getattr(streamer, "error", None)
+        if error is not None:
+            raise GenerationError(f"{type(error).__name__}: {error}") from error
 
-    def generate(self, data):
-        self.model.generate(**data)
+    def classify_action(self, text: str) -> LLMActionType:
+        """Ask the model which action fits the text, constrained to the action names."""
+        options = "\n".join(f"{action.name}: {action.value}" for action in LLMActionType)
+        request = {
+            "instructions": f"Choose the action which best fits the user's message.\nActions:\n{options}",
+            "prompt": text,
+            "json_schema": {
+                "type": "object",
+                "properties": {"action": {"enum": [action.name for action in LLMActionType]}},
+                "required": ["action"],
+            },
+            "do_sample": False,
+            "max_new_tokens": 32,
+        }
+        try:
+            return LLMActionType[json.loads("".join(self.query_model(request)))["action"]]
+        except (GenerationError, ValueError, KeyError):
+            return LLMActionType.CHAT
 
     def rendered_template(self, conversation: list) -> str:
         chat_template = MODELS[self.model_name]["chat_template"]
@@ -0,0 +1,205 @@
+"""
+Memory accounting for generations.
+
+The KV cache of a sequence grows by the same number of bytes with every
+token, 2 (keys and values) * layers * KV heads * head size * bytes per
+value, so the memory a request can need is known before it starts: its
+prompt plus max_new_tokens, for each sequence it decodes. MemoryBudget
+reserves that much of a fixed budget for every generation while it runs.
+A request which can never fit is clamped to the tokens that do fit, or
+rejected, and one which only has to wait for others to finish is held
+back until they do.
+"""
+import os
+import threading
+from typing import Optional
+
+from airunner_nexus import settings
+from airunner_nexus.exceptions import MemoryBudgetError
+from airunner_nexus.logger import logger
+
+
+def available_ram() -> int:
+    """Bytes of RAM available to new allocations."""
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def process_ram() -> int:
+    """Resident bytes of this process."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+def kv_bytes_per_token(config, dtype_bytes: int) -> int:
+    """KV cache bytes one token of one sequence takes in a model with this transformers config."""
+    layers = config.num_hidden_layers
+    attention_heads = config.num_attention_heads
+    kv_heads = getattr(config, "num_key_value_heads", None) or attention_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // attention_heads
+    return 2 * layers * kv_heads * head_dim * dtype_bytes
+
+
+class Reservation:
+    """Memory held for one generation until it is released."""
+    def __init__(self, budget: "MemoryBudget", size: int, max_new_tokens: int):
+        self.budget = budget
+        self.size = size
+        self.max_new_tokens = max_new_tokens
+        self.released = False
+
+    def release(self):
+        self.budget.release(self)
+
+
+class MemoryBudget:
+    def __init__(
+        self,
+        kv_bytes_per_token: int,
+        budget_bytes: int,
+        device: str = "cpu",
+        max_context: Optional[int] = None,
+        policy: str = settings.MEMORY_OVERFLOW_POLICY,
+        admission_timeout: float = settings.MEMORY_ADMISSION_TIMEOUT
+    ):
+        """
+        :param budget_bytes: memory generations may reserve, on top of the loaded model
+        :param max_context: longest sequence the model supports, if it has a limit
+        :param policy: "clamp" shortens max_new_tokens of requests which can never fit, "reject" refuses them
+        :param admission_timeout: seconds a request waits for others to release memory before it is refused
+        """
+        self.kv_bytes_per_token = kv_bytes_per_token
+        self.budget_bytes = budget_bytes
+        self.device = device
+        self.policy = policy
+        self.admission_timeout = admission_timeout
+        by_memory = budget_bytes // self.token_bytes(1)
+        self.max_context = min(by_memory, max_context) if max_context else by_memory
+        self.reserved = 0
+        self.active = 0
+        self.peak_reserved = 0
+        self.clamped = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+
+    @classmethod
+    def for_model(cls, model, device: str, share: float = 1.0) -> "MemoryBudget":
+        """
+        Budget a loaded transformers model from settings and the memory left on its device.
+        :param share: fraction of the budget this process gets, when several share the device's memory
+        """
+        # The cache is kept in the compute dtype, even when the weights are quantized
+        dtype_bytes = settings.KV_CACHE_DTYPE_BYTES or model.dtype.itemsize
+        budget_bytes = settings.MEMORY_BUDGET_BYTES
+        if budget_bytes is None:
+            budget_bytes = cls.free_memory(device) * settings.MEMORY_BUDGET_FRACTION
+        budget_bytes = int(budget_bytes * share)
+        budget = cls(
+            kv_bytes_per_token(model.config, dtype_bytes),
+            budget_bytes,
+            device,
+            max_context=getattr(model.config, "max_position_embeddings", None)
+        )
+        logger.info(
+            f"Memory budget {budget_bytes / 2 ** 30:.2f}GiB on {device}, "
+            f"{budget.kv_bytes_per_token / 1024:.0f}KiB of KV cache per token, "
+            f"at most {budget.max_context} tokens per sequence"
+        )
+        return budget
+
+    @staticmethod
+    def free_memory(device: str) -> int:
+        if device.startswith("cuda"):
+            import torch
+            free, _total = torch.cuda.mem_get_info(torch.device(device))
+            return free
+        return available_ram()
+
+    def used_memory(self) -> int:
+        """Bytes actually allocated on the device, to compare with what is reserved."""
+        if self.device.startswith("cuda"):
+            import torch
+            return torch.cuda.memory_allocated(torch.device(self.device))
+        return process_ram()
+
+    def token_bytes(self, tokens: int, sequences: int = 1) -> int:
+        """Bytes to reserve for sequences of tokens, including working memory beyond the KV cache."""
+        return int(tokens * sequences * self.kv_bytes_per_token * settings.MEMORY_OVERHEAD_FACTOR)
+
+    def max_new_tokens(self, prompt_tokens: int, sequences: int = 1) -> int:
+        """Most tokens which can ever be generated after a prompt, with the whole budget free."""
+        by_memory = self.budget_bytes // self.token_bytes(1, sequences) - prompt_tokens
+        return max(0, min(by_memory, self.max_context - prompt_tokens))
+
+    def max_batch_size(self, tokens_per_sequence: int) -> int:
+        """Sequences of this length that fit in the budget at once."""
+        return max(1, self.budget_bytes // self.token_bytes(max(1, tokens_per_sequence)))
+
+    def admit(self, prompt_tokens: int, max_new_tokens: int, sequences: int = 1) -> Reservation:
+        """
+        Reserve memory for a generation, waiting for others to finish if needed.
+        Raises MemoryBudgetError if it can't be admitted.
+        """
+        limit = self.max_new_tokens(prompt_tokens, sequences)
+        if max_new_tokens > limit:
+            if self.policy == "reject" or limit == 0:
+                with self._condition:
+                    self.rejected += 1
+                raise MemoryBudgetError(
+                    f"{prompt_tokens} prompt tokens and {max_new_tokens} new tokens for {sequences} "
+                    f"sequences need more than the memory budget; at most {limit} new tokens fit"
+                )
+            logger.info(f"Clamped max_new_tokens from {max_new_tokens} to {limit} to fit the memory budget")
+            with self._condition:
+                self.clamped += 1
+            max_new_tokens = limit
+        size = self.token_bytes(prompt_tokens + max_new_tokens, sequences)
+        with self._condition:
+            if not self._condition.wait_for(
+                lambda: self.reserved + size <= self.budget_bytes,
+                self.admission_timeout
+            ):
+                self.rejected += 1
+                raise MemoryBudgetError(
+                    f"timed out after {self.admission_timeout}s waiting for "
+                    f"{size / 2 ** 20:.0f}MiB of the memory budget"
+                )
+            self.reserved += size
+            self.active += 1
+            self.peak_reserved = max(self.peak_reserved, self.reserved)
+        return Reservation(self, size, max_new_tokens)
+
+    def release(self, reservation: Reservation):
+        with self._condition:
+            if reservation.released:
+                return
+            reservation.released = True
+            self.reserved -= reservation.size
+            self.active -= 1
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "device": self.device,
+                "budget_bytes": self.budget_bytes,
+                "reserved_bytes": self.reserved,
+                "peak_reserved_bytes": self.peak_reserved,
+                "used_bytes": self.used_memory(),
+                "process_ram_bytes": process_ram(),
+                "available_ram_bytes": available_ram(),
+                "kv_bytes_per_token": self.kv_bytes_per_token,
+                "max_context": self.max_context,
+                "active": self.active,
+                "clamped": self.clamped,
+                "rejected": self.rejected,
+            }
@@ -0,0 +1,56 @@
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from airunner_nexus import settings
+
+MOOD_DESCRIPTIONS = {
+    "happy": "That makes me happy, glad and cheerful.",
+    "sad": "That makes me sad, down and unhappy.",
+    "neutral": "That is fine, I don't feel strongly about it.",
+    "angry": "That makes me angry, furious and annoyed.",
+    "paranoid": "I don't trust that, someone is out to get me.",
+    "anxious": "That makes me nervous, worried and anxious.",
+    "excited": "That is so exciting, I can't wait!",
+    "bored": "That is boring and dull.",
+    "confused": "I don't understand, that is confusing.",
+    "relaxed": "I feel calm, relaxed and at ease.",
+    "curious": "That is interesting, tell me more.",
+    "frustrated": "That is frustrating, nothing is working.",
+    "hopeful": "I am hopeful that things will get better.",
+    "disappointed": "That is disappointing, I expected better.",
+}
+
+
+class MoodScorer:
+    """
+    Estimate how a message moves each mood stat by comparing its embedding
+    with a short description of every mood.
+
+    Moods which are more similar to the message than average go up, the rest
+    go down.
+    """
+    def __init__(
+        self,
+        embed: Callable[[List[str]], np.ndarray],
+        scale: float = settings.MOOD_DELTA_SCALE,
+        descriptions: Dict[str, str] = None
+    ):
+        self.embed = embed
+        self.scale = scale
+        descriptions = descriptions or MOOD_DESCRIPTIONS
+        self.moods = list(descriptions.keys())
+        self.mood_embeddings = np.asarray(self.embed(list(descriptions.values())), dtype=np.float32)
+
+    def score(self, text: str, stats: Dict[str, float] = None) -> Dict[str, float]:
+        """
+        Return a delta for every mood stat.
+        :param stats: current stats; only moods present here are returned when given
+        """
+        similarities = self.mood_embeddings @ np.asarray(self.embed([text]), dtype=np.float32)[0]
+        deltas = np.clip((similarities - similarities.mean()) * self.scale, -1.0, 1.0)
+        return {
+            mood: round(float(delta), 4)
+            for mood, delta in zip(self.moods, deltas)
+            if stats is None or mood in stats
+        }
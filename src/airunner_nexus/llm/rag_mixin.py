@@ -1,7 +1,11 @@
+import os
 import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional
 
 from llama_index.core import SimpleDirectoryReader, ServiceContext, PromptHelper, \
-    SimpleKeywordTableIndex
+    SimpleKeywordTableIndex, StorageContext, load_index_from_storage
 from llama_index.core.chat_engine import ContextChatEngine
 from llama_index.core.indices.keyword_table import KeywordTableSimpleRetriever
 from llama_index.core.node_parser import SentenceSplitter
@@ -9,13 +13,22 @@ from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 from llama_index.core import Settings
 from llama_index.core.readers.json import JSONReader
 
+from airunner_nexus import settings
 from airunner_nexus.enums import AgentState
+from airunner_nexus.llm.dense_retriever import DenseRetriever
+from airunner_nexus.llm.document_ingestion import extractor_classes, iter_file_chunks
+from airunner_nexus.llm.document_manifest import DocumentManifest
+from airunner_nexus.llm.embedding_cache import BatchEmbedder, EmbeddingCache
 from airunner_nexus.llm.external_condition_stopping_criteria import ExternalConditionStoppingCriteria
+from airunner_nexus.llm.retrieval_cache import RetrievalCache
+from airunner_nexus.llm.vector_index import VectorIndex
+from airunner_nexus.logger import logger
 
 
 class RagMixin:
     def __init__(self):
         self.embed_model = None
+        self.embedder = None
         self.json_reader = None
         self.file_extractor = None
         self.documents = None
@@ -23,8 +36,23 @@ class RagMixin:
         self.prompt_helper = None
         self.service_context = None
         self.index = None
+        self.vector_index = None
         self.retriever = None
         self.chat_engine = None
+        self.use_dense_retrieval = settings.RAG_RETRIEVER == "dense"
+        self.rag_persist_dir = os.path.expanduser(settings.RAG_PERSIST_DIR)
+        if self.use_dense_retrieval:
+            self.rag_persist_dir = os.path.join(self.rag_persist_dir, "dense")
+        self.manifest = DocumentManifest(os.path.join(self.rag_persist_dir, "manifest.json"))
+        self._index_lock = threading.RLock()
+        self._index_watcher = None
+        self._stop_index_watcher = threading.Event()
+        self._keyword_index_version = 0
+        self.retrieval_cache = RetrievalCache(settings.RAG_RETRIEVAL_CACHE_SIZE)
+        self._retrieval_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rag retrieval")
+        self._pending_retrievals = {}
+        self._pending_retrievals_lock = threading.Lock()
+        self.rag_requests = deque()
         self.__query_instruction = "Search through all available texts and provide a brief summary of the key points which are relevant to the query."
         self.__text_instruction = "Summarize and provide a brief explanation of the text. Stay concise and to the point."
         self.agent_state = AgentState.SEARCH
@@ -32,13 +60,14 @@ class RagMixin:
         self.load_rag_model()
         self.load_readers()
         self.load_file_extractor()
-        self.load_documents()
         self.load_text_splitter()
         self.load_prompt_helper()
         self.load_service_context()
         self.load_document_index()
         self.load_retriever()
         self.load_context_chat_engine()
+        if settings.RAG_WATCH:
+            self.start_index_watcher()
 
     @property
     def text_instruction(self):
@@ -62,6 +91,13 @@ class RagMixin:
             query_instruction=self.query_instruction,
             text_instruction=self.text_instruction,
             trust_remote_code=False,
+            embed_batch_size=settings.RAG_EMBED_BATCH_SIZE,
+        )
+        self.embedder = BatchEmbedder(
+            self.embed_model,
+            model_name=f"{self.model_path}:{self.text_instruction}",
+            cache=EmbeddingCache(settings.RAG_EMBEDDING_CACHE),
+            batch_size=settings.RAG_EMBED_BATCH_SIZE
         )
 
     def load_readers(self):
@@ -72,15 +108,19 @@ class RagMixin:
             ".md": self.markdown_reader,
         }
 
-    def load_documents(self):
+    def load_documents(self, input_files: Optional[List[str]] = None):
+        input_files = self.target_files if input_files is None else input_files
         try:
             self.documents = SimpleDirectoryReader(
-                input_files=self.target_files,
+                input_files=input_files,
                 file_extractor=self.file_extractor,
-                exclude_hidden=False
+                exclude_hidden=False,
+                filename_as_id=True
             ).load_data()
         except ValueError as e:
             print(f"Error loading documents: {str(e)}")
+            self.documents = []
+        return self.documents
 
     def load_text_splitter(self):
         self.text_splitter = SentenceSplitter(
@@ -110,15 +150,269 @@ class RagMixin:
             print(f"Error loading service context with chat engine: {str(e)}")
 
     def load_document_index(self):
+        """Load the persisted index, then bring it up to date with target_files."""
+        if self.use_dense_retrieval:
+            self.load_vector_index()
+        else:
+            self.load_keyword_index()
+        if self.index is None and self.vector_index is None:
+            return
+        self.refresh_document_index()
+        if (
+            self.use_dense_retrieval
+            and settings.RAG_VECTOR_PARTITIONS
+            and not self.vector_index.is_partitioned
+            and self.vector_index.count >= settings.RAG_VECTOR_PARTITIONS * 40
+        ):
+            self.vector_index.train_partitions(settings.RAG_VECTOR_PARTITIONS)
+
+    def load_vector_index(self):
         try:
-            self.index = SimpleKeywordTableIndex.from_documents(
-                self.documents,
-                service_context=self.service_context,
+            self.vector_index = VectorIndex(
+                os.path.join(self.rag_persist_dir, "vectors"),
+                dtype=settings.RAG_VECTOR_DTYPE,
+                n_probe=settings.RAG_VECTOR_N_PROBE
             )
-        except TypeError as e:
-            print(f"Error loading index: {str(e)}")
+        except ValueError as e:
+            print(f"Error loading vector index: {str(e)}")
+            return
+        if self.vector_index.count == 0:
+            self.manifest.entries = {}
+
+    def load_keyword_index(self):
+        if os.path.exists(os.path.join(self.rag_persist_dir, "docstore.json")):
+            try:
+                self.index = load_index_from_storage(
+                    StorageContext.from_defaults(persist_dir=self.rag_persist_dir),
+                    service_context=self.service_context,
+                )
+            except Exception as e:
+                print(f"Error loading persisted index: {str(e)}")
+                self.index = None
+        if self.index is None:
+            self.manifest.entries = {}
+            try:
+                self.index = SimpleKeywordTableIndex.from_documents(
+                    [],
+                    service_context=self.service_context,
+                )
+            except TypeError as e:
+                print(f"Error loading index: {str(e)}")
+
+    def refresh_document_index(self) -> bool:
+        """
+        Re-index files in target_files which were added or changed since the
+        index was persisted and remove files which were deleted.
+
+        Documents are read and chunked before the index lock is taken so that
+        queries are only blocked while nodes are inserted or removed.
+        :return: True if the index was modified
+        """
+        added, changed, deleted = self.manifest.diff(self.target_files)
+        if not (added or changed or deleted):
+            return False
+        logger.info(
+            f"Updating document index: {len(added)} added, "
+            f"{len(changed)} changed, {len(deleted)} deleted"
+        )
+        if self.use_dense_retrieval:
+            self.ingest_files(added + changed)
+            with self._index_lock:
+                for file_path in deleted:
+                    self.delete_documents(self.manifest.doc_ids(file_path))
+                    self.manifest.remove(file_path)
+                self.persist_document_index()
+            return True
+
+        documents = self.load_documents(added + changed) if added or changed else []
+        documents_by_file = {}
+        for document in documents:
+            file_path = os.path.abspath(document.metadata.get("file_path", ""))
+            documents_by_file.setdefault(file_path, []).append(document)
+
+        with self._index_lock:
+            for file_path in changed + deleted:
+                self.delete_documents(self.manifest.doc_ids(file_path))
+                self.manifest.remove(file_path)
+            for document in documents:
+                self.index.insert(document)
+            self._keyword_index_version += 1
+            for file_path in added + changed:
+                self.manifest.update(
+                    file_path,
+                    [document.doc_id for document in documents_by_file.get(file_path, [])]
+                )
+            self.persist_document_index()
+        return True
+
+    def ingest_files(self, files: List[str]):
+        """
+        Stream chunks from a process pool into the embedder and the vector
+        index, committing every RAG_INGEST_BATCH_SIZE chunks.
+        """
+        batch = []
+        total_chunks = 0
+        for file_chunks in iter_file_chunks(
+            files,
+            workers=settings.RAG_INGEST_WORKERS,
+            chunk_size=self.text_splitter.chunk_size,
+            chunk_overlap=self.text_splitter.chunk_overlap,
+            extractors=extractor_classes(self.file_extractor)
+        ):
+            batch.append(file_chunks)
+            total_chunks += len(file_chunks[2])
+            if total_chunks >= settings.RAG_INGEST_BATCH_SIZE:
+                self.index_file_chunks(batch)
+                batch = []
+                total_chunks = 0
+        if batch:
+            self.index_file_chunks(batch)
+
+    def index_file_chunks(self, batch: list):
+        """
+        Embed a batch of chunked files and replace their previous chunks in the
+        vector index. Files which could not be read keep their previous chunks
+        and stay out of the manifest, so they are retried.
+        """
+        batch = [file_chunks for file_chunks in batch if file_chunks[1] is not None]
+        chunks = [chunk for _file_path, _doc_ids, file_chunks in batch for chunk in file_chunks]
+        texts = [text for text, _metadata, _doc_id in chunks]
+        embeddings = self.embedder.embed(texts) if chunks else None
+        with self._index_lock:
+            for file_path, _doc_ids, _file_chunks in batch:
+                self.delete_documents(self.manifest.doc_ids(file_path))
+            if chunks:
+                self.vector_index.add(
+                    embeddings,
+                    texts,
+                    [metadata for _text, metadata, _doc_id in chunks],
+                    [doc_id for _text, _metadata, doc_id in chunks]
+                )
+            for file_path, doc_ids, _file_chunks in batch:
+                self.manifest.update(file_path, doc_ids)
+            self.persist_document_index()
+
+    def delete_documents(self, doc_ids: List[str]):
+        if self.use_dense_retrieval:
+            self.vector_index.delete(doc_ids)
+        else:
+            for doc_id in doc_ids:
+                self.index.delete_ref_doc(doc_id, delete_from_docstore=True)
+
+    def persist_document_index(self):
+        os.makedirs(self.rag_persist_dir, exist_ok=True)
+        if self.use_dense_retrieval:
+            self.vector_index.save()
+        else:
+            self.index.storage_context.persist(persist_dir=self.rag_persist_dir)
+        self.manifest.save()
+
+    def start_index_watcher(self, interval: float = settings.RAG_WATCH_INTERVAL):
+        """Poll target_files in a background thread and apply changes to the index."""
+        if self._index_watcher and self._index_watcher.is_alive():
+            return
+        self._stop_index_watcher.clear()
+        self._index_watcher = threading.Thread(
+            target=self._watch_index,
+            args=(interval,),
+            daemon=True,
+            name="rag index watcher"
+        )
+        self._index_watcher.start()
+
+    def stop_index_watcher(self):
+        self._stop_index_watcher.set()
+        if self._index_watcher:
+            self._index_watcher.join()
+            self._index_watcher = None
+
+    def _watch_index(self, interval: float):
+        while not self._stop_index_watcher.wait(interval):
+            try:
+                self.refresh_document_index()
+            except Exception as e:
+                logger.error(f"Error refreshing document index: {str(e)}")
+
+    @property
+    def index_version(self) -> int:
+        if self.use_dense_retrieval:
+            return self.vector_index.version
+        return self._keyword_index_version
+
+    def retrieve(self, query: str) -> list:
+        """Retrieve nodes for the query, reusing cached or prefetched results."""
+        version = self.index_version
+        results = self.retrieval_cache.get(query, version)
+        if results is not None:
+            return results
+        with self._pending_retrievals_lock:
+            future = self._pending_retrievals.pop(
+                (self.retrieval_cache.normalize_query(query), version), None
+            )
+        if future is not None:
+            return future.result()
+        return self._retrieve_and_cache(query, version)
+
+    def prefetch_retrieval(self, query: str) -> Optional[Future]:
+        """Start retrieving for query in the background so a later retrieve() finds it ready."""
+        version = self.index_version
+        key = (self.retrieval_cache.normalize_query(query), version)
+        with self._pending_retrievals_lock:
+            self._pending_retrievals = {
+                pending_key: future
+                for pending_key, future in self._pending_retrievals.items()
+                if not future.done() or pending_key == key
+            }
+            if key in self._pending_retrievals:
+                return self._pending_retrievals[key]
+            future = self._retrieval_executor.submit(self._retrieve_and_cache, query, version)
+            self._pending_retrievals[key] = future
+            return future
+
+    def _retrieve_and_cache(self, query: str, version: int) -> list:
+        if self.use_dense_retrieval:
+            results = self.retriever.retrieve(query)
+        else:
+            with self._index_lock:
+                results = self.retriever.retrieve(query)
+        self.retrieval_cache.put(query, version, results)
+        return results
+
+    @staticmethod
+    def add_retrieved_context(conversation: list, nodes: list) -> list:
+        """Prepend retrieved text to the system message of the conversation."""
+        if not nodes:
+            return conversation
+        context = "Context:\n" + "\n".join(node.get_content() for node in nodes) + "\n------\n"
+        conversation = [dict(message) for message in conversation]
+        if conversation and conversation[0]["role"] == "system":
+            conversation[0]["content"] = context + conversation[0]["content"]
+        else:
+            conversation.insert(0, {"role": "system", "content": context})
+        return conversation
+
+    def enqueue_rag_query(self, **kwargs):
+        """
+        Queue a rag_query_model call. If a generation is already running, the
+        retrieval for the queued query starts immediately so that it overlaps
+        with the current decode.
+        """
+        self.rag_requests.append(kwargs)
+        if kwargs.get("query") and self.generate_thread and self.generate_thread.is_alive():
+            self.prefetch_retrieval(kwargs["query"])
+
+    def run_next_rag_query(self):
+        kwargs = self.rag_requests.popleft()
+        yield from self.rag_query_model(**kwargs)
 
     def load_retriever(self):
+        if self.use_dense_retrieval:
+            self.retriever = DenseRetriever(
+                self.vector_index,
+                self.embed_model,
+                similarity_top_k=settings.RAG_SIMILARITY_TOP_K
+            )
+            return
         try:
             self.retriever = KeywordTableSimpleRetriever(
                 index=self.index,
@@ -158,7 +452,8 @@ class RagMixin:
         decoder_start_token_id=None,
         use_cache=True,
         length_penalty=1.5,
-        history_prompt=""
+        history_prompt="",
+        query=None
     ):
         chat_template = (
             "{% for message in messages %}"
@@ -172,9 +467,13 @@ class RagMixin:
             "{% endfor %}"
         )
 
+        conversation = conversation if conversation is not None else []
+        if query:
+            conversation = self.add_retrieved_context(conversation, self.retrieve(query))
+
         rendered_template = self.tokenizer.apply_chat_template(
             chat_template=chat_template,
-            conversation=conversation if conversation is not None else [],
+            conversation=conversation,
             tokenize=False
         )
         print("*"*1000)
@@ -217,6 +516,10 @@ class RagMixin:
         )
         self.generate_thread.start()
 
+        # Retrieve for the next queued request while this one decodes
+        if self.rag_requests and self.rag_requests[0].get("query"):
+            self.prefetch_retrieval(self.rag_requests[0]["query"])
+
         rendered_template = rendered_template.replace("</s>", "")
         strip_template = "<s> " + rendered_template
         strip_template = strip_template.replace(" [INST]", "  [INST]")
@@ -0,0 +1,260 @@
+import inspect
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from typing import Generator, List, Optional
+
+from airunner_nexus import settings
+from airunner_nexus.exceptions import GenerationError, MemoryBudgetError
+from airunner_nexus.logger import logger
+
+# LLMHandler methods a replica runs on behalf of the server
+REPLICA_METHODS = ("query_model", "query_model_candidates", "classify_action")
+
+
+def configure_device(device: str):
+    """
+    Restrict the current process to a device before torch is imported.
+    "cuda:1" exposes only that GPU; "cpu", "cpu:0-7" or "cpu:0,2,4" hides
+    every GPU and pins the process to the given cores.
+    """
+    kind, _, spec = device.partition(":")
+    if kind == "cuda":
+        os.environ["CUDA_VISIBLE_DEVICES"] = spec or "0"
+        return
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    if not spec or not hasattr(os, "sched_setaffinity"):
+        return
+    cores = set()
+    for part in spec.split(","):
+        first, _, last = part.partition("-")
+        cores.update(range(int(first), int(last or first) + 1))
+    os.sched_setaffinity(0, cores)
+    os.environ["OMP_NUM_THREADS"] = str(len(cores))
+
+
+def memory_domain(device: str) -> str:
+    """Devices with the same domain allocate from the same memory: every CPU device shares RAM."""
+    kind, _, spec = device.partition(":")
+    return "cpu" if kind == "cpu" else f"{kind}:{spec or 0}"
+
+
+def run_replica(connection, device: str, model_name: str, engine: str, memory_share: float = 1.0):
+    """Entry point of a replica process: load a model and answer requests until told to stop."""
+    configure_device(device)
+    if engine == "fake":
+        from airunner_nexus.llm.fake_llm_handler import FakeLLMHandler
+        handler = FakeLLMHandler(model_name)
+    else:
+        from airunner_nexus.llm.llm_handler import LLMHandler
+        handler = LLMHandler(model_name, memory_share)
+    connection.send((None, "ready", os.getpid()))
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        request_id, method, data = message
+        try:
+            if method not in REPLICA_METHODS:
+                raise ValueError(f"Unknown replica method {method}")
+            result = getattr(handler, method)(data)
+            if inspect.isgenerator(result):
+                for chunk in result:
+                    connection.send((request_id, "chunk", chunk))
+            else:
+                connection.send((request_id, "chunk", result))
+            connection.send((request_id, "done", None))
+        except Exception as e:
+            connection.send((request_id, "error", f"{type(e).__name__}: {e}"))
+
+
+class Replica:
+    """The server side of one replica process."""
+    def __init__(self, index: int, device: str, model_name: str, engine: str, context, memory_share: float = 1.0):
+        """:param memory_share: fraction of its device's memory the replica budgets for generations"""
+        self.index = index
+        self.device = device
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=run_replica,
+            args=(child_connection, device, model_name, engine, memory_share),
+            daemon=True,
+            name=f"replica {index}"
+        )
+        self.process.start()
+        child_connection.close()
+        self.pid = None
+        self.is_alive = True
+        self.outstanding = 0
+        self.completed = 0
+        self.failed = 0
+        self.chunks = 0
+        self.busy_time = 0.0
+        self.busy_since = None
+        self.started_at = time.monotonic()
+        self.send_lock = threading.Lock()
+
+    @property
+    def utilization(self) -> float:
+        """Fraction of the replica's lifetime spent with at least one request."""
+        busy_time = self.busy_time
+        if self.busy_since is not None:
+            busy_time += time.monotonic() - self.busy_since
+        elapsed = time.monotonic() - self.started_at
+        return busy_time / elapsed if elapsed else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "index": self.index,
+            "device": self.device,
+            "pid": self.pid,
+            "alive": self.is_alive,
+            "outstanding": self.outstanding,
+            "completed": self.completed,
+            "failed": self.failed,
+            "chunks": self.chunks,
+            "utilization": round(self.utilization, 4),
+        }
+
+
+class ReplicaPool:
+    """
+    Run the model in several worker processes, each with its own replica
+    pinned to a device or a set of cores, so that generation does not
+    compete for the GIL with the server's socket threads.
+
+    Requests go to the replica with the fewest outstanding requests and are
+    answered over a pipe. Every replica handles one request at a time and
+    queues the rest.
+    """
+    def __init__(
+        self,
+        replicas: int = settings.LLM_REPLICAS,
+        devices: Optional[List[str]] = settings.REPLICA_DEVICES,
+        model_name: str = settings.DEFAULT_MODEL_NAME,
+        engine: str = settings.LLM_ENGINE
+    ):
+        devices = devices or ["cuda:0"]
+        context = multiprocessing.get_context("spawn")
+        assigned = [devices[index % len(devices)] for index in range(replicas)]
+        # Replicas sharing memory split its budget instead of each counting all of it as free
+        sharing = {}
+        for device in assigned:
+            sharing[memory_domain(device)] = sharing.get(memory_domain(device), 0) + 1
+        self.replicas = [
+            Replica(index, device, model_name, engine, context, 1 / sharing[memory_domain(device)])
+            for index, device in enumerate(assigned)
+        ]
+        self.requests = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._closing = False
+        for replica in self.replicas:
+            try:
+                replica.pid = replica.connection.recv()[2]
+            except EOFError:
+                logger.error(f"Replica {replica.index} failed to start on {replica.device}")
+                replica.is_alive = False
+                continue
+            logger.info(f"Replica {replica.index} ready on {replica.device} (pid {replica.pid})")
+            threading.Thread(
+                target=self._read,
+                args=(replica,),
+                daemon=True,
+                name=f"replica {replica.index} reader"
+            ).start()
+
+    def _least_loaded(self) -> Replica:
+        alive = [replica for replica in self.replicas if replica.is_alive]
+        if not alive:
+            raise RuntimeError("No model replicas are running")
+        return min(alive, key=lambda replica: (replica.outstanding, replica.utilization))
+
+    def _read(self, replica: Replica):
+        """Hand replies from a replica to the requests waiting for them."""
+        while True:
+            try:
+                request_id, kind, value = replica.connection.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                request = self.requests.get(request_id)
+                if kind == "chunk":
+                    replica.chunks += 1
+                else:
+                    self._finish(replica, kind == "error")
+            if request is not None:
+                request[0].put((kind, value))
+        if not self._closing:
+            logger.error(f"Replica {replica.index} stopped unexpectedly")
+        with self._lock:
+            replica.is_alive = False
+            waiting = [responses for responses, owner in self.requests.values() if owner is replica]
+            for _ in range(replica.outstanding):
+                self._finish(replica, True)
+        for responses in waiting:
+            responses.put(("error", "replica stopped"))
+
+    def _finish(self, replica: Replica, failed: bool):
+        replica.outstanding -= 1
+        replica.completed += int(not failed)
+        replica.failed += int(failed)
+        if replica.outstanding == 0 and replica.busy_since is not None:
+            replica.busy_time += time.monotonic() - replica.busy_since
+            replica.busy_since = None
+
+    def call(self, method: str, data) -> Generator:
+        """Run an LLMHandler method on the least loaded replica and yield what it yields."""
+        request_id = next(self._ids)
+        responses = queue.SimpleQueue()
+        with self._lock:
+            replica = self._least_loaded()
+            self.requests[request_id] = (responses, replica)
+            replica.outstanding += 1
+            if replica.busy_since is None:
+                replica.busy_since = time.monotonic()
+        try:
+            try:
+                with replica.send_lock:
+                    replica.connection.send((request_id, method, data))
+            except OSError as e:
+                responses.put(("error", str(e)))
+            while True:
+                kind, value = responses.get()
+                if kind == "chunk":
+                    yield value
+                elif kind == "done":
+                    break
+                elif value.startswith(f"{MemoryBudgetError.__name__}: "):
+                    raise MemoryBudgetError(value[len(MemoryBudgetError.__name__) + 2:])
+                elif value.startswith(f"{GenerationError.__name__}: "):
+                    raise GenerationError(value[len(GenerationError.__name__) + 2:])
+                else:
+                    raise GenerationError(f"Replica {replica.index} failed: {value}")
+        finally:
+            with self._lock:
+                self.requests.pop(request_id, None)
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            return [replica.stats() for replica in self.replicas]
+
+    def close(self):
+        self._closing = True
+        for replica in self.replicas:
+            try:
+                with replica.send_lock:
+                    replica.connection.send(None)
+            except OSError:
+                pass
+        for replica in self.replicas:
+            replica.process.join(timeout=5)
+            if replica.process.is_alive():
+                replica.process.terminate()
+            logger.info(f"Replica {replica.index} stopped: {replica.stats()}")
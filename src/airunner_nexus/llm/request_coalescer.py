@@ -0,0 +1,123 @@
+import contextvars
+import hashlib
+import json
+import threading
+from typing import Callable, Generator, Iterable, Optional
+
+from airunner_nexus.logger import logger
+
+# Keys which only describe how the client renders the conversation
+IGNORED_KEYS = ("history", "listener", "speaker")
+
+
+class Flight:
+    """Chunks produced by one in-flight generation, shared with every request attached to it."""
+    def __init__(self, key: str):
+        self.key = key
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.followers = 0
+        self.condition = threading.Condition()
+
+    def publish(self, chunk: str):
+        with self.condition:
+            self.chunks.append(chunk)
+            self.condition.notify_all()
+
+    def finish(self, error: Optional[Exception] = None):
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+
+    def follow(self) -> Generator[str, None, None]:
+        """Replay the chunks produced so far, then yield new chunks as they arrive."""
+        index = 0
+        while True:
+            with self.condition:
+                while index >= len(self.chunks) and not self.done:
+                    self.condition.wait()
+                chunks = self.chunks[index:]
+                done = self.done
+            index += len(chunks)
+            yield from chunks
+            if done and index >= len(self.chunks):
+                break
+        if self.error is not None:
+            raise self.error
+
+
+class RequestCoalescer:
+    """
+    Run identical deterministic requests once (singleflight).
+
+    The first request for a key starts the generation on its own thread so
+    that it keeps going for the other requests even if the first client goes
+    away. Every request for that key, including the first, follows the shared
+    stream.
+    """
+    def __init__(self):
+        self.flights = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def request_key(data: dict) -> Optional[str]:
+        """
+        Key for a request, or None if its output is not deterministic. Only
+        greedy requests are: a seed does not make sampling reproducible, since
+        concurrent generations share the random number generator.
+        """
+        if data.get("do_sample", True):
+            return None
+        conversation = data.get("conversation") or [
+            {"role": "system", "content": data.get("instructions", "")},
+            {"role": "user", "content": data.get("prompt", "")},
+        ]
+        params = {
+            key: value for key, value in data.items()
+            if key not in IGNORED_KEYS + ("conversation", "instructions", "prompt")
+        }
+        # Only the structure is normalized: content is compared byte for byte,
+        # since whitespace can change what the model generates
+        params["conversation"] = [
+            dict(message, role=str(message.get("role", "")).lower(), content=message.get("content", ""))
+            for message in conversation
+        ]
+        encoded = json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def run(self, key: Optional[str], generate: Callable[[], Iterable[str]]) -> Generator[str, None, None]:
+        if key is None:
+            yield from generate()
+            return
+        with self._lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = Flight(key)
+                self.flights[key] = flight
+                # The leader's log context and trace follow its generation
+                threading.Thread(
+                    target=contextvars.copy_context().run,
+                    args=(self._produce, flight, generate),
+                    daemon=True,
+                    name="coalesced generation"
+                ).start()
+            else:
+                flight.followers += 1
+                logger.info(f"Attached request to in-flight generation ({flight.followers} followers)")
+        yield from flight.follow()
+
+    def _produce(self, flight: Flight, generate: Callable[[], Iterable[str]]):
+        error = None
+        try:
+            for chunk in generate():
+                flight.publish(chunk)
+        except Exception as e:
+            logger.error(f"Coalesced generation failed: {e}")
+            error = e
+        finally:
+            with self._lock:
+                if self.flights.get(flight.key) is flight:
+                    del self.flights[flight.key]
+            flight.finish(error)
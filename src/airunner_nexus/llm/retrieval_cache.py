@@ -0,0 +1,56 @@
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class RetrievalCache:
+    """
+    LRU cache of retrieval results keyed by the normalized query.
+
+    Entries are tagged with the index version they were retrieved from; the
+    whole cache is dropped the first time a newer version is seen.
+    """
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        return re.sub(r"\s+", " ", query).strip().lower()
+
+    def _check_version(self, version: int) -> bool:
+        """Drop stale entries when the index moved on. Returns False for an outdated version."""
+        if self.version is None or version > self.version:
+            self._entries.clear()
+            self.version = version
+        return version == self.version
+
+    def get(self, query: str, version: int) -> Optional[list]:
+        key = self.normalize_query(query)
+        with self._lock:
+            results = self._entries.get(key) if self._check_version(version) else None
+            if results is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return results
+
+    def put(self, query: str, version: int, results: list):
+        key = self.normalize_query(query)
+        with self._lock:
+            if not self._check_version(version):
+                return
+            self._entries[key] = results
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
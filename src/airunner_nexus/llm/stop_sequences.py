@@ -0,0 +1,89 @@
+from typing import List, Optional, Tuple
+
+import torch
+from transformers import StoppingCriteria
+
+
+class StopSequenceMatcher:
+    """
+    Incrementally match stop strings against streamed text.
+
+    Text which could still turn out to be the start of a stop string is held
+    back until the next chunk decides it, so the client never receives any
+    part of a stop string.
+    """
+    def __init__(self, stop_strings: List[str]):
+        self.stop_strings = [stop for stop in stop_strings if stop]
+        self.held = ""
+        self.stopped = False
+
+    def push(self, text: str) -> Tuple[str, bool]:
+        """
+        Add a chunk of streamed text.
+        :return: (text which is safe to emit, True if a stop string matched)
+        """
+        if self.stopped:
+            return "", True
+        buffer = self.held + text
+        match = min(
+            (index for index in (buffer.find(stop) for stop in self.stop_strings) if index != -1),
+            default=-1
+        )
+        if match != -1:
+            self.held = ""
+            self.stopped = True
+            return buffer[:match], True
+        hold = self._partial_match_length(buffer)
+        self.held = buffer[len(buffer) - hold:] if hold else ""
+        return buffer[:len(buffer) - hold], False
+
+    def flush(self) -> str:
+        """Release held back text once the stream has ended without a match."""
+        held = self.held
+        self.held = ""
+        return "" if self.stopped else held
+
+    def _partial_match_length(self, buffer: str) -> int:
+        """Length of the longest suffix of buffer which is a prefix of a stop string."""
+        longest = 0
+        for stop in self.stop_strings:
+            for length in range(min(len(stop) - 1, len(buffer)), longest, -1):
+                if buffer.endswith(stop[:length]):
+                    longest = length
+                    break
+        return longest
+
+
+class StopSequenceStoppingCriteria(StoppingCriteria):
+    """
+    Stop a sequence on the step which produces a stop token id or completes a
+    stop string.
+
+    Only the last few tokens are decoded on each step, enough to cover the
+    longest stop string, so a stop string split across tokens is still found.
+    """
+    def __init__(
+        self,
+        tokenizer,
+        stop_strings: Optional[List[str]] = None,
+        stop_token_ids: Optional[List[int]] = None
+    ):
+        super().__init__()
+        self.tokenizer = tokenizer
+        self.stop_strings = [stop for stop in (stop_strings or []) if stop]
+        self.stop_token_ids = set(stop_token_ids or [])
+        self.window = max((len(stop) for stop in self.stop_strings), default=0) + 2
+        self.prompt_length = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1] - 1
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        generated = input_ids[:, self.prompt_length:]
+        for row in range(generated.shape[0]):
+            if self.stop_token_ids and int(generated[row, -1]) in self.stop_token_ids:
+                done[row] = True
+            elif self.stop_strings:
+                tail = self.tokenizer.decode(generated[row, -self.window:], skip_special_tokens=True)
+                done[row] = any(stop in tail for stop in self.stop_strings)
+        return done
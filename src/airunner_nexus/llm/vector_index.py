@@ -0,0 +1,319 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from airunner_nexus.logger import logger
+
+
+class VectorIndex:
+    """
+    Dense retrieval index which keeps chunk embeddings in a memory-mapped
+    matrix on disk.
+
+    Embeddings are L2 normalized and stored either as float16 or as int8 with
+    a float32 scale per row so that a dot product is a cosine similarity.
+    Chunk text and metadata are kept in sqlite next to the matrix, so neither
+    has to fit in RAM. Search scans the matrix in blocks, or only the probed
+    partitions once train_partitions has been called (IVF).
+    """
+    DTYPES = ("float16", "int8")
+
+    def __init__(
+        self,
+        path: str,
+        dtype: str = "float16",
+        block_size: int = 65536,
+        growth: int = 4096,
+        n_probe: int = 8
+    ):
+        if dtype not in self.DTYPES:
+            raise ValueError(f"Unsupported vector dtype {dtype}")
+        self.path = path
+        self.dtype = dtype
+        self.block_size = block_size
+        self.growth = growth
+        self.n_probe = n_probe
+        self.dim = None
+        self.count = 0
+        self.capacity = 0
+        self.version = 0
+        self.vectors = None
+        self.scales = None
+        self.live = None
+        self.partitions = None
+        self.centroids = None
+        self._lock = threading.RLock()
+        os.makedirs(self.path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.path, "records.sqlite"), check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "row INTEGER PRIMARY KEY, doc_id TEXT, text TEXT, metadata TEXT)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS records_doc_id ON records (doc_id)")
+        self.db.commit()
+        self.load()
+
+    @property
+    def meta_path(self) -> str:
+        return os.path.join(self.path, "meta.json")
+
+    @property
+    def is_partitioned(self) -> bool:
+        return self.centroids is not None
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def load(self):
+        if not os.path.exists(self.meta_path):
+            return
+        with open(self.meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["dtype"] != self.dtype:
+            raise ValueError(f"Index at {self.path} was built with {meta['dtype']} vectors")
+        self.dim = meta["dim"]
+        self.count = meta["count"]
+        self.version = meta.get("version", 0)
+        self._map(meta["capacity"])
+        if os.path.exists(self._file("centroids.npy")):
+            self.centroids = np.load(self._file("centroids.npy"))
+
+    def save(self):
+        with self._lock:
+            if self.vectors is None:
+                return
+            self.vectors.flush()
+            self.live.flush()
+            self.partitions.flush()
+            if self.scales is not None:
+                self.scales.flush()
+            self.db.commit()
+            tmp_path = self.meta_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({
+                    "dim": self.dim,
+                    "dtype": self.dtype,
+                    "count": self.count,
+                    "capacity": self.capacity,
+                    "version": self.version,
+                }, f)
+            os.replace(tmp_path, self.meta_path)
+
+    def _memmap(self, name: str, dtype, shape: tuple):
+        path = self._file(name)
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with open(path, "ab") as f:
+            if f.tell() < nbytes:
+                f.truncate(nbytes)
+        return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+    def _map(self, capacity: int):
+        """(Re)open the memory-mapped files with room for capacity rows."""
+        self.capacity = capacity
+        self.vectors = self._memmap("vectors.bin", self.dtype, (capacity, self.dim))
+        self.live = self._memmap("live.bin", np.bool_, (capacity,))
+        self.partitions = self._memmap("partitions.bin", np.int32, (capacity,))
+        if self.dtype == "int8":
+            self.scales = self._memmap("scales.bin", np.float32, (capacity,))
+
+    def _encode(self, embeddings: np.ndarray) -> tuple:
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings / np.maximum(norms, 1e-12)
+        if self.dtype == "float16":
+            return embeddings.astype(np.float16), None
+        scales = np.abs(embeddings).max(axis=1) / 127.0
+        scales = np.maximum(scales, 1e-12).astype(np.float32)
+        quantized = np.round(embeddings / scales[:, None]).astype(np.int8)
+        return quantized, scales
+
+    def _assign_partitions(self, embeddings: np.ndarray) -> np.ndarray:
+        if self.centroids is None:
+            return np.zeros(len(embeddings), dtype=np.int32)
+        return np.argmax(embeddings.astype(np.float32) @ self.centroids.T, axis=1).astype(np.int32)
+
+    def add(
+        self,
+        embeddings: np.ndarray,
+        texts: List[str],
+        metadatas: Optional[List[dict]] = None,
+        doc_ids: Optional[List[str]] = None
+    ) -> List[int]:
+        """Append embeddings along with their chunk text and metadata."""
+        total = len(texts)
+        if total == 0:
+            return []
+        metadatas = metadatas or [{} for _ in range(total)]
+        doc_ids = doc_ids or [None] * total
+        vectors, scales = self._encode(embeddings)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Expected embeddings of dimension {self.dim}, got {vectors.shape[1]}")
+            start = self.count
+            end = start + total
+            if end > self.capacity:
+                self._map(max(end, self.capacity + self.growth, self.capacity * 2))
+            self.vectors[start:end] = vectors
+            if scales is not None:
+                self.scales[start:end] = scales
+            self.partitions[start:end] = self._assign_partitions(vectors)
+            self.live[start:end] = True
+            rows = list(range(start, end))
+            self.db.executemany(
+                "INSERT INTO records (row, doc_id, text, metadata) VALUES (?, ?, ?, ?)",
+                [
+                    (row, doc_id, text, json.dumps(metadata))
+                    for row, doc_id, text, metadata in zip(rows, doc_ids, texts, metadatas)
+                ]
+            )
+            self.count = end
+            self.version += 1
+            return rows
+
+    def delete(self, doc_ids: List[str]) -> int:
+        """Remove every chunk belonging to the given documents."""
+        if not doc_ids:
+            return 0
+        with self._lock:
+            rows = []
+            for doc_id in doc_ids:
+                rows.extend(
+                    row for row, in self.db.execute("SELECT row FROM records WHERE doc_id = ?", (doc_id,))
+                )
+            if rows:
+                self.live[np.asarray(rows, dtype=np.int64)] = False
+                self.db.executemany("DELETE FROM records WHERE row = ?", [(row,) for row in rows])
+                self.version += 1
+            return len(rows)
+
+    def _rows_matching(self, filters: Dict[str, object]) -> np.ndarray:
+        clauses = " AND ".join("json_extract(metadata, ?) = ?" for _ in filters)
+        params = []
+        for key, value in filters.items():
+            params.extend([f"$.{key}", value])
+        rows = [row for row, in self.db.execute(f"SELECT row FROM records WHERE {clauses}", params)]
+        return np.asarray(rows, dtype=np.int64)
+
+    def _score(self, rows, query: np.ndarray) -> np.ndarray:
+        vectors = self.vectors[rows]
+        scores = vectors.astype(np.float32) @ query
+        if self.scales is not None:
+            scores *= self.scales[rows]
+        return scores
+
+    def _top_k(self, scores: np.ndarray, rows: np.ndarray, top_k: int) -> tuple:
+        if len(scores) > top_k:
+            keep = np.argpartition(-scores, top_k - 1)[:top_k]
+            return scores[keep], rows[keep]
+        return scores, rows
+
+    def search(
+        self,
+        query_embedding: np.ndarray,
+        top_k: int = 5,
+        filters: Optional[Dict[str, object]] = None,
+        n_probe: Optional[int] = None
+    ) -> List[dict]:
+        """
+        Return the top_k chunks most similar to the query embedding.
+
+        :param filters: metadata key/value pairs which every result must match
+        :param n_probe: number of partitions to scan when the index is partitioned
+        """
+        query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        with self._lock:
+            if self.count == 0:
+                return []
+            candidates = None
+            if filters:
+                candidates = self._rows_matching(filters)
+            if self.is_partitioned:
+                n_probe = min(n_probe or self.n_probe, len(self.centroids))
+                probe = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+                if candidates is None:
+                    candidates = np.flatnonzero(np.isin(self.partitions[:self.count], probe))
+                else:
+                    candidates = candidates[np.isin(self.partitions[candidates], probe)]
+
+            best_scores = np.empty(0, dtype=np.float32)
+            best_rows = np.empty(0, dtype=np.int64)
+            if candidates is None:
+                blocks = (
+                    np.arange(start, min(start + self.block_size, self.count))
+                    for start in range(0, self.count, self.block_size)
+                )
+            else:
+                blocks = (
+                    candidates[start:start + self.block_size]
+                    for start in range(0, len(candidates), self.block_size)
+                )
+            for rows in blocks:
+                rows = rows[self.live[rows]]
+                if len(rows) == 0:
+                    continue
+                scores, rows = self._top_k(self._score(rows, query), rows, top_k)
+                best_scores, best_rows = self._top_k(
+                    np.concatenate([best_scores, scores]),
+                    np.concatenate([best_rows, rows]),
+                    top_k
+                )
+            order = np.argsort(-best_scores)
+            return [
+                self.record(int(best_rows[i]), float(best_scores[i]))
+                for i in order
+            ]
+
+    def record(self, row: int, score: float = 0.0) -> dict:
+        doc_id, text, metadata = self.db.execute(
+            "SELECT doc_id, text, metadata FROM records WHERE row = ?", (row,)
+        ).fetchone()
+        return {
+            "row": row,
+            "score": score,
+            "doc_id": doc_id,
+            "text": text,
+            "metadata": json.loads(metadata),
+        }
+
+    def train_partitions(self, n_lists: int, iterations: int = 10, sample_size: int = 65536, seed: int = 0):
+        """Cluster the stored vectors with k-means and assign every row to a partition."""
+        with self._lock:
+            live_rows = np.flatnonzero(self.live[:self.count])
+            if len(live_rows) < n_lists:
+                logger.warning(f"Not enough vectors to train {n_lists} partitions")
+                return
+            rng = np.random.default_rng(seed)
+            sample_rows = np.sort(rng.choice(live_rows, size=min(sample_size, len(live_rows)), replace=False))
+            sample = self._decode(sample_rows)
+            centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)]
+            for _ in range(iterations):
+                assignments = np.argmax(sample @ centroids.T, axis=1)
+                for i in range(n_lists):
+                    members = sample[assignments == i]
+                    if len(members):
+                        centroid = members.mean(axis=0)
+                        centroids[i] = centroid / max(float(np.linalg.norm(centroid)), 1e-12)
+            self.centroids = centroids.astype(np.float32)
+            for start in range(0, self.count, self.block_size):
+                rows = np.arange(start, min(start + self.block_size, self.count))
+                self.partitions[rows] = self._assign_partitions(self._decode(rows))
+            np.save(self._file("centroids.npy"), self.centroids)
+            self.version += 1
+            self.save()
+
+    def _decode(self, rows: np.ndarray) -> np.ndarray:
+        vectors = self.vectors[rows].astype(np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[rows][:, None]
+        return vectors
+
+    def close(self):
+        self.save()
+        self.db.close()
@@ -1,26 +1,141 @@
 """
 Wrapper functions for logging
+
+Records are handed to a background thread through a bounded queue, so a
+log call costs the caller a put and never waits on the terminal. Each line
+carries the request and connection it was logged for, set with
+log_context() by the thread handling them.
 """
+import atexit
+import contextlib
+import contextvars
+import json
 import logging
+import logging.handlers
+import queue
+import threading
+import time
+from typing import Callable, Optional, Union
+
+from airunner_nexus import settings
+
+request_id = contextvars.ContextVar("request_id", default=None)
+connection_id = contextvars.ContextVar("connection_id", default=None)
+
+
+@contextlib.contextmanager
+def log_context(request: Optional[Union[int, str]] = None, connection: Optional[int] = None):
+    """Attach a request id and connection id to everything this thread logs inside the block."""
+    request_token = request_id.set(request)
+    connection_token = connection_id.set(connection)
+    try:
+        yield
+    finally:
+        request_id.reset(request_token)
+        connection_id.reset(connection_token)
+
+
+class ContextFilter(logging.Filter):
+    """Copy the log context onto records in the thread which logs them, before they are queued."""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        record.connection_id = connection_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            "time": round(record.created, 6),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+            "module": record.module,
+            "line": record.lineno,
+        }
+        if record.request_id is not None:
+            line["request_id"] = record.request_id
+        if record.connection_id is not None:
+            line["connection_id"] = record.connection_id
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Drop records instead of blocking when the logging thread falls behind."""
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RateLimiter:
+    """A token bucket per key, refilled at rate per second up to burst."""
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+        return allowed
 
 
 class Logger:
     def __init__(self):
         self.logger = logging.getLogger()
-        self.logger.setLevel(logging.DEBUG)
+        self.logger.setLevel(settings.LOG_LEVEL)
         self.stream_handler = logging.StreamHandler()
-        self.stream_handler.setLevel(logging.DEBUG)
-        self.formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s - %(lineno)d")
+        self.stream_handler.setLevel(settings.LOG_LEVEL)
+        if settings.LOG_FORMAT == "json":
+            self.formatter = JsonFormatter()
+        else:
+            self.formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s - %(lineno)d")
         self.stream_handler.setFormatter(self.formatter)
-        self.logger.addHandler(self.stream_handler)
+        self.queue_handler = DroppingQueueHandler(queue.Queue(settings.LOG_QUEUE_SIZE))
+        self.queue_handler.addFilter(ContextFilter())
+        self.logger.addHandler(self.queue_handler)
+        self.listener = logging.handlers.QueueListener(self.queue_handler.queue, self.stream_handler)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+        self.rate_limiter = RateLimiter(settings.LOG_DEBUG_RATE, settings.LOG_DEBUG_BURST)
+
+    @property
+    def dropped(self) -> int:
+        """Records dropped because the queue was full."""
+        return self.queue_handler.dropped
 
     def debug(self, msg):
         """
-        Log info message
+        Log debug message
         :param msg:
         :return: None
         """
-        self.logger.debug(msg)
+        self.logger.debug(msg, stacklevel=2)
+
+    def debug_limited(self, key: str, msg: Union[str, Callable[[], str]]):
+        """
+        Log a debug message from a hot path, such as once per token, at
+        most settings.LOG_DEBUG_RATE times a second per key.
+        :param msg: the message, or a function returning it so that
+            nothing is formatted for messages which are not logged
+        :return: None
+        """
+        if not self.logger.isEnabledFor(logging.DEBUG) or not self.rate_limiter.allow(key):
+            return
+        self.logger.debug(msg() if callable(msg) else msg, stacklevel=2)
 
     def info(self, msg):
         """
@@ -28,7 +143,7 @@ class Logger:
         :param msg:
         :return: None
         """
-        self.logger.info(msg)
+        self.logger.info(msg, stacklevel=2)
 
     def warning(self, msg):
         """
@@ -36,7 +151,7 @@ class Logger:
         :param msg:
         :return: None
         """
-        self.logger.warning(msg)
+        self.logger.warning(msg, stacklevel=2)
 
     def error(self, msg):
         """
@@ -44,7 +159,7 @@ class Logger:
         :param msg:
         :return: None
         """
-        self.logger.error(msg)
+        self.logger.error(msg, stacklevel=2)
 
 
 logger = Logger()
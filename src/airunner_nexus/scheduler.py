@@ -0,0 +1,259 @@
+"""
+Weighted fair scheduling of requests and decode steps.
+
+Every request belongs to a priority class and a tenant (the client
+connection unless the request names one). RequestQueue hands requests to
+the server's workers: classes share the workers in proportion to their
+weights, and tenants within a class take turns, so one client queueing long
+generations cannot starve the others. A connection is answered one request at
+a time, so its other requests stay queued until the running one is done
+instead of holding workers.
+
+DecodeScheduler then shares the model between generations which are running
+at the same time, one decode step at a time. A generation asks for its turn
+between steps; the step goes to the generation of the highest class which has
+used the fewest weighted steps, so long low priority generations pause while
+interactive ones decode.
+"""
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Optional
+
+from airunner_nexus import settings
+
+PRIORITY_CLASSES = ("interactive", "batch", "background")
+# Priority of requests which do not ask for one, by reqtype. Mood updates feed
+# the next turn of a conversation, so they run at the caller's priority.
+DEFAULT_PRIORITIES = {}
+
+
+def request_priority(data: dict) -> str:
+    priority = data.get("priority")
+    if priority in PRIORITY_CLASSES:
+        return priority
+    return DEFAULT_PRIORITIES.get(data.get("reqtype"), "interactive")
+
+
+def percentile(values: list, fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class ScheduledRequest:
+    """A queued message and when it was queued, started and first answered."""
+    _ids = itertools.count(1)
+
+    def __init__(self, connection, msg: bytes, priority: str, tenant: str):
+        self.id = next(ScheduledRequest._ids)
+        self.connection = connection
+        self.msg = msg
+        self.priority = priority
+        self.tenant = tenant
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.first_output_at = None
+        # Set by the server: the parsed message, and its trace if it is traced
+        self.data = None
+        self.trace = None
+
+    def mark_first_output(self):
+        if self.first_output_at is None:
+            self.first_output_at = time.monotonic()
+
+
+class LatencyStats:
+    """Recent queue wait, first output and total latency of each priority class."""
+    def __init__(self, window: int = settings.SCHEDULER_LATENCY_WINDOW):
+        self.window = window
+        self.samples = {
+            priority: {"wait": deque(maxlen=window), "first_output": deque(maxlen=window), "total": deque(maxlen=window)}
+            for priority in PRIORITY_CLASSES
+        }
+        self.completed = {priority: 0 for priority in PRIORITY_CLASSES}
+        self._lock = threading.Lock()
+
+    def record(self, request: ScheduledRequest):
+        finished_at = time.monotonic()
+        with self._lock:
+            samples = self.samples[request.priority]
+            samples["wait"].append((request.started_at or finished_at) - request.enqueued_at)
+            if request.first_output_at is not None:
+                samples["first_output"].append(request.first_output_at - request.enqueued_at)
+            samples["total"].append(finished_at - request.enqueued_at)
+            self.completed[request.priority] += 1
+
+    def report(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                priority: {
+                    "completed": self.completed[priority],
+                    **{
+                        f"{name}_{label}_ms": round(value * 1000, 2) if value is not None else None
+                        for name, values in samples.items()
+                        for label, value in (
+                            ("p50", percentile(list(values), 0.5)),
+                            ("p99", percentile(list(values), 0.99)),
+                        )
+                    },
+                }
+                for priority, samples in self.samples.items()
+            }
+
+
+class RequestQueue:
+    """
+    Replacement for a FIFO queue which picks the next request by weighted
+    fair queueing over priority classes and round robin over tenants.
+    """
+    def __init__(self, weights: Dict[str, float] = None):
+        self.weights = weights or settings.SCHEDULER_WEIGHTS
+        self.queues = {priority: OrderedDict() for priority in PRIORITY_CLASSES}
+        self.virtual_time = {priority: 0.0 for priority in PRIORITY_CLASSES}
+        self.size = 0
+        # Connections with a request being handled, whose other requests wait
+        self.busy = set()
+        self.latency = LatencyStats()
+        self._condition = threading.Condition()
+
+    def qsize(self) -> int:
+        return self.size
+
+    def put(self, request: ScheduledRequest):
+        with self._condition:
+            tenants = self.queues[request.priority]
+            if not tenants:
+                # A class which was idle starts level with the busy ones instead of catching up
+                busy = [self.virtual_time[priority] for priority in PRIORITY_CLASSES if self.queues[priority]]
+                self.virtual_time[request.priority] = max(self.virtual_time[request.priority], min(busy, default=0.0))
+            tenants.setdefault(request.tenant, deque()).append(request)
+            self.size += 1
+            self._condition.notify()
+
+    def _is_ready(self, request: ScheduledRequest) -> bool:
+        return request.connection is None or request.connection not in self.busy
+
+    def _next(self) -> Optional[tuple]:
+        """:return: the class, tenant and index of the next request which can run, if there is one"""
+        for priority in sorted(
+            (priority for priority in PRIORITY_CLASSES if self.queues[priority]),
+            key=lambda priority: (self.virtual_time[priority], PRIORITY_CLASSES.index(priority))
+        ):
+            for tenant, requests in self.queues[priority].items():
+                for index, request in enumerate(requests):
+                    if self._is_ready(request):
+                        return priority, tenant, index
+        return None
+
+    def get(self, timeout: Optional[float] = None) -> Optional[ScheduledRequest]:
+        """
+        :return: the next request, or None after waiting timeout seconds.
+        Call done with the request once it has been handled.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.size > 0 and self._next() is not None, timeout):
+                return None
+            priority, tenant, index = self._next()
+            self.virtual_time[priority] += 1 / self.weights.get(priority, 1)
+            tenants = self.queues[priority]
+            requests = tenants[tenant]
+            request = requests[index]
+            del requests[index]
+            # The tenant goes to the back of its class
+            del tenants[tenant]
+            if requests:
+                tenants[tenant] = requests
+            self.size -= 1
+            if request.connection is not None:
+                self.busy.add(request.connection)
+        request.started_at = time.monotonic()
+        return request
+
+    def has_requests(self, connection) -> bool:
+        """True if the connection has a request queued or being handled."""
+        with self._condition:
+            return connection in self.busy or any(
+                request.connection is connection
+                for tenants in self.queues.values()
+                for requests in tenants.values()
+                for request in requests
+            )
+
+    def done(self, request: ScheduledRequest):
+        """Let the next request of the request's connection run."""
+        with self._condition:
+            self.busy.discard(request.connection)
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            queued = {
+                priority: sum(len(requests) for requests in self.queues[priority].values())
+                for priority in PRIORITY_CLASSES
+            }
+        return {"queued": queued, "latency": self.latency.report()}
+
+
+class DecodeTicket:
+    _ids = itertools.count(1)
+
+    def __init__(self, priority: str, weight: float):
+        self.id = next(DecodeTicket._ids)
+        self.priority = priority
+        self.rank = PRIORITY_CLASSES.index(priority)
+        self.weight = weight
+        self.virtual_time = 0.0
+        self.steps = 0
+
+
+class DecodeScheduler:
+    """
+    Let one running generation decode at a time, choosing by weighted fair
+    sharing of steps. With preempt, lower classes wait for as long as a
+    higher class has a generation running.
+    """
+    def __init__(self, weights: Dict[str, float] = None, preempt: bool = settings.SCHEDULER_PREEMPT):
+        self.weights = weights or settings.SCHEDULER_WEIGHTS
+        self.preempt = preempt
+        self.active = {}
+        self.running = None
+        self._condition = threading.Condition()
+
+    def _order(self, ticket: DecodeTicket) -> tuple:
+        return (ticket.rank if self.preempt else 0, ticket.virtual_time, ticket.id)
+
+    def _is_next(self, ticket: DecodeTicket) -> bool:
+        return self.running is None and min(self.active.values(), key=self._order) is ticket
+
+    def ticket(self, priority: str) -> DecodeTicket:
+        return DecodeTicket(priority, self.weights.get(priority, 1))
+
+    def start(self, ticket: DecodeTicket):
+        """Register a generation and wait for its first turn. Does nothing if it has started."""
+        with self._condition:
+            if ticket.id in self.active:
+                return
+            ticket.virtual_time = min((other.virtual_time for other in self.active.values()), default=0.0)
+            self.active[ticket.id] = ticket
+            self._condition.wait_for(lambda: self._is_next(ticket))
+            self.running = ticket
+
+    def step(self, ticket: DecodeTicket):
+        """Called between decode steps: give up the model and wait for the next turn."""
+        with self._condition:
+            ticket.steps += 1
+            ticket.virtual_time += 1 / ticket.weight
+            self.running = None
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: self._is_next(ticket))
+            self.running = ticket
+
+    def finish(self, ticket: DecodeTicket):
+        with self._condition:
+            self.active.pop(ticket.id, None)
+            if self.running is ticket:
+                self.running = None
+            self._condition.notify_all()
@@ -1,17 +1,33 @@
+import argparse
+import base64
 import json
+import os
 import re
 import signal
 import socket
 import threading
 import time
-import queue
 from typing import Optional
 
 from airunner_nexus import settings
+from airunner_nexus.codec import ENCODING_JSON, available_encodings, decode
+from airunner_nexus.connection import Connection
+from airunner_nexus.enums import FrameType
+from airunner_nexus.frames import AUDIO_HEADER, EMBEDDING_DTYPE, EMBEDDING_HEADER, PROTOCOL_FRAMES, PROTOCOL_PACKETS
+from airunner_nexus.llm.action_router import ActionRouter
+from airunner_nexus.llm.embedding_batcher import EmbeddingBatcher
+from airunner_nexus.llm.embedding_handler import EmbeddingHandler
+from airunner_nexus.llm.fake_llm_handler import FakeLLMHandler
 from airunner_nexus.llm.llm_handler import LLMHandler
-from airunner_nexus.logger import logger
-from airunner_nexus.exceptions import FailedToSendError, NoConnectionToClientError
-import airunner_nexus.messagecodes as codes
+from airunner_nexus.llm.mood_scorer import MoodScorer
+from airunner_nexus.llm.replica_pool import ReplicaPool
+from airunner_nexus.llm.request_coalescer import RequestCoalescer
+from airunner_nexus.logger import log_context, logger
+from airunner_nexus.scheduler import DecodeScheduler, RequestQueue, ScheduledRequest, request_priority
+from airunner_nexus.tracing import Tracer, current_trace, span
+from airunner_nexus.tts.tts_pipeline import TTSPipeline, TTSStream, load_synthesizer
+from airunner_nexus.exceptions import FailedToSendError, GenerationError, MemoryBudgetError, NoConnectionToClientError, \
+    ProtocolError
 
 
 class Server:
@@ -23,23 +39,67 @@ class Server:
         self.max_client_connections = kwargs.get("max_client_connections", 1)
         self.model_base_path = kwargs.get("model_base_path", ".")
         self.do_timeout = kwargs.get("do_timeout", False)
+        self.worker_threads = kwargs.get("worker_threads", settings.WORKER_THREADS)
+        self.unix_socket_path = kwargs.get("unix_socket_path", settings.UNIX_SOCKET_PATH)
+        self.shm_ring_size = kwargs.get("shm_ring_size", settings.SHM_RING_SIZE)
+        self.shm_threshold = kwargs.get("shm_threshold", settings.SHM_THRESHOLD)
+        self.engine = kwargs.get("engine", settings.LLM_ENGINE)
+        self.replicas = kwargs.get("replicas", settings.LLM_REPLICAS)
+        self.replica_devices = kwargs.get("replica_devices", settings.REPLICA_DEVICES)
+        self.decode_scheduling = kwargs.get("decode_scheduling", settings.DECODE_SCHEDULING)
+        self.tts_model = kwargs.get("tts_model", settings.TTS_MODEL)
+        self.tts_workers = kwargs.get("tts_workers", settings.TTS_WORKERS)
 
         self.soc = None
-        self.soc_connection = None
-        self.soc_addr = None
+        self.unix_soc = None
+        self.connections = {}
         self.threads = []
-        self.queue = queue.SimpleQueue()
+        self.queue = RequestQueue(kwargs.get("scheduler_weights", settings.SCHEDULER_WEIGHTS))
+        self.decode_scheduler = None
+        self.request_context = threading.local()
+        self.tracer = Tracer(
+            kwargs.get("tracing", settings.TRACING),
+            kwargs.get("trace_threshold_ms", settings.TRACE_THRESHOLD_MS)
+        )
         self.quit_event = threading.Event()
-        self.has_connection = False
-        self.llm_handler = LLMHandler()
+        self.replica_pool = None
+        self.llm_handler = None
+        self.load_llm()
+        self.llm_lock = threading.Lock()
+        self.coalescer = RequestCoalescer()
+        # Workers load the models below on first use
+        self.models_lock = threading.RLock()
+        self._embedding_handler = None
+        self._embedding_batcher = None
+        self._action_router = None
+        self._mood_scorer = None
+        self._tts_pipeline = None
         self.message = None
+        if kwargs.get("preload_mood_scorer", settings.PRELOAD_MOOD_SCORER):
+            # In the background, so the server accepts connections meanwhile; first users wait on models_lock
+            self.start_thread(target=self.preload_mood_scorer, daemon=True, name="preload mood scorer")
 
         self.initialize_socket()
         self.start()
         signal.signal(signal.SIGINT, self.quit_event.set)  # handle ctrl+c
-        self.start_thread(target=self.worker, name="socket server worker")
+        for index in range(self.worker_threads):
+            self.start_thread(target=self.worker, name=f"socket server worker {index}")
         self.start_thread(target=self.watch_connection, name="watch connection")
 
+    def load_llm(self):
+        """Load the model in this process, or start replicas of it in worker processes."""
+        if self.replicas:
+            # Keep enough workers busy to feed every replica
+            self.worker_threads = max(self.worker_threads, self.replicas)
+            self.replica_pool = ReplicaPool(self.replicas, self.replica_devices, engine=self.engine)
+        elif self.engine == "fake":
+            self.llm_handler = FakeLLMHandler()
+        else:
+            self.llm_handler = LLMHandler()
+        if self.llm_handler is not None and self.decode_scheduling:
+            self.decode_scheduler = DecodeScheduler()
+            self.llm_handler.decode_scheduler = self.decode_scheduler
+
     @property
     def message(self) -> str:
         """Does nothing. Only used for the setter."""
@@ -47,8 +107,81 @@ class Server:
 
     @message.setter
     def message(self, msg: bytes):
-        """Place incoming messages onto the queue."""
-        self.queue.put(msg)
+        """Place incoming messages which are not tied to a client onto the queue."""
+        self.enqueue(None, msg)
+
+    def enqueue(self, connection: Optional[Connection], msg: Optional[bytes]):
+        """Queue a message under its priority class and tenant."""
+        parse_started_at = time.monotonic()
+        data = self.parse_request_data(msg, connection.encoding if connection is not None else ENCODING_JSON) if msg else {}
+        if data.get("reqtype") == "health" and connection is not None and not self.queue.has_requests(connection):
+            # Answered straight away, so a backend busy with generations still passes health checks
+            connection.message_client(self.health_status())
+            return
+        tenant = data.get("tenant") or (f"connection-{connection.id}" if connection is not None else "server")
+        request = ScheduledRequest(connection, msg, request_priority(data), str(tenant))
+        request.data = data
+        request.trace = self.tracer.start(request.id, data)
+        if request.trace is not None:
+            if connection is not None and connection.receive_started_at is not None:
+                request.trace.add("receive", connection.receive_started_at, parse_started_at)
+            request.trace.add("parse_request_data", parse_started_at, request.enqueued_at)
+        self.queue.put(request)
+
+    def health_status(self) -> dict:
+        return {
+            "status": "ok",
+            "connections": len(self.connections),
+            "queued": self.queue.qsize(),
+        }
+
+    def mark_first_output(self):
+        """Record that the request handled by this worker has sent its first output."""
+        request = getattr(self.request_context, "request", None)
+        if request is not None:
+            request.mark_first_output()
+
+    @property
+    def has_connection(self) -> bool:
+        return len(self.connections) > 0
+
+    @property
+    def embedding_handler(self) -> EmbeddingHandler:
+        with self.models_lock:
+            if self._embedding_handler is None:
+                self._embedding_handler = EmbeddingHandler()
+        return self._embedding_handler
+
+    @property
+    def embedding_batcher(self) -> EmbeddingBatcher:
+        with self.models_lock:
+            if self._embedding_batcher is None:
+                self._embedding_batcher = EmbeddingBatcher(self.embedding_handler.embed)
+        return self._embedding_batcher
+
+    @property
+    def action_router(self) -> ActionRouter:
+        with self.models_lock:
+            if self._action_router is None:
+                self._action_router = ActionRouter(
+                    self.embedding_handler.embed,
+                    fallback=self.classify_action
+                )
+        return self._action_router
+
+    @property
+    def mood_scorer(self) -> MoodScorer:
+        with self.models_lock:
+            if self._mood_scorer is None:
+                self._mood_scorer = MoodScorer(self.embedding_handler.embed)
+        return self._mood_scorer
+
+    @property
+    def tts_pipeline(self) -> TTSPipeline:
+        with self.models_lock:
+            if self._tts_pipeline is None:
+                self._tts_pipeline = TTSPipeline(load_synthesizer(self.tts_model), self.tts_workers)
+        return self._tts_pipeline
 
     @property
     def signal_byte_size(self) -> int:
@@ -63,42 +196,60 @@ class Server:
         return re.search(r'```' + language + '(.*?)```', res, re.DOTALL)
 
     @staticmethod
-    def parse_request_data(incoming_data: bytes) -> dict:
-        """Parse incoming bytes from the client."""
+    def parse_request_data(incoming_data: bytes, encoding: str = ENCODING_JSON) -> dict:
+        """Parse incoming bytes from the client: UTF-8 JSON, or MessagePack if the connection negotiated it."""
         try:
-            data = incoming_data.decode("ascii")
+            data = decode(incoming_data, encoding)
         except UnicodeDecodeError as err:
             logger.error("something went wrong with a request from the client")
             logger.error(f"UnicodeDecodeError: {err}")
             return {}
-
-        try:
-            data = json.loads(data)
-        except json.decoder.JSONDecodeError:
+        except ValueError:
+            logger.error("Improperly formatted request from client")
+            return {}
+        if not isinstance(data, dict):
             logger.error("Improperly formatted request from client")
             return {}
 
         return data
 
+    def request_data(self, msg: bytes, connection: Optional[Connection]) -> dict:
+        """Parse a request, reusing what enqueue parsed when it is the one this worker is handling."""
+        request = getattr(self.request_context, "request", None)
+        if request is not None and request.msg is msg and request.data is not None:
+            return request.data
+        return self.parse_request_data(msg, connection.encoding if connection is not None else ENCODING_JSON)
+
     def worker(self):
         """Start a worker to handle request queue."""
         logger.info("Enqueue worker started")
         while not self.quit_event.is_set():
-            if self.has_connection:
+            request = self.queue.get(timeout=1)  # get the next message by priority and tenant
+            if request is None:
+                continue
+            connection, msg = request.connection, request.msg
+            if msg is None or (connection is not None and not connection.is_open):
+                self.queue.done(request)
+                continue
+            self.request_context.request = request
+            trace_token = current_trace.set(request.trace)
+            if request.trace is not None:
+                request.trace.add("queue", request.enqueued_at, request.started_at, priority=request.priority)
+            with log_context(request.id, connection.id if connection is not None else None):
+                logger.debug(f"Received {request.priority} message from queue")
                 try:
-                    msg = self.queue.get(timeout=1)  # get a message from the queue
-                    if msg is not None:
-                        logger.info("Received message from queue")
-                        try:
-                            self.handle_message(msg)
-                        except Exception as err:
-                            logger.info(f"callback error: {err}")
-                            raise err
-                except queue.Empty:
-                    pass
-            if self.quit_event.is_set():
-                break
-            time.sleep(1)
+                    # The queue hands out one request per connection at a time, so responses don't interleave
+                    with span("handle_message"):
+                        self.handle_message(msg, connection)
+                except Exception as err:
+                    logger.error(f"callback error: {err}")
+                finally:
+                    self.queue.done(request)
+                    self.request_context.request = None
+                    self.queue.latency.record(request)
+                    current_trace.reset(trace_token)
+                    if request.trace is not None:
+                        self.tracer.finish(request.trace)
         logger.info("SERVER WORKER: worker stopped")
 
     def start(self):
@@ -119,6 +270,12 @@ class Server:
                 logger.info(f"Thread {thread.name} not running")
             logger.info(f"Stopped thread {thread.name}...")
         logger.info("All threads stopped")
+        logger.info(f"Scheduler stats: {json.dumps(self.queue.stats())}")
+        if self.replica_pool is not None:
+            self.replica_pool.close()
+        if self._tts_pipeline is not None:
+            logger.info(f"Text to speech stats: {json.dumps(self._tts_pipeline.stats())}")
+            self._tts_pipeline.close()
         self.quit_event.set()
 
     def start_thread(self, target: Optional, daemon: bool = False, name: str = None) -> threading.Thread:
@@ -137,10 +294,21 @@ class Server:
 
     def disconnect(self):
         """Disconnect from socket."""
-        if self.soc_connection:
-            self.soc_connection.close()
+        for connection in list(self.connections.values()):
+            self.close_connection(connection)
         self.soc.close()
-        self.soc_connection = None
+        if self.unix_soc is not None:
+            self.unix_soc.close()
+            self.unix_soc = None
+            try:
+                os.unlink(os.path.expanduser(self.unix_socket_path))
+            except OSError:
+                pass
+
+    def close_connection(self, connection: Connection):
+        connection.close()
+        self.connections.pop(connection.id, None)
+        logger.info(f"Connection with client {connection.address} closed")
 
     def reconnect(self):
         """Disconnects then reconnects to service. Does not stop the thread."""
@@ -156,21 +324,52 @@ class Server:
         """Reset connection to service."""
         self.disconnect()
         self.initialize_socket()
-        self.has_connection = False
         self.open_socket()
         self.listen_to_socket()
 
-    def handle_message(self, msg: bytes):
+    def handle_message(self, msg: bytes, connection: Optional[Connection] = None):
         """Override this method or pass it in as a parameter to handle messages."""
-        data = self.parse_request_data(msg)
-        self.query_llm(data)
+        data = self.request_data(msg, connection)
+        reqtype = data.get("reqtype")
+        if reqtype == "route_action":
+            self.message_client(self.action_router.route(data.get("prompt", "")), connection)
+        elif reqtype == "embed":
+            self.embed(data, connection)
+        elif reqtype == "health":
+            self.message_client(self.health_status(), connection)
+        elif reqtype == "scheduler_stats":
+            self.message_client(self.queue.stats(), connection)
+        elif reqtype == "replica_stats":
+            self.message_client({
+                "replicas": self.replica_pool.stats() if self.replica_pool is not None else []
+            }, connection)
+        elif reqtype == "dump_trace":
+            self.message_client(self.tracer.dump(data.get("request_id")), connection)
+        elif reqtype == "tts_stats":
+            self.message_client(self._tts_pipeline.stats() if self._tts_pipeline is not None else {}, connection)
+        elif reqtype == "memory_stats":
+            memory_budget = getattr(self.llm_handler, "memory_budget", None)
+            self.message_client(memory_budget.stats() if memory_budget is not None else {}, connection)
+        elif reqtype == "decode_stats":
+            decode_stats = getattr(self.llm_handler, "decode_stats", None)
+            self.message_client(decode_stats() if decode_stats is not None else {}, connection)
+        elif reqtype == "update_mood":
+            self.update_mood(data, connection)
+        else:
+            try:
+                self.query_llm(data, connection)
+            except MemoryBudgetError as err:
+                logger.error(f"Rejected request: {err}")
+                self.send_error(str(err), connection)
+            except GenerationError as err:
+                self.send_error(str(err), connection)
 
     def open_socket(self):
         """Open a socket connection."""
         try:
             self.soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.soc.settimeout(1)
-            self.soc.bind(("", 50006))
+            self.soc.bind((self.host, self.port))
         except socket.error as err:
             logger.info(f"Failed to open a socket at {self.host}:{self.port}")
             logger.info(str(err))
@@ -178,63 +377,93 @@ class Server:
             logger.error(f"Failed to open a socket at {self.host}:{self.port}")
             logger.error(_exc)
         logger.info(f"Socket opened {self.soc}")
+        if self.unix_socket_path:
+            self.open_unix_socket()
+
+    def open_unix_socket(self):
+        """Open a Unix domain socket for clients on the same machine."""
+        path = os.path.expanduser(self.unix_socket_path)
+        try:
+            if os.path.exists(path):
+                os.unlink(path)
+            self.unix_soc = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.unix_soc.settimeout(3)
+            self.unix_soc.bind(path)
+        except (AttributeError, OSError) as err:
+            logger.error(f"Failed to open a Unix socket at {path}: {err}")
+            self.unix_soc = None
+            return
+        logger.info(f"Socket opened {self.unix_soc}")
 
     def listen_to_socket(self):
         """Listen to socket for connections."""
         self.soc.listen(self.max_clients)
         logger.info(f"Listening for connections on {self.host}:{self.port}")
+        if self.unix_soc is not None:
+            self.unix_soc.listen(self.max_clients)
+            logger.info(f"Listening for connections on {self.unix_socket_path}")
 
     def try_quit(self) -> bool:
         """Try to quit the thread."""
         if self.quit_event.is_set():
-            self.queue.put(b"quit")
-            if self.soc_connection:
-                self.soc_connection.close()
-                self.soc_connection = None
-            if self.queue:
-                self.queue.put("quit")
+            for connection in list(self.connections.values()):
+                self.close_connection(connection)
+            for _ in range(self.worker_threads):
+                self.enqueue(None, None)
             return True
         return False
 
-    def do_send(self, msg: bytes) -> int:
+    @staticmethod
+    def do_send(msg: bytes, connection: Optional[Connection]) -> int:
         """Send a message to the client."""
-        size_in_bytes = len(msg)
-        bytes_sent = 0
-        if not self.soc_connection:
+        if connection is None:
             logger.error("No connection to client")
-        else:
-            try:
-                bytes_sent = self.soc_connection.send(msg)
-            except Exception as e:
-                logger.error("something went wrong")
-                logger.error(e)
-            if bytes_sent != size_in_bytes:
-                logger.error("Failed to send all bytes")
-        return bytes_sent
+            return 0
+        return connection.do_send(msg)
 
-    def message_client(self, message: dict):
+    @staticmethod
+    def message_client(message: dict, connection: Optional[Connection]):
         """Convenience method to send a message to the client."""
-        message = json.dumps(message).encode()
-        self.send_message(message)
-        self.send_end_message()
+        if connection is None:
+            logger.error("No connection to client")
+            return
+        connection.message_client(message)
 
-    def send_message(self, message: bytes):
+    @staticmethod
+    def send_message(message: bytes, connection: Optional[Connection]):
         """Send a message to the client in byte packets."""
-        packet_size = self.packet_size
-        for i in range(0, len(message), packet_size):
-            packet = message[i:i + packet_size]
-            self.do_send(packet + b'\x00' * (packet_size - len(packet)))
+        if connection is None:
+            logger.error("No connection to client")
+            return
+        with span("send_message", bytes=len(message)):
+            connection.send_message(message)
 
-    def send_end_message(self):
-        """Send a message of all zeroes of expected_byte_size length to indicate that the image is being sent."""
-        self.do_send(b'\x00' * self.packet_size)
+    @staticmethod
+    def send_end_message(connection: Optional[Connection]):
+        """Send a message of all zeroes of expected_byte_size length to indicate the end of a message."""
+        if connection is None:
+            logger.error("No connection to client")
+            return
+        connection.send_end_message()
 
-    def send_msg(self, msg: Optional[bytes] = None) -> int:
+    @staticmethod
+    def send_error(message: str, connection: Optional[Connection]):
+        """End a response with an error: an error frame for framed clients, a JSON error otherwise."""
+        if connection is None:
+            logger.error("No connection to client")
+            return
+        if connection.uses_frames:
+            connection.send_frame(FrameType.ERROR, message.encode(), flush=False)
+            connection.send_end_message()
+            return
+        connection.message_client({"error": message})
+
+    def send_msg(self, msg: Optional[bytes] = None, connection: Optional[Connection] = None) -> int:
         """Send a message to the client."""
         success = False
         bytes_sent = 0
         try:
-            bytes_sent = self.do_send(msg)
+            bytes_sent = self.do_send(msg, connection)
             success = True
         except FailedToSendError:
             logger.error("failed to send connection to client")
@@ -242,7 +471,7 @@ class Server:
             logger.error("Lost connection to client")
         if not success:
             logger.error("failed to send message, adding back to queue")
-            self.message = msg
+            self.enqueue(connection, msg)
         return bytes_sent
 
     def is_expected_message(self, packet: bytes, byte: bytes) -> bool:
@@ -257,12 +486,9 @@ class Server:
     def handle_quit_message(self):
         logger.info("Quit")
         self.quit_event.set()
-        self.message = None
-        self.queue.put(b"quit")
 
     def handle_cancel_message(self):
         logger.info("Cancel image")
-        self.message = None
         self.cancel()
 
     def handle_model_switch_message(self, model: str):
@@ -275,84 +501,134 @@ class Server:
             "model": model
         }).encode()
 
-    def get_packet(self) -> bytes:
-        return self.soc_connection.recv(self.signal_byte_size)
-
     def handle_open_socket(self):
-        """Listen for incoming connections."""
+        """Listen for incoming connections and start a receive thread for each."""
         self.listen_to_socket()
-        current_state = codes.AWAITING_CONNECTION
         logger.info("Waiting for connections")
-        self.soc.settimeout(3)
+        if self.unix_soc is not None:
+            threading.Thread(
+                target=self.accept_connections,
+                args=(self.unix_soc,),
+                daemon=True,
+                name="unix socket listener"
+            ).start()
+        self.accept_connections(self.soc, self.do_timeout)
+        logger.info("server stopped")
+        self.stop()
+
+    def accept_connections(self, listener: socket.socket, do_timeout: bool = False):
+        """Accept connections on a listening socket until the server quits."""
+        listener.settimeout(3)
         total_timeouts = 0
         while not self.quit_event.is_set():
-            if current_state is codes.AWAITING_CONNECTION:
-                try:
-                    if not self.quit_event.is_set():
-                        self.soc_connection, self.soc_addr = self.soc.accept()
-                    if self.soc_connection:
-                        total_timeouts = 0
-                        self.has_connection = True
-                        current_state = codes.AWAITING_MESSAGE
-                        logger.info(f"connected with {self.soc_addr}")
-                except socket.timeout:
-                    total_timeouts += 1
-                    if total_timeouts >= 3 and self.do_timeout:
-                        self.quit_event.set()
-                        break
-                except Exception as exc:
-                    logger.error(exc)
-
-            if current_state is codes.AWAITING_MESSAGE:
-                msg = None
+            try:
+                soc_connection, soc_addr = listener.accept()
+            except socket.timeout:
+                total_timeouts += 1
+                if total_timeouts >= 3 and do_timeout and not self.has_connection:
+                    self.quit_event.set()
+                    break
+                continue
+            except OSError as exc:
+                if listener.fileno() == -1:
+                    break
+                logger.error(exc)
+                continue
+            except Exception as exc:
+                logger.error(exc)
+                continue
+            total_timeouts = 0
+            soc_connection.settimeout(None)
+            connection = Connection(soc_connection, soc_addr or listener.getsockname(), self.packet_size)
+            self.connections[connection.id] = connection
+            logger.info(f"connected with {connection.address}")
+            threading.Thread(
+                target=self.handle_connection,
+                args=(connection,),
+                daemon=True,
+                name=f"connection {connection.id}"
+            ).start()
+
+    def handle_connection(self, connection: Connection):
+        """Read messages from a client and push them onto the queue until it disconnects."""
+        with log_context(connection=connection.id):
+            while not self.quit_event.is_set() and connection.is_open:
                 try:
-                    packets = []
-                    while True:
-                        packet = self.get_packet()
-                        if packet == b'\x00' * self.packet_size:
-                            break
-                        packet = packet.strip(b'\x00')
-                        if packet == b'':
-                            raise RuntimeError("socket connection broken")
-                        if self.is_quit_message(packet):
-                            self.handle_quit_message()
-                            break
-                        if self.is_cancel_message(packet):
-                            self.handle_cancel_message()
-                            break
-                        if packet != b'':
-                            packets.append(packet)
-                    msg = b''.join(packets)
-                except socket.timeout:
-                    pass
-                except AttributeError:
-                    logger.error("attribute error")
-                except ConnectionResetError:
-                    logger.error("connection reset error")
-                    current_state = codes.AWAITING_CONNECTION
-                except Exception as exc:
-                    logger.error(exc)
-                    current_state = codes.AWAITING_CONNECTION
-
-                if msg is not None and msg != b'':
-                    logger.info("message received")
-                    self.message = msg  # push directly to queue
-                    self.soc_connection.settimeout(None)
-                    current_state = codes.AWAITING_MESSAGE
-                else:
-                    if not self.soc_connection:
-                        logger.error("connection lost, invalid soc_connection")
-                        current_state = codes.AWAITING_CONNECTION
-                    if current_state == codes.AWAITING_CONNECTION:
-                        logger.info("Connection with client lost")
-                        logger.info("resetting socket")
-                        self.reset_connection()
-
-            if self.quit_event.is_set():
+                    msg = self.receive_message(connection)
+                except (OSError, RuntimeError) as exc:
+                    logger.error(f"Connection with client lost: {exc}")
+                    break
+                except ProtocolError as exc:
+                    logger.error(f"Closing connection with client {connection.address}: {exc}")
+                    break
+                if msg and self.is_hello_message(msg, connection):
+                    continue
+                if msg:
+                    logger.debug("message received")
+                    self.enqueue(connection, msg)
+            self.close_connection(connection)
+
+    def is_hello_message(self, msg: bytes, connection: Connection) -> bool:
+        """
+        Handle protocol negotiation on the receiving thread so that the next
+        message is already read with the negotiated protocol.
+        """
+        if connection.uses_frames or len(msg) >= self.packet_size:
+            return False
+        data = self.parse_request_data(msg)
+        if data.get("reqtype") != "hello":
+            return False
+        protocol = data.get("protocol")
+        if protocol not in (PROTOCOL_PACKETS, PROTOCOL_FRAMES):
+            protocol = PROTOCOL_PACKETS
+        reply = {"protocol": protocol}
+        if data.get("shm") and protocol == PROTOCOL_FRAMES and connection.is_local:
+            try:
+                reply["shm"] = connection.attach_rings(self.shm_ring_size, self.shm_threshold)
+            except OSError as err:
+                logger.error(f"Failed to create shared memory for client {connection.address}: {err}")
+        # Binary encodings need frames, packets are null padded
+        encoding = data.get("encoding")
+        if protocol != PROTOCOL_FRAMES or encoding not in available_encodings():
+            encoding = ENCODING_JSON
+        reply["encoding"] = encoding
+        connection.message_client(reply)
+        connection.protocol = protocol
+        connection.encoding = encoding
+        logger.info(f"Client {connection.address} uses the {protocol} protocol with {encoding}")
+        return True
+
+    def receive_message(self, connection: Connection) -> Optional[bytes]:
+        """Read packets until the end message, or one frame. Returns None for control messages."""
+        if connection.uses_frames:
+            frame = connection.receive_frame()
+            if frame is None:
+                raise RuntimeError("socket connection broken")
+            frame_type, _flags, _stream_id, payload = frame
+            if frame_type is FrameType.QUIT:
+                self.handle_quit_message()
+            elif frame_type is FrameType.CANCEL:
+                self.handle_cancel_message()
+            elif frame_type is FrameType.REQUEST:
+                return payload
+            return None
+        packets = []
+        while True:
+            packet = connection.get_packet()
+            if packet == b'':
+                raise RuntimeError("socket connection broken")
+            if not packets:
+                connection.receive_started_at = time.monotonic()
+            if packet == b'\x00' * self.packet_size:
                 break
-
-        logger.info("server stopped")
-        self.stop()
+            if self.is_quit_message(packet):
+                self.handle_quit_message()
+                return None
+            if self.is_cancel_message(packet):
+                self.handle_cancel_message()
+                return None
+            packets.append(packet.rstrip(b'\x00'))
+        return b''.join(packets)
 
     def cancel(self):
         pass
@@ -365,25 +641,158 @@ class Server:
                 break
             time.sleep(1)
 
-    def query_llm(self, data: dict):
-        do_json = True
+    def classify_action(self, text: str):
+        if self.replica_pool is not None:
+            return list(self.replica_pool.call("classify_action", text))[0]
+        if self.decode_scheduler is not None:
+            return self.llm_handler.classify_action(text)
+        with self.llm_lock:
+            return self.llm_handler.classify_action(text)
+
+    def embed(self, data: dict, connection: Optional[Connection] = None):
+        """
+        Reply with float16 embeddings of data["texts"] (or data["text"]): a
+        binary embedding frame for framed clients, base64 in JSON otherwise.
+        """
+        texts = data.get("texts") or [data.get("text", "")]
+        vectors = self.embedding_batcher.embed([str(text) for text in texts]).astype(EMBEDDING_DTYPE)
+        if connection is not None and connection.uses_frames:
+            connection.send_frame(
+                FrameType.EMBEDDING,
+                EMBEDDING_HEADER.pack(*vectors.shape) + vectors.tobytes(),
+                flush=False
+            )
+            connection.send_end_message()
+            return
+        self.message_client({
+            "shape": list(vectors.shape),
+            "dtype": "float16",
+            "embeddings": base64.b64encode(vectors.tobytes()).decode("ascii"),
+        }, connection)
+
+    def preload_mood_scorer(self):
+        try:
+            _ = self.mood_scorer
+        except Exception as err:
+            logger.error(f"Failed to load the mood scorer: {err}")
+
+    def update_mood(self, data: dict, connection: Optional[Connection] = None):
+        """Reply with a delta for each of the agent's mood stats based on the latest turns."""
+        history = data.get("history", [])[-settings.MOOD_HISTORY_TURNS:]
+        text = "\n".join(f"{turn['name']}: {turn['message']}" for turn in history)
+        self.message_client({
+            "agent": data.get("agent"),
+            "mood_deltas": self.mood_scorer.score(text, data.get("stats")) if text else {},
+        }, connection)
+
+    def generate_text(self, data: dict):
+        if self.replica_pool is not None:
+            yield from self.replica_pool.call("query_model", data)
+            return
+        if self.decode_scheduler is not None:
+            # Concurrent generations take turns decoding instead of holding the model
+            yield from self.llm_handler.query_model(data)
+            return
+        with self.llm_lock:
+            yield from self.llm_handler.query_model(data)
+
+    def generate_candidates(self, data: dict):
+        if self.replica_pool is not None:
+            yield from self.replica_pool.call("query_model_candidates", data)
+            return
+        if self.decode_scheduler is not None:
+            yield from self.llm_handler.query_model_candidates(data)
+            return
+        with self.llm_lock:
+            yield from self.llm_handler.query_model_candidates(data)
+
+    def query_llm_candidates(self, data: dict, connection: Optional[Connection] = None):
+        """
+        Stream each sampled candidate on its own stream to framed clients.
+        Clients using packets receive all candidates in one JSON message.
+        """
+        if connection is not None and connection.uses_frames:
+            for index, text in self.generate_candidates(data):
+                self.mark_first_output()
+                if text is None:
+                    connection.send_stream_end(index)
+                else:
+                    connection.send_message(text.encode(), stream_id=index)
+            connection.send_end_message()
+            return
+        candidates = [""] * data["num_return_sequences"]
+        for index, text in self.generate_candidates(data):
+            if text:
+                candidates[index] += text
+        self.message_client({"candidates": candidates}, connection)
+
+    def speech_stream(self, data: dict, connection: Optional[Connection]) -> Optional[TTSStream]:
+        """Start speaking the response as audio frames when the request asks for tts."""
+        if not data.get("tts"):
+            return None
+        if connection is None or not connection.uses_frames:
+            logger.warning("Text to speech needs the frames protocol, sending text only")
+            return None
+
+        def send_audio(index: int, sample_rate: int, pcm: bytes):
+            connection.send_frame(FrameType.AUDIO, AUDIO_HEADER.pack(index, sample_rate) + pcm)
+
+        request = getattr(self.request_context, "request", None)
+        return self.tts_pipeline.stream(send_audio, request.enqueued_at if request is not None else None)
+
+    def query_llm(self, data: dict, connection: Optional[Connection] = None):
+        if data.get("num_return_sequences", 1) > 1:
+            self.query_llm_candidates(data, connection)
+            return
+        # Schema constrained output is already valid JSON and can be streamed as is
+        do_json = data.get("json_schema") is None
+        # Spoken while it is generated; schema constrained JSON is not worth speaking
+        speech = self.speech_stream(data, connection) if do_json else None
         response = ""
-        for text in self.llm_handler.query_model(data):
-            response += text
-            if not do_json:
-                self.send_message(text)
+        # Identical deterministic requests share a single generation
+        key = self.coalescer.request_key(data)
+        with span("stream"):
+            for text in self.coalescer.run(key, lambda: self.generate_text(data)):
+                self.mark_first_output()
+                response += text
+                logger.debug_limited("token", lambda: f"Generated {len(response)} characters")
+                if not do_json:
+                    self.send_message(text.encode(), connection)
+                if speech is not None:
+                    speech.feed(text)
 
         if do_json:
             response = response.strip().replace("\n", " ")
             found_json = Server.find_json(response)
             if found_json:
                 response = found_json.group(1)
-                self.send_message(response)
-            else:
-                self.send_message(response)
+            self.send_message(response.encode(), connection)
 
-        self.send_end_message()
+        if speech is not None:
+            # Finish speaking before the response is marked done
+            speech.close()
+            if speech.time_to_first_audio is not None:
+                logger.info(
+                    f"Spoke {speech.sentences} sentences, "
+                    f"first audio after {speech.time_to_first_audio * 1000:.0f}ms"
+                )
+        self.send_end_message(connection)
 
 
 if __name__ == '__main__':
-    server = Server()
+    parser = argparse.ArgumentParser(description="Run an airunner_nexus server.")
+    parser.add_argument("--host", default=settings.DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=settings.DEFAULT_PORT)
+    parser.add_argument("--engine", default=settings.LLM_ENGINE, choices=["transformers", "fake"])
+    parser.add_argument("--replicas", type=int, default=settings.LLM_REPLICAS)
+    parser.add_argument("--unix-socket", default=settings.UNIX_SOCKET_PATH)
+    parser.add_argument("--tts-model", default=settings.TTS_MODEL, choices=["espeak", "fake"])
+    args = parser.parse_args()
+    server = Server(
+        host=args.host,
+        port=args.port,
+        engine=args.engine,
+        replicas=args.replicas,
+        unix_socket_path=args.unix_socket,
+        tts_model=args.tts_model
+    )
@@ -1,10 +1,38 @@
 PACKET_SIZE = 1024
 DEFAULT_PORT = 50006
 DEFAULT_HOST = "0.0.0.0"
+GATEWAY_BACKENDS = ["127.0.0.1:50007", "127.0.0.1:50008"]  # servers behind a gateway, as host:port
+GATEWAY_WORKER_THREADS = 32  # requests a gateway proxies at the same time
+GATEWAY_HEALTH_INTERVAL = 5  # seconds between health checks of each backend
+GATEWAY_HEALTH_TIMEOUT = 2  # seconds before a health check or connection attempt fails
+GATEWAY_AFFINITY_SLACK = 2000  # outstanding tokens a session's backend may exceed the least loaded one by
+GATEWAY_MAX_SESSIONS = 10000  # sessions remembered for affinity
+UNIX_SOCKET_PATH = None  # also listen on this Unix domain socket for local clients, e.g. "~/.airunner/nexus.sock"
+SHM_RING_SIZE = 16 * 1024 * 1024  # bytes in each shared memory ring of a local connection
+SHM_THRESHOLD = 64 * 1024  # frame payloads of at least this many bytes go through shared memory
 USER_NAME = "User"
 BOT_NAME = "AI Bot"
 MAX_CLIENTS = 1
+WORKER_THREADS = 4
+SCHEDULER_WEIGHTS = {"interactive": 8, "batch": 2, "background": 1}  # share of workers and decode steps per priority class
+SCHEDULER_PREEMPT = True  # lower classes pause decoding while a higher class is generating
+DECODE_SCHEDULING = True  # interleave concurrent generations step by step instead of one at a time
+SCHEDULER_LATENCY_WINDOW = 1000  # recent requests per class used for latency percentiles
+TCP_NODELAY = True  # send small writes without waiting for acks (Nagle's algorithm)
+OUTPUT_FLUSH_BYTES = 1024  # flush a connection's output buffer once it holds this many bytes
+OUTPUT_FLUSH_DELAY_MS = 20  # flush buffered output at most this long after it was written
+OUTPUT_FLUSH_ON_SENTENCE = True  # flush as soon as streamed text ends a sentence
 DEBUG = True
+LOG_LEVEL = "DEBUG" if DEBUG else "INFO"
+LOG_FORMAT = "json"  # "json" lines, or "text"
+LOG_QUEUE_SIZE = 10000  # records waiting for the logging thread; more are dropped instead of blocking
+LOG_DEBUG_RATE = 5  # per token debug messages logged per second
+LOG_DEBUG_BURST = 20
+TRACING = False  # time every request's stages; requests can also ask with "trace": true
+TRACE_THRESHOLD_MS = None  # write traces of requests slower than this to TRACE_DIR
+TRACE_DIR = "~/.airunner/traces"
+TRACE_KEEP = 100  # recent traces kept for dump_trace requests
+TRACE_TORCH_PROFILER = False  # run traced generations under torch.profiler
 DEFAULT_SERVER_TYPE = "LLM"
 MODEL_BASE_PATH = "~/.airunner/text/models/causallm"
 MODELS = {
@@ -24,6 +52,54 @@ MODELS = {
     }
 }
 DEFAULT_MODEL_NAME = "mistral_instruct"
+LLM_ENGINE = "transformers"  # "fake" streams canned replies without loading a model, for testing
+FAKE_TOKEN_DELAY = 0.02  # seconds per token streamed by the fake engine
+BATCH_SIZE = 8  # prompts generated together by the batch command
+BATCH_WINDOW = 256  # requests the batch command reads ahead and sorts by length
+LLM_REPLICAS = 0  # number of model worker processes; 0 runs the model inside the server process
+MEMORY_BUDGET_BYTES = None  # memory generations may reserve for KV cache, split between replicas sharing a device; None uses MEMORY_BUDGET_FRACTION of what is free after loading the model
+MEMORY_BUDGET_FRACTION = 0.8
+MEMORY_OVERHEAD_FACTOR = 1.2  # working memory per token beyond the KV cache itself
+MEMORY_OVERFLOW_POLICY = "clamp"  # "clamp" max_new_tokens of requests which can never fit, or "reject" them
+MEMORY_ADMISSION_TIMEOUT = 30  # seconds a request waits for others to free memory before it is rejected
+KV_CACHE_DTYPE_BYTES = None  # bytes per cached value, defaults to the size of the model's dtype
+COMPILED_DECODE = False  # decode single sequences over a static KV cache with a forward pass compiled by torch.compile
+COMPILED_MAX_CACHE_LEN = 4096  # tokens of the static KV cache; longer generations decode eagerly
+COMPILE_MODE = "reduce-overhead"  # torch.compile mode; "reduce-overhead" captures the decode step as a CUDA graph
+COMPILE_WARMUP_STEPS = 4  # decode steps run when the model loads, so compilation happens before the first request
+REPLICA_DEVICES = None  # device of each replica, assigned round robin, e.g. ["cuda:0", "cuda:1"] or ["cpu:0-7", "cpu:8-15"]
+EMBEDDING_MODEL_PATH = "~/.airunner/text/models/embedding/all-MiniLM-L6-v2"
+EMBEDDING_DEVICE = "cpu"
+EMBED_BATCH_WINDOW_MS = 5  # how long embed requests wait for others to share a batch
+EMBED_MAX_BATCH = 256  # texts embedded in one call at most
+EMBED_CACHE_SIZE = 10000  # embeddings of recent texts kept in memory
+TTS_MODEL = "espeak"  # "espeak", or "fake" for a stand-in tone
+TTS_WORKERS = 2  # sentences synthesized at the same time
+TTS_MIN_SENTENCE_CHARS = 12  # shorter sentences are spoken together with the next one
+ESPEAK_VOICE = "en"
+ESPEAK_WORDS_PER_MINUTE = 175
+FAKE_TTS_SAMPLE_RATE = 16000
+FAKE_TTS_DELAY_PER_CHAR = 0.002  # seconds the fake synthesizer takes per character
+ROUTER_CONFIDENCE_THRESHOLD = 0.6  # below this the LLM picks the action
+ROUTER_TEMPERATURE = 0.05
+MOOD_DELTA_SCALE = 5.0
+MOOD_HISTORY_TURNS = 2
+PRELOAD_MOOD_SCORER = True  # load the mood scorer and its embedding model at startup instead of on the first mood update
+JSON_CONSTRAINT_TOP_K = 16  # valid tokens left unmasked per step in json_schema mode
+JSON_CONSTRAINT_MAX_CANDIDATES = 2000  # tokens checked before scanning the whole vocabulary
+RAG_PERSIST_DIR = "~/.airunner/text/rag"
+RAG_WATCH = False
+RAG_WATCH_INTERVAL = 5
+RAG_RETRIEVER = "dense"  # "dense" or "keyword"
+RAG_VECTOR_DTYPE = "float16"  # "float16" or "int8"
+RAG_VECTOR_PARTITIONS = 0  # number of IVF partitions, 0 scans the whole matrix
+RAG_VECTOR_N_PROBE = 8
+RAG_SIMILARITY_TOP_K = 5
+RAG_EMBED_BATCH_SIZE = 64
+RAG_INGEST_WORKERS = None  # defaults to the number of cores
+RAG_INGEST_BATCH_SIZE = 512
+RAG_RETRIEVAL_CACHE_SIZE = 256
+RAG_EMBEDDING_CACHE = "~/.airunner/text/rag/embedding_cache.sqlite"
 LLM_INSTRUCTIONS = {
     "dialogue_instructions": "You are a chatbot. You will follow all of the rules in order to generate compelling and intriguing dialogue.\nThe Rules:\n{dialogue_rules}------\n{mood_stats}------\n{contextual_information}------\n",
     "contextual_information": "Contextual Information:\n{date_time}\nThe weather is {weather}\n",
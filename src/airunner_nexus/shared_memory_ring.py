@@ -0,0 +1,91 @@
+"""
+Shared memory ring buffer for large payloads between local processes.
+
+One side writes a payload into the ring and sends a short descriptor over the
+socket instead of the payload; the other side copies it out and frees the
+space. Each ring has exactly one producer and one consumer: the producer only
+moves the head and the consumer only moves the tail, both stored in the
+ring's header.
+"""
+import struct
+from multiprocessing import resource_tracker, shared_memory
+from typing import Optional
+
+from airunner_nexus import settings
+
+# head, tail: total bytes written and read since the ring was created
+RING_HEADER = struct.Struct("<QQ")
+POSITION = struct.Struct("<Q")
+HEAD_OFFSET = 0
+TAIL_OFFSET = POSITION.size
+# position of the payload in the stream of written bytes, payload length
+DESCRIPTOR = struct.Struct("!QI")
+
+
+class SharedMemoryRing:
+    def __init__(self, name: Optional[str] = None, size: int = settings.SHM_RING_SIZE):
+        """
+        Create a new ring, or attach to an existing one when a name is given.
+        Both sides must use the same size. The side which created the ring
+        unlinks it on close.
+        """
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=RING_HEADER.size + size)
+            RING_HEADER.pack_into(self.shm.buf, 0, 0, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # Only the creator may unlink the segment when its process exits
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.capacity = size
+        self.data = self.shm.buf[RING_HEADER.size:RING_HEADER.size + self.capacity]
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def describe(self) -> dict:
+        return {"name": self.name, "size": self.capacity}
+
+    def _positions(self) -> tuple:
+        return RING_HEADER.unpack_from(self.shm.buf, 0)
+
+    def write(self, payload) -> Optional[bytes]:
+        """
+        Copy a payload into the ring.
+        :return: the descriptor to send, or None if there is not enough free space
+        """
+        size = len(payload)
+        head, tail = self._positions()
+        if size > self.capacity - (head - tail):
+            return None
+        start = head % self.capacity
+        first = min(size, self.capacity - start)
+        self.data[start:start + first] = payload[:first]
+        if first < size:
+            self.data[:size - first] = payload[first:]
+        POSITION.pack_into(self.shm.buf, HEAD_OFFSET, head + size)
+        return DESCRIPTOR.pack(head, size)
+
+    def read(self, descriptor: bytes) -> bytes:
+        """Copy the payload described by a descriptor out of the ring and free its space."""
+        position, size = DESCRIPTOR.unpack(descriptor)
+        head, tail = self._positions()
+        if position != tail or position + size > head:
+            raise ValueError(f"Descriptor {position}+{size} does not match ring state {tail}..{head}")
+        start = position % self.capacity
+        first = min(size, self.capacity - start)
+        payload = bytes(self.data[start:start + first])
+        if first < size:
+            payload += bytes(self.data[:size - first])
+        POSITION.pack_into(self.shm.buf, TAIL_OFFSET, tail + size)
+        return payload
+
+    def close(self):
+        self.data.release()
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
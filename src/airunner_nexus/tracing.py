@@ -0,0 +1,191 @@
+"""
+Opt-in timing of requests, exported in the Chrome trace event format which
+chrome://tracing and https://ui.perfetto.dev open.
+
+A Trace is started when a request is queued and follows it to the threads
+which work on it in a context variable, like the log context. Stages are
+timed with span(); outside a traced request span() does nothing.
+
+Requests are traced when tracing is enabled on the server or when they ask
+for it with "trace": true. Recent traces can be fetched with a dump_trace
+request, and traces of requests slower than the threshold are written to
+the trace directory. With "profile": true the generate span also runs
+under torch.profiler and its own Chrome trace is written next to them.
+"""
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import List, Optional
+
+from airunner_nexus import settings
+from airunner_nexus.logger import logger
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+# torch.profiler is process wide, so only one generation is profiled at a time
+_profiler_lock = threading.Lock()
+
+
+class Trace:
+    """Timed spans of one request, from any thread."""
+    def __init__(self, request_id: int, profile: bool = False):
+        self.request_id = request_id
+        self.profile = profile
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.spans = []
+        # Files written for this request, such as torch.profiler traces
+        self.attachments = {}
+        self._lock = threading.Lock()
+
+    @property
+    def duration(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def add(self, name: str, start: float, end: float, **args):
+        """Record a span between two time.monotonic() readings, on the calling thread."""
+        thread = threading.current_thread()
+        with self._lock:
+            self.spans.append((name, thread.ident, thread.name, start, end, args))
+
+    def events(self) -> List[dict]:
+        """Chrome trace events, with the request as the process and its threads as threads."""
+        with self._lock:
+            spans = list(self.spans)
+        events = [{
+            "name": "process_name",
+            "ph": "M",
+            "pid": self.request_id,
+            "args": {"name": f"request {self.request_id}"},
+        }]
+        thread_names = {}
+        for name, thread_id, thread_name, start, end, args in spans:
+            thread_names[thread_id] = thread_name
+            events.append({
+                "name": name,
+                "cat": "request",
+                "ph": "X",
+                "ts": round(start * 1e6, 3),
+                "dur": round((end - start) * 1e6, 3),
+                "pid": self.request_id,
+                "tid": thread_id,
+                "args": args,
+            })
+        for thread_id, thread_name in thread_names.items():
+            events.append({
+                "name": "thread_name",
+                "ph": "M",
+                "pid": self.request_id,
+                "tid": thread_id,
+                "args": {"name": thread_name},
+            })
+        return events
+
+
+@contextlib.contextmanager
+def span(name: str, **args):
+    """Time the block as a span of the current request's trace, if it has one."""
+    trace = current_trace.get()
+    if trace is None:
+        yield None
+        return
+    start = time.monotonic()
+    try:
+        yield trace
+    finally:
+        trace.add(name, start, time.monotonic(), **args)
+
+
+@contextlib.contextmanager
+def torch_profile(name: str, trace_dir: str = settings.TRACE_DIR):
+    """
+    Run the block under torch.profiler when the current trace asks for it,
+    and attach the Chrome trace the profiler writes. If another block is
+    being profiled, this one runs unprofiled and the trace records why.
+    """
+    trace = current_trace.get()
+    if trace is None or not trace.profile:
+        yield
+        return
+    if not _profiler_lock.acquire(blocking=False):
+        now = time.monotonic()
+        trace.add(f"{name} not profiled", now, now, reason="another request is being profiled")
+        yield
+        return
+    try:
+        import torch
+        from torch.profiler import ProfilerActivity, profile
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        with profile(activities=activities) as profiler:
+            yield
+    finally:
+        _profiler_lock.release()
+    path = os.path.join(os.path.expanduser(trace_dir), f"request-{trace.request_id}-{name}-torch.json")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    profiler.export_chrome_trace(path)
+    trace.attachments[name] = path
+
+
+class Tracer:
+    """Starts traces for requests and keeps, dumps and saves the finished ones."""
+    def __init__(
+        self,
+        enabled: bool = settings.TRACING,
+        threshold_ms: Optional[float] = settings.TRACE_THRESHOLD_MS,
+        trace_dir: str = settings.TRACE_DIR,
+        keep: int = settings.TRACE_KEEP
+    ):
+        """
+        :param enabled: trace every request, not only those which ask for it
+        :param threshold_ms: write traces of requests which took longer to trace_dir; None writes none
+        :param keep: finished traces kept for dump_trace requests
+        """
+        self.enabled = enabled
+        self.threshold = threshold_ms / 1000 if threshold_ms is not None else None
+        self.trace_dir = trace_dir
+        self.finished = deque(maxlen=keep)
+        self._lock = threading.Lock()
+
+    def start(self, request_id: int, data: dict) -> Optional[Trace]:
+        if not self.enabled and not data.get("trace"):
+            return None
+        return Trace(request_id, profile=bool(data.get("profile", settings.TRACE_TORCH_PROFILER)))
+
+    def finish(self, trace: Trace):
+        trace.finished_at = time.monotonic()
+        with self._lock:
+            self.finished.append(trace)
+        if self.threshold is not None and trace.duration >= self.threshold:
+            path = os.path.join(os.path.expanduser(self.trace_dir), f"request-{trace.request_id}.json")
+            self.write([trace], path)
+            logger.info(f"Request took {trace.duration * 1000:.0f}ms, trace written to {path}")
+
+    def dump(self, request_id: Optional[int] = None) -> dict:
+        """:return: a Chrome trace of one request, or of every kept request"""
+        with self._lock:
+            traces = [trace for trace in self.finished if request_id is None or trace.request_id == request_id]
+        return self.chrome_trace(traces)
+
+    @staticmethod
+    def chrome_trace(traces: List[Trace]) -> dict:
+        return {
+            "traceEvents": [event for trace in traces for event in trace.events()],
+            "displayTimeUnit": "ms",
+            "otherData": {
+                str(trace.request_id): {
+                    "duration_ms": round(trace.duration * 1000, 3),
+                    "attachments": trace.attachments,
+                }
+                for trace in traces
+            },
+        }
+
+    def write(self, traces: List[Trace], path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as trace_file:
+            json.dump(self.chrome_trace(traces), trace_file)
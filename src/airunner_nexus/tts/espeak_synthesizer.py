@@ -0,0 +1,35 @@
+import shutil
+import subprocess
+from typing import Tuple
+
+from airunner_nexus import settings
+
+# Size of the header espeak writes before the samples
+WAV_HEADER_SIZE = 44
+
+
+class EspeakSynthesizer:
+    """
+    Synthesize speech with the espeak-ng (or espeak) command line.
+
+    pyttsx3 drives the same voices but its engine is a per process
+    singleton which cannot run several sentences at once; a process per
+    sentence lets the pipeline's workers synthesize in parallel.
+    """
+    def __init__(self, voice: str = settings.ESPEAK_VOICE, words_per_minute: int = settings.ESPEAK_WORDS_PER_MINUTE):
+        self.voice = voice
+        self.words_per_minute = words_per_minute
+        self.command = shutil.which("espeak-ng") or shutil.which("espeak")
+        if self.command is None:
+            raise RuntimeError("espeak-ng or espeak must be installed for espeak text to speech")
+
+    def synthesize(self, text: str) -> Tuple[int, bytes]:
+        """:return: sample rate, and mono 16 bit little endian PCM"""
+        # The text goes on stdin, so a sentence starting with "-" is never read as an option
+        wav = subprocess.run(
+            [self.command, "--stdout", "--stdin", "-v", self.voice, "-s", str(self.words_per_minute)],
+            input=text.encode("utf-8"),
+            check=True,
+            capture_output=True
+        ).stdout
+        return int.from_bytes(wav[24:28], "little"), wav[WAV_HEADER_SIZE:]
@@ -0,0 +1,30 @@
+import time
+from typing import Tuple
+
+import numpy as np
+
+from airunner_nexus import settings
+
+
+class FakeSynthesizer:
+    """
+    Stand-in synthesizer for testing the TTS pipeline without a voice.
+
+    Returns a quiet tone whose length follows the length of the text, after
+    waiting as long as a real model might take to synthesize it.
+    """
+    def __init__(
+        self,
+        sample_rate: int = settings.FAKE_TTS_SAMPLE_RATE,
+        delay_per_char: float = settings.FAKE_TTS_DELAY_PER_CHAR
+    ):
+        self.sample_rate = sample_rate
+        self.delay_per_char = delay_per_char
+
+    def synthesize(self, text: str) -> Tuple[int, bytes]:
+        """:return: sample rate, and mono 16 bit little endian PCM"""
+        time.sleep(self.delay_per_char * len(text))
+        # Roughly 15 characters of speech per second
+        samples = np.arange(int(self.sample_rate * len(text) / 15))
+        tone = 0.1 * np.sin(2 * np.pi * 220 * samples / self.sample_rate)
+        return self.sample_rate, (tone * 32767).astype("<i2").tobytes()
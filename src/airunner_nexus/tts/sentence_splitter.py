@@ -0,0 +1,40 @@
+import re
+from typing import List
+
+from airunner_nexus import settings
+
+# End of a sentence, with any closing quotes or brackets, once whitespace follows it
+SENTENCE_BOUNDARY = re.compile(r'[.!?]+["\')\]]*\s+|\n+')
+
+
+class SentenceSplitter:
+    """
+    Split streamed text into sentences as soon as they are complete.
+
+    A boundary only counts once the whitespace after it has arrived, so
+    "3.14" or a token ending in "." is not cut early. Sentences shorter
+    than min_chars are joined to the next one rather than spoken alone.
+    """
+    def __init__(self, min_chars: int = settings.TTS_MIN_SENTENCE_CHARS):
+        self.min_chars = min_chars
+        self.buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        """Add streamed text and return the sentences it completed."""
+        self.buffer += text
+        sentences = []
+        start = 0
+        for match in SENTENCE_BOUNDARY.finditer(self.buffer):
+            sentence = self.buffer[start:match.end()].strip()
+            if len(sentence) < self.min_chars:
+                continue
+            sentences.append(sentence)
+            start = match.end()
+        self.buffer = self.buffer[start:]
+        return sentences
+
+    def flush(self) -> List[str]:
+        """Return whatever is left once the stream has ended."""
+        sentence = self.buffer.strip()
+        self.buffer = ""
+        return [sentence] if sentence else []
@@ -0,0 +1,151 @@
+"""
+Speak a response while it is still being generated.
+
+Text streamed from the model is split into sentences as they complete. Each
+sentence is synthesized in a pool of workers while generation carries on,
+and a delivery thread hands the audio to the caller in sentence order as
+soon as the next one is ready.
+"""
+import contextvars
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from airunner_nexus import settings
+from airunner_nexus.enums import TTSModel
+from airunner_nexus.logger import logger
+from airunner_nexus.scheduler import percentile
+from airunner_nexus.tts.sentence_splitter import SentenceSplitter
+
+
+def load_synthesizer(model: str):
+    """Create the synthesizer for a TTSModel value."""
+    model = TTSModel(model)
+    if model is TTSModel.FAKE:
+        from airunner_nexus.tts.fake_synthesizer import FakeSynthesizer
+        return FakeSynthesizer()
+    if model is TTSModel.ESPEAK:
+        from airunner_nexus.tts.espeak_synthesizer import EspeakSynthesizer
+        return EspeakSynthesizer()
+    raise ValueError(f"Text to speech model {model.value} is not supported by the server")
+
+
+class TTSStream:
+    """The sentences of one response, from the first token until its last audio is delivered."""
+    def __init__(
+        self,
+        pipeline: "TTSPipeline",
+        on_audio: Callable[[int, int, bytes], None],
+        started_at: Optional[float] = None
+    ):
+        """
+        :param on_audio: called with sentence index, sample rate and PCM for each sentence, in order
+        :param started_at: time.monotonic() the request arrived, defaults to now
+        """
+        self.pipeline = pipeline
+        self.on_audio = on_audio
+        self.started_at = started_at or time.monotonic()
+        self.first_audio_at = None
+        self.splitter = SentenceSplitter(pipeline.min_chars)
+        self.sentences = 0
+        self.failed = False
+        self.synthesized = queue.SimpleQueue()
+        self.delivery = threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(self._deliver,),
+            daemon=True,
+            name="tts delivery"
+        )
+        self.delivery.start()
+
+    @property
+    def time_to_first_audio(self) -> Optional[float]:
+        if self.first_audio_at is None:
+            return None
+        return self.first_audio_at - self.started_at
+
+    def feed(self, text: str):
+        """Add generated text, starting synthesis of any sentence it completes."""
+        for sentence in self.splitter.feed(text):
+            self._submit(sentence)
+
+    def close(self):
+        """Synthesize the rest of the text and wait until all audio has been delivered."""
+        for sentence in self.splitter.flush():
+            self._submit(sentence)
+        self.synthesized.put(None)
+        self.delivery.join()
+        if self.first_audio_at is not None:
+            self.pipeline.record(self.time_to_first_audio)
+
+    def _submit(self, sentence: str):
+        self.synthesized.put((self.sentences, self.pipeline.executor.submit(self.pipeline.synthesize, sentence)))
+        self.sentences += 1
+
+    def _deliver(self):
+        while True:
+            item = self.synthesized.get()
+            if item is None:
+                break
+            index, future = item
+            try:
+                sample_rate, pcm = future.result()
+            except Exception as e:
+                logger.error(f"Failed to synthesize sentence {index}: {e}")
+                continue
+            if self.failed:
+                continue
+            if self.first_audio_at is None:
+                self.first_audio_at = time.monotonic()
+            try:
+                self.on_audio(index, sample_rate, pcm)
+            except Exception as e:
+                # Keep draining so close() returns, but stop sending to a client which has gone
+                logger.error(f"Failed to deliver audio: {e}")
+                self.failed = True
+
+
+class TTSPipeline:
+    """A synthesizer shared by every response being spoken, and the workers which run it."""
+    def __init__(
+        self,
+        synthesizer=None,
+        workers: int = settings.TTS_WORKERS,
+        min_chars: int = settings.TTS_MIN_SENTENCE_CHARS
+    ):
+        """
+        :param synthesizer: anything with synthesize(text) -> (sample rate, PCM bytes),
+            defaults to the settings.TTS_MODEL one
+        """
+        self.synthesizer = synthesizer or load_synthesizer(settings.TTS_MODEL)
+        self.min_chars = min_chars
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tts worker")
+        self.first_audio = deque(maxlen=settings.SCHEDULER_LATENCY_WINDOW)
+        self._lock = threading.Lock()
+
+    def synthesize(self, text: str) -> tuple:
+        return self.synthesizer.synthesize(text)
+
+    def stream(self, on_audio: Callable[[int, int, bytes], None], started_at: Optional[float] = None) -> TTSStream:
+        return TTSStream(self, on_audio, started_at)
+
+    def record(self, time_to_first_audio: float):
+        with self._lock:
+            self.first_audio.append(time_to_first_audio)
+
+    def stats(self) -> dict:
+        with self._lock:
+            values = list(self.first_audio)
+        return {
+            "responses": len(values),
+            **{
+                f"first_audio_{label}_ms": round(value * 1000, 2) if value is not None else None
+                for label, value in (("p50", percentile(values, 0.5)), ("p99", percentile(values, 0.99)))
+            },
+        }
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)